@@ -1,6 +1,11 @@
-from PIL import Image
 import numpy as np
 from typing import Dict, Tuple, Optional
+from image_io import open_tiff, iter_tiles, TileShape, DEFAULT_TILE_SHAPE
+from band_profile import profile_axis, bin_mask, bin_coverage, PROFILE_AXES, DEFAULT_PROFILE_AXIS
+from centreline import downsample_factor, new_coverage, accumulate_coverage, skeleton_centreline
+
+# pixel value of the subiculum in the mask .tif
+SUB_MASK_VALUE = 255
 
 def calculate_end_connecting_line(
     L_end_pixel: Tuple[float, float], 
@@ -19,7 +24,9 @@ def calculate_end_connecting_line(
         'direction_vector': (0.0, 0.0), #um
         'is_vertical': False,
         'is_horizontal': False,
-        'midpoint_um': ((x1 + x2)/2, (y1 + y2)/2)
+        'midpoint_um': ((x1 + x2)/2, (y1 + y2)/2),
+        'left_end_um': (x1, y1),
+        'right_end_um': (x2, y2)
     }
     
     dx = x2 - x1
@@ -96,10 +103,19 @@ def calculate_perpendicular_line(
 def analyze_mask_sub(
     image_path_sub: str,
     pixel_to_micrometer: float,
-    left_sub_end: Tuple[float, float],
-    right_sub_end: Tuple[float, float]
+    left_sub_end: Optional[Tuple[float, float]] = None,
+    right_sub_end: Optional[Tuple[float, float]] = None,
+    tile_shape: TileShape = DEFAULT_TILE_SHAPE,
+    profile_bins: Optional[int] = None,
+    profile_axis_kind: str = DEFAULT_PROFILE_AXIS
 ) -> Dict:
     """
+    left_sub_end, right_sub_end: the 2 ends of the subiculum (x, y) in pixel,
+    None = use the ends of the centreline found in the mask (centreline.py)
+    profile_bins: also measure the subiculum area in that many proximal-distal
+    bins (see band_profile.profile_axis), in the same pass over the mask
+    profile_axis_kind: 'skeleton' (curved centreline) or 'line' (straight midline)
+
     return data structure
     {
         "geometry": {
@@ -117,33 +133,73 @@ def analyze_mask_sub(
             "direction_vector": (...),
             "is_vertical": ...,
             "is_horizontal": ...,
-            'midpoint_um': ...
+            'midpoint_um': ...,
+            'left_end_um': ..., 'right_end_um': ...
         },
+        "centreline": {...},          # only when the centreline was needed,
+                                      # see centreline.skeleton_centreline
         "dividing_line": {
             "slope": ...,
             "intercept": ...,
             "direction_vector": (...),
             "is_vertical": ...,
             "is_horizontal": ...
+        },
+        "profile": {                  # only with profile_bins
+            "n_bins": ...,
+            "axis": ...,              # 'skeleton' / 'line'
+            "sub_area_um2": [...]     # subiculum area per bin
         }
     }
     """
-    # load image
-    with Image.open(image_path_sub) as img:
-        img_array = np.array(img)
-    
-    binary_mask = (img_array == 255).astype(np.uint8)
-    white_coords = np.argwhere(binary_mask == 1)
-    
-    if white_coords.size == 0:
+    if profile_axis_kind not in PROFILE_AXES:
+        raise ValueError(f"Unknown profile axis {profile_axis_kind!r}, expected one of {PROFILE_AXES}")
+    manual_ends = left_sub_end is not None and right_sub_end is not None
+    need_centreline = not manual_ends or (profile_bins and profile_axis_kind == 'skeleton')
+
+    # straight axis between known ends: bin every mask pixel in the streaming pass
+    axis = None
+    if manual_ends:
+        # cal midline (connecting two ends) in um!!
+        connect_line = calculate_end_connecting_line(left_sub_end, right_sub_end, pixel_to_micrometer)
+        if profile_bins and not need_centreline:
+            axis = profile_axis(connect_line, profile_bins)
+    sub_bin_pixels = np.zeros(profile_bins or 0, dtype=np.int64)
+
+    # open image, strips / tiles are decoded as they are needed
+    img_array = open_tiff(image_path_sub)
+
+    # centreline: the mask is reduced to a block coverage grid in the same pass
+    if need_centreline:
+        factor = downsample_factor(img_array.shape)
+        coverage = new_coverage(img_array.shape, factor)
+
+    # stream the white (255) region tile by tile: pixel count + bounding box
+    n_white = 0
+    min_row = min_col = None
+    max_row = max_col = None
+    for r0, r1, c0, c1 in iter_tiles(img_array.shape, tile_shape):
+        binary_mask = np.asarray(img_array[r0:r1, c0:c1]) == SUB_MASK_VALUE
+        white_rows = np.nonzero(binary_mask.any(axis=1))[0]
+        if white_rows.size == 0:
+            continue
+        white_cols = np.nonzero(binary_mask.any(axis=0))[0]
+        n_white += int(np.count_nonzero(binary_mask))
+        min_row = r0 + white_rows[0] if min_row is None else min(min_row, r0 + white_rows[0])
+        max_row = r0 + white_rows[-1] if max_row is None else max(max_row, r0 + white_rows[-1])
+        min_col = c0 + white_cols[0] if min_col is None else min(min_col, c0 + white_cols[0])
+        max_col = c0 + white_cols[-1] if max_col is None else max(max_col, c0 + white_cols[-1])
+        if axis is not None:
+            sub_bin_pixels += bin_mask(axis, binary_mask, pixel_to_micrometer, row_offset=r0, col_offset=c0)
+        if need_centreline:
+            accumulate_coverage(coverage, binary_mask, factor, row_offset=r0, col_offset=c0)
+
+    if n_white == 0:
         raise ValueError("No white region found in the image")
-    
+
     # calculate the geometry
-    min_row, min_col = white_coords.min(axis=0)
-    max_row, max_col = white_coords.max(axis=0)
-    
     geometry = {
-        "area_um2": binary_mask.sum() * (pixel_to_micrometer ** 2),
+        "area_um2": n_white * (pixel_to_micrometer ** 2),
         "width_um": (max_col - min_col + 1) * pixel_to_micrometer,
         "height_um": (max_row - min_row + 1) * pixel_to_micrometer,
         "bounding_box": {
@@ -154,15 +210,35 @@ def analyze_mask_sub(
         }
     }
     
-    # cal midline (connecting two ends) in um!!
-    connect_line = calculate_end_connecting_line(left_sub_end, right_sub_end, pixel_to_micrometer)
-    
+    centreline = None
+    if need_centreline:
+        centreline = skeleton_centreline(coverage, img_array.shape, factor, pixel_to_micrometer,
+                                         left_end=left_sub_end)
+        if not manual_ends:
+            # the ends of the centreline replace the hand-typed ends
+            left_sub_end, right_sub_end = centreline["left_end_pixel"], centreline["right_end_pixel"]
+            connect_line = calculate_end_connecting_line(left_sub_end, right_sub_end, pixel_to_micrometer)
+
     # cal dividing line
     perpendicular_line = calculate_perpendicular_line(connect_line)
 
-    return {
+    result = {
         "geometry": geometry,
         "midline": connect_line,
         "dividing_line": perpendicular_line
     }
+    if centreline is not None:
+        result["centreline"] = centreline
+    if profile_bins:
+        if axis is None:
+            # binned by block, on the coverage grid of the centreline pass
+            axis = profile_axis(connect_line, profile_bins,
+                                centreline if profile_axis_kind == 'skeleton' else None)
+            sub_bin_pixels = bin_coverage(axis, coverage, factor, pixel_to_micrometer)
+        result["profile"] = {
+            "n_bins": profile_bins,
+            "axis": profile_axis_kind,
+            "sub_area_um2": (sub_bin_pixels * (pixel_to_micrometer ** 2)).tolist()
+        }
+    return result
 
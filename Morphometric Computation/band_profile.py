@@ -0,0 +1,109 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+from centreline import t_of_pixels
+
+# number of proximal-distal bins in batch runs
+DEFAULT_PROFILE_BINS = 10
+# 'skeleton': curved centreline of the mask (centreline.py), 'line': straight line between the ends
+PROFILE_AXES = ('skeleton', 'line')
+DEFAULT_PROFILE_AXIS = 'skeleton'
+
+def profile_axis(midline: Dict, n_bins: int, centreline: Optional[Dict] = None) -> Dict:
+    """
+    proximal-distal axis of one slice, computed once and used for every object type
+    every point gets a position t, 0 at the left end and 1 at the right end, and
+    falls in bin floor(t * n_bins) (points beyond the ends go to the first / last bin)
+
+    with centreline (analyze_mask_sub "centreline"): t is the arc length position
+    of the nearest centreline point, looked up in the centreline's t_map
+
+    otherwise the straight midline of analyze_mask_sub (left end -> right end, in um):
+    t = (p - left_end) . (right_end - left_end) / |right_end - left_end|^2
+    with n_bins = 2 the bins are the left / right halves of is_left (except for a
+    vertical midline, where calculate_perpendicular_line does not keep the direction)
+    """
+    if n_bins < 1:
+        raise ValueError(f"n_bins must be >= 1, got {n_bins}")
+    if centreline is not None:
+        return {'kind': 'skeleton', 'centreline': centreline, 'n_bins': n_bins}
+    x1, y1 = midline['left_end_um']
+    x2, y2 = midline['right_end_um']
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        raise ValueError("Left and right end of the subiculum are the same point")
+    return {
+        'kind': 'line',
+        'origin': (x1, y1),
+        'step': (dx / length_sq, dy / length_sq),  # t per um along x / y
+        'n_bins': n_bins
+    }
+
+def slice_profile_axis(sub_result: Dict) -> Optional[Dict]:
+    # the axis analyze_mask_sub measured the subiculum profile with, None without profile
+    profile = sub_result.get("profile")
+    if profile is None:
+        return None
+    centreline = sub_result.get("centreline") if profile["axis"] == 'skeleton' else None
+    return profile_axis(sub_result["midline"], profile["n_bins"], centreline)
+
+def position_of_points(axis: Dict, x_um, y_um) -> np.ndarray:
+    """position t along the axis of points in um"""
+    x_um = np.asarray(x_um, dtype=np.float64)
+    y_um = np.asarray(y_um, dtype=np.float64)
+    if axis['kind'] == 'skeleton':
+        centreline = axis['centreline']
+        px = centreline['pixel_to_micrometer']
+        return t_of_pixels(centreline, np.rint(y_um / px), np.rint(x_um / px)).astype(np.float64)
+    return (x_um - axis['origin'][0]) * axis['step'][0] + (y_um - axis['origin'][1]) * axis['step'][1]
+
+def bin_of(axis: Dict, t: np.ndarray) -> np.ndarray:
+    return np.clip(np.floor(t * axis['n_bins']), 0, axis['n_bins'] - 1).astype(np.int64)
+
+def bin_positions(axis: Dict, t: np.ndarray,
+                  weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    per bin: number of points at positions t (position_of_points) and sum of
+    weights (e.g. object areas), in one pass
+    """
+    bins = bin_of(axis, np.asarray(t, dtype=np.float64))
+    counts = np.bincount(bins, minlength=axis['n_bins'])
+    sums = np.bincount(bins, weights=weights, minlength=axis['n_bins']) if weights is not None \
+        else counts.astype(np.float64)
+    return counts, sums
+
+def bin_mask(axis: Dict, mask: np.ndarray, pixel_to_micrometer: float,
+             row_offset: int = 0, col_offset: int = 0) -> np.ndarray:
+    """
+    number of nonzero pixels of a 2D mask (or a tile of it) per bin
+    t is separable in row and column, so it is evaluated once per row and
+    once per column and summed for each nonzero pixel
+    (skeleton axis: t of each pixel's block in the centreline t_map)
+    """
+    if axis['kind'] == 'skeleton':
+        rows, cols = np.nonzero(mask)
+        t = t_of_pixels(axis['centreline'], rows + row_offset, cols + col_offset)
+        return np.bincount(bin_of(axis, t), minlength=axis['n_bins'])
+    n_rows, n_cols = mask.shape
+    col_t = (np.arange(col_offset, col_offset + n_cols) * pixel_to_micrometer - axis['origin'][0]) * axis['step'][0]
+    row_t = (np.arange(row_offset, row_offset + n_rows) * pixel_to_micrometer - axis['origin'][1]) * axis['step'][1]
+    rows, cols = np.nonzero(mask)
+    return np.bincount(bin_of(axis, row_t[rows] + col_t[cols]), minlength=axis['n_bins'])
+
+def bin_coverage(axis: Dict, coverage: np.ndarray, factor: int, pixel_to_micrometer: float) -> np.ndarray:
+    """
+    pixels per bin from a block coverage (centreline.new_coverage), each
+    block is binned at its centre
+    """
+    if axis['kind'] == 'skeleton':
+        t = axis['centreline']['t_map']
+    else:
+        block_rows, block_cols = np.indices(coverage.shape)
+        t = position_of_points(axis, ((block_cols + 0.5) * factor - 0.5) * pixel_to_micrometer,
+                               ((block_rows + 0.5) * factor - 0.5) * pixel_to_micrometer)
+    return np.bincount(bin_of(axis, t).ravel(), weights=coverage.ravel(),
+                       minlength=axis['n_bins']).astype(np.int64)
+
+def bin_edges(n_bins: int) -> np.ndarray:
+    # bin borders as fractions of the left end -> right end distance
+    return np.arange(n_bins + 1) / n_bins
@@ -0,0 +1,572 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from typing import Dict, IO, List, Optional, Tuple
+from cal_area import analyze_mask
+from analyze_SUB import analyze_mask_sub
+from save_results import save_results
+from result_store import ResultStore, STORE_FORMATS, open_store
+from image_io import DEFAULT_TILE_SHAPE, MASKS_CACHE_DIRNAME, clear_decode_cache
+from spatial_index import DEFAULT_PROXIMITY_RADIUS_UM
+from band_profile import slice_profile_axis, DEFAULT_PROFILE_BINS, DEFAULT_PROFILE_AXIS, PROFILE_AXES
+from result_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, slice_cache_key, load_cached, store_cached, \
+    clear as clear_cache
+from cohort import CohortAggregator, load_cohort, DEFAULT_STATE_NAME
+from checkpoint import slice_fingerprint, load_checkpoint, save_checkpoint, DEFAULT_CHECKPOINT_NAME
+from run_log import StageLog, traced_memory, peak_rss_bytes, open_log, write_event, run_report, DEFAULT_LOG_NAME
+from density_map import density_maps, save_density_maps, map_path, DEFAULT_DENSITY_DIR, DEFAULT_DENSITY_SIGMA
+
+# same choices as the interactive prompts in main.py
+AGE_MAPPING = {'1': '6 weeks', '2': '10 weeks', '3': '6 months'}
+SEX_MAPPING = {'1': 'Female', '2': 'Male'}
+GENOTYPE_MAPPING = {'1': 'WT', '2': '5XFAD'}
+
+# manifest columns, one row per slice
+REQUIRED_COLUMNS = [
+    'cell_npy_path', 'ab_npy_path', 'sub_path',
+    'physical_width', 'physical_height', 'pixel_width',
+    'age', 'mouse_id', 'sex', 'genotype'
+]
+# optional: left_sub_end, right_sub_end (empty = ends of the mask centreline), slice_id
+PATH_COLUMNS = ['cell_npy_path', 'ab_npy_path', 'sub_path']
+
+def load_manifest(manifest_path: str) -> List[Dict]:
+    """
+    read a CSV or YAML manifest, return a list of row dicts
+    YAML can be a list of rows or a mapping with a 'slices' list
+    relative paths are resolved against the manifest folder
+    """
+    ext = os.path.splitext(manifest_path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        import yaml  # only needed for YAML manifests
+        with open(manifest_path, encoding='utf-8') as f:
+            content = yaml.safe_load(f)
+        rows = content.get('slices', []) if isinstance(content, dict) else content
+    else:
+        # read everything as text, numbers are parsed per row
+        rows = pd.read_csv(manifest_path, dtype=str, keep_default_na=False).to_dict('records')
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for row in rows:
+        for col in PATH_COLUMNS:
+            path = str(row.get(col, '')).strip().strip('"')
+            if path and not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            row[col] = path
+    return rows
+
+def _parse_point(value) -> Tuple[float, float]:
+    # "1000, 2000" or [1000, 2000]
+    if isinstance(value, str):
+        value = value.strip().strip('()[]').split(',')
+    point = tuple(float(v) for v in value)
+    if len(point) != 2:
+        raise ValueError(f"Expected 2 coordinates, got {value}")
+    return point
+
+def _parse_optional_point(value) -> Optional[Tuple[float, float]]:
+    if value is None or str(value).strip() == '':
+        return None
+    return _parse_point(value)
+
+def _parse_choice(value, mapping: Dict[str, str], name: str) -> str:
+    # accept either the prompt number or the label itself
+    value = str(value).strip()
+    if value in mapping:
+        return mapping[value]
+    if value in mapping.values():
+        return value
+    raise ValueError(f"Unknown {name}: {value!r}, expected one of {list(mapping.values())}")
+
+def default_slice_id(cell_npy_path: str) -> str:
+    # image_seg.npy -> image, one Cellpose output per slice
+    name = os.path.splitext(os.path.basename(cell_npy_path))[0]
+    return name[:-len('_seg')] if name.endswith('_seg') else name
+
+def parse_row(row: Dict) -> Dict:
+    """Validate one manifest row and convert it to the analysis parameters."""
+    missing = [col for col in REQUIRED_COLUMNS if str(row.get(col, '')).strip() == '']
+    if missing:
+        raise ValueError(f"Missing manifest columns: {', '.join(missing)}")
+
+    for col in PATH_COLUMNS:
+        if not os.path.isfile(row[col]):
+            raise FileNotFoundError(f"{col} does not exist: {row[col]}")
+
+    physical_width = float(row['physical_width'])
+    physical_height = float(row['physical_height'])
+    pixel_width = int(float(row['pixel_width']))
+
+    return {
+        'cell_npy_path': row['cell_npy_path'],
+        'ab_npy_path': row['ab_npy_path'],
+        'sub_path': row['sub_path'],
+        'physical_width': physical_width,
+        'physical_height': physical_height,
+        'pixel_to_micrometer': physical_width / pixel_width,  # Assumes square pixels
+        'left_sub_end': _parse_optional_point(row.get('left_sub_end')),
+        'right_sub_end': _parse_optional_point(row.get('right_sub_end')),
+        'age': _parse_choice(row['age'], AGE_MAPPING, 'age'),
+        'mouse_id': str(row['mouse_id']).strip(),
+        'slice_id': str(row.get('slice_id') or '').strip() or default_slice_id(row['cell_npy_path']),
+        'sex': _parse_choice(row['sex'], SEX_MAPPING, 'sex'),
+        'genotype': _parse_choice(row['genotype'], GENOTYPE_MAPPING, 'genotype')
+    }
+
+# parameters that change the analysis result, part of the cache key
+CACHE_PARAM_KEYS = ['pixel_to_micrometer', 'left_sub_end', 'right_sub_end', 'age']
+
+# run-wide options shared by every slice
+DEFAULT_OPTIONS = {
+    'cache_dir': DEFAULT_CACHE_DIR,      # None disables the result cache
+    'cache_max_bytes': DEFAULT_MAX_BYTES,
+    'tile_shape': DEFAULT_TILE_SHAPE,    # (rows, cols) streamed at a time, None = full size
+    'roi_mode': None,                    # None / 'pixels' / 'centroid', see cal_area.analyze_mask
+    'profile_bins': DEFAULT_PROFILE_BINS,  # proximal-distal bins, None / 0 = no profile
+    'profile_axis': DEFAULT_PROFILE_AXIS,  # 'skeleton' / 'line', see band_profile.profile_axis
+    'proximity_radius_um': DEFAULT_PROXIMITY_RADIUS_UM,  # cells-around-plaque radius in spatial_data
+    'verbose': False,                    # print the per-slice stats of analyze_mask
+    'density_dir': None,                 # folder of the per-slice density maps, None = no maps
+    'density_sigma': DEFAULT_DENSITY_SIGMA,  # kernel sd in midline lengths, see density_map.py
+    'checkpoint_every': 1,               # commit the results after this many finished slices
+    'trace_memory': False                # per-stage peak memory with tracemalloc (slower)
+}
+# options that change the analysis result, also part of the cache key
+CACHE_OPTION_KEYS = ['roi_mode', 'profile_bins', 'profile_axis']
+# options that change anything written for a slice, part of its resume fingerprint:
+# the analysis plus what finish_slice derives from it (spatial_data, density maps)
+RESUME_OPTION_KEYS = CACHE_OPTION_KEYS + ['proximity_radius_um', 'density_dir', 'density_sigma']
+
+def _with_defaults(options: Optional[Dict]) -> Dict:
+    return {**DEFAULT_OPTIONS, **(options or {})}
+
+def analyze_slice(params: Dict, options: Optional[Dict] = None) -> Dict:
+    """
+    analyze_mask_sub -> analyze_mask for one parsed row, or load the result
+    from the cache when the inputs and parameters are unchanged
+    runs in a worker process, so it must not write any output file
+
+    return data structure
+    {
+        "mask_result": ..., "sub_result": ...,
+        "peak_bytes": ...,   # with options['trace_memory']: peak memory allocated by the analysis
+                             # (tracemalloc, memory-mapped pages are not counted), else None
+        "peak_rss_bytes": ...,   # peak resident set size of the process after the analysis
+                                 # (run_log.peak_rss_bytes, None on Windows)
+        "cache_key": ...,    # None without cache
+        "cached": ...,       # True if loaded from the cache
+        "seconds": ...,
+        "stages": [...]      # run_log.StageLog records: sub, load, overlap, label_stats, split
+                             # (or cache_load), finish_slice adds cache_store, tables, cohort, density
+    }
+    """
+    options = _with_defaults(options)
+    # memory is traced while this slice is analyzed only, and only if asked for
+    with traced_memory(options['trace_memory']):
+        outcome = _analyze_traced(params, options)
+    outcome['peak_rss_bytes'] = peak_rss_bytes()
+    return outcome
+
+def _analyze_traced(params: Dict, options: Dict) -> Dict:
+    # analyze_slice inside traced_memory, the peak is read before the trace stops
+    log = StageLog()
+
+    cache_key = None
+    if options['cache_dir']:
+        with log.stage('cache_load') as counts:
+            cache_key = slice_cache_key(
+                [params[col] for col in PATH_COLUMNS],
+                {**{k: params[k] for k in CACHE_PARAM_KEYS}, **{k: options[k] for k in CACHE_OPTION_KEYS}}
+            )
+            cached = load_cached(options['cache_dir'], cache_key)
+            counts['hit'] = cached is not None
+        if cached is not None:
+            mask_result, sub_result = cached
+            return {'mask_result': mask_result, 'sub_result': sub_result,
+                    'peak_bytes': log.peak_bytes(), 'cache_key': cache_key, 'cached': True,
+                    'seconds': log.seconds(), 'stages': log.stages}
+
+    # the sub mask is read by both steps: decode it once, then free it for the next slice
+    try:
+        mask_result, sub_result = _analyze(params, options, log)
+    finally:
+        clear_decode_cache()
+
+    return {'mask_result': mask_result, 'sub_result': sub_result,
+            'peak_bytes': log.peak_bytes(), 'cache_key': cache_key, 'cached': False,
+            'seconds': log.seconds(), 'stages': log.stages}
+
+def _analyze(params: Dict, options: Dict, log: StageLog) -> Tuple[Dict, Dict]:
+    with log.stage('sub') as counts:
+        sub_result = analyze_mask_sub(
+            params['sub_path'], params['pixel_to_micrometer'],
+            params['left_sub_end'], params['right_sub_end'],
+            tile_shape=options['tile_shape'],
+            profile_bins=options['profile_bins'],
+            profile_axis_kind=options['profile_axis']
+        )
+        counts['sub_area_um2'] = sub_result['geometry']['area_um2']
+    # one proximal-distal axis per slice, shared by the sub mask and all objects
+    axis = slice_profile_axis(sub_result)
+    mask_result = analyze_mask(
+        params['cell_npy_path'], params['ab_npy_path'], params['pixel_to_micrometer'], params['age'],
+        sub_result["midline"]["midpoint_um"], sub_result["dividing_line"]["direction_vector"],
+        tile_shape=options['tile_shape'],
+        sub_path=params['sub_path'],
+        bounding_box=sub_result["geometry"]["bounding_box"],
+        roi_mode=options['roi_mode'],
+        profile_axis=axis,
+        stage_log=log,
+        verbose=options['verbose'],
+        masks_cache_dir=os.path.join(options['cache_dir'], MASKS_CACHE_DIRNAME) if options['cache_dir'] else None
+    )
+    return mask_result, sub_result
+
+def save_slice(params: Dict, mask_result: Dict, sub_result: Dict, store: ResultStore,
+               options: Optional[Dict] = None) -> Dict:
+    # only ever called from the main process, one slice at a time
+    options = _with_defaults(options)
+    return save_results(
+        params['mouse_id'], params['sex'], params['genotype'], params['age'],
+        params['pixel_to_micrometer'], params['physical_width'], params['physical_height'],
+        mask_result,
+        sub_result,
+        slice_id=params['slice_id'],
+        store=store,
+        proximity_radius_um=options['proximity_radius_um']
+    )
+
+def finish_slice(params: Dict, outcome: Dict, store: ResultStore, options: Optional[Dict] = None,
+                 cohort: Optional[CohortAggregator] = None) -> None:
+    # main process: fill the cache with a fresh result, queue the result tables, update the cohort stats,
+    # write the density maps
+    options = _with_defaults(options)
+    with traced_memory(options['trace_memory']):
+        log = StageLog()
+        if options['cache_dir'] and not outcome['cached']:
+            with log.stage('cache_store'):
+                store_cached(options['cache_dir'], outcome['cache_key'],
+                             (outcome['mask_result'], outcome['sub_result']), options['cache_max_bytes'])
+        with log.stage('tables'):
+            tables = save_slice(params, outcome['mask_result'], outcome['sub_result'], store, options)
+        if cohort is not None:
+            with log.stage('cohort'):
+                cohort.add_slice(tables)
+        if options['density_dir']:
+            with log.stage('density') as counts:
+                maps = density_maps(outcome['mask_result'], outcome['sub_result']['midline'],
+                                    sigma=options['density_sigma'])
+                save_density_maps(map_path(options['density_dir'], params['mouse_id'], params['slice_id']),
+                                  maps, params)
+                counts.update({f'{obj_type}_outside': n for obj_type, n in maps['n_outside'].items()})
+    outcome['stages'] = outcome['stages'] + log.stages
+    outcome['seconds'] += log.seconds()
+
+def process_slice(params: Dict, store: ResultStore, options: Optional[Dict] = None,
+                  cohort: Optional[CohortAggregator] = None) -> Dict:
+    """analyze_mask_sub -> analyze_mask -> save_results for one parsed row, return the outcome"""
+    outcome = analyze_slice(params, options)
+    finish_slice(params, outcome, store, options, cohort)
+    return outcome
+
+def _status(idx: int, mouse_id: str, error: Exception = None, outcome: Dict = None,
+            params: Optional[Dict] = None, resumed: bool = False) -> Dict:
+    status = {
+        'row': idx,
+        'mouse_id': mouse_id,
+        'slice_id': params['slice_id'] if params else None,
+        'status': 'ok' if error is None else 'failed',
+        'error': '' if error is None else f"{type(error).__name__}: {error}",
+        'peak_mb': outcome['peak_bytes'] / 2**20 if outcome and outcome['peak_bytes'] is not None else None,
+        'peak_rss_mb': outcome['peak_rss_bytes'] / 2**20 if outcome and outcome.get('peak_rss_bytes') is not None
+        else None,
+        'cached': outcome['cached'] if outcome else False,
+        'seconds': outcome['seconds'] if outcome else None,
+        'stages': outcome['stages'] if outcome else [],
+        'resumed': resumed   # done in an earlier run, see checkpoint.py
+    }
+    return status
+
+class SliceCommits:
+    """
+    commits finished slices of a run: flush the store (all tables at once),
+    save the cohort stats, then mark the slices done in the checkpoint file;
+    after every `every` finished slices and at the end of the run (commit())
+    a crash loses at most the uncommitted slices, which a resumed run redoes
+    used by run_manifest and by the watch-folder service (watch.py)
+    """
+
+    def __init__(self, store: ResultStore, every: int, cohort: Optional[CohortAggregator] = None,
+                 cohort_path: Optional[str] = None, checkpoint_path: Optional[str] = None,
+                 done: Optional[Dict[str, Dict]] = None, manifest_path: str = ''):
+        self.store = store
+        self.every = max(int(every), 1)
+        self.cohort = cohort
+        self.cohort_path = cohort_path
+        self.checkpoint_path = checkpoint_path
+        self.done = dict(done or {})
+        self.manifest_path = manifest_path
+        self.pending: Dict[str, Dict] = {}
+        self.seconds = 0.0
+
+    def slice_done(self, fingerprint: str, status: Dict) -> None:
+        self.pending[fingerprint] = {k: status[k] for k in ('row', 'mouse_id', 'slice_id')}
+        if len(self.pending) >= self.every:
+            self.commit()
+
+    def commit(self) -> None:
+        start = time.perf_counter()
+        self.store.flush()
+        if self.cohort is not None:
+            self.cohort.save(self.cohort_path)
+        # only marked done once its rows are on disk
+        self.done.update(self.pending)
+        self.pending = {}
+        if self.checkpoint_path:
+            save_checkpoint(self.checkpoint_path, self.done, self.manifest_path)
+        self.seconds += time.perf_counter() - start
+
+def run_manifest(manifest_path: str, workers: int = 1, store: Optional[ResultStore] = None,
+                 options: Optional[Dict] = None, log: Optional[IO] = None,
+                 report_path: Optional[str] = None, cohort_path: Optional[str] = None,
+                 checkpoint_path: Optional[str] = None, resume: bool = False) -> List[Dict]:
+    """
+    process every slice in the manifest, keep going past bad rows
+    with workers > 1 the slices are analyzed in a process pool, but results
+    are still written by this process in manifest order, so the CSVs are
+    identical for any number of workers
+    slices whose inputs and parameters are unchanged are loaded from the
+    result cache (options['cache_dir'], see DEFAULT_OPTIONS)
+    the result tables are written to store (CSV in the current folder by
+    default) every options['checkpoint_every'] slices and at the end of the
+    run, each flush commits all tables of its slices at once
+    checkpoint_path records the committed slices; with resume, slices already
+    in it (same manifest row, options and input files) are not run again
+    log (a stream, see run_log.open_log) gets one JSON line per slice as it
+    finishes and one for the whole run (run_log.run_report + write time);
+    report_path also saves that run report as a JSON file
+    cohort_path: running cohort statistics (cohort.CohortAggregator), updated
+    with every saved slice and written together with the tables
+    return one status dict per row: {'row', 'mouse_id', 'slice_id', 'status', 'error', 'peak_mb', 'peak_rss_mb',
+                                     'cached', 'seconds', 'stages', 'resumed'}
+    """
+    options = _with_defaults(options)
+    rows = load_manifest(manifest_path)
+    if store is None:
+        store = open_store('csv')
+    start = time.perf_counter()
+    write_event(log, {'event': 'start', 'manifest': manifest_path, 'workers': workers, 'n_rows': len(rows),
+                      'options': {k: v for k, v in options.items() if k != 'verbose'}})
+
+    # validate everything up front, bad rows never reach a worker
+    parsed = []
+    for idx, row in enumerate(rows, start=1):
+        mouse_id = str(row.get('mouse_id', '')).strip()
+        try:
+            parsed.append((idx, mouse_id, parse_row(row), None))
+        except Exception as e:
+            print(f"Row {idx} (mouse {mouse_id}) skipped: {type(e).__name__}: {e}")
+            parsed.append((idx, mouse_id, None, e))
+
+    fingerprints = {}
+    for idx, _, params, error in parsed:
+        if error is None:
+            fingerprints[idx] = slice_fingerprint(
+                params, [params[col] for col in PATH_COLUMNS], {k: options[k] for k in RESUME_OPTION_KEYS})
+    done = load_checkpoint(checkpoint_path) if checkpoint_path and resume else {}
+    if done:
+        n_done = sum(fp in done for fp in fingerprints.values())
+        print(f"Resuming: {n_done}/{len(rows)} slices already done")
+
+    cohort = load_cohort(cohort_path) if cohort_path else None
+    commits = SliceCommits(store, options['checkpoint_every'], cohort, cohort_path, checkpoint_path, done,
+                           manifest_path)
+    statuses = []
+    try:
+        _run_parsed(parsed, len(rows), workers, store, options, statuses, log, cohort, commits, fingerprints)
+    finally:
+        # whatever finished is written, also when the run is interrupted
+        commits.commit()
+        report = {**run_report(statuses), 'write_seconds': commits.seconds,
+                  'wall_seconds': time.perf_counter() - start, 'workers': workers}
+        write_event(log, {'event': 'run', **report})
+        if report_path:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+    return statuses
+
+def _finished(statuses: List[Dict], status: Dict, n_rows: int, log: Optional[IO],
+              commits: SliceCommits, fingerprint: Optional[str]) -> None:
+    statuses.append(status)
+    write_event(log, {'event': 'slice', **status})
+    if status['status'] == 'ok' and not status['resumed']:
+        print(f"Slice {status['row']}/{n_rows} (mouse {status['mouse_id']}) done in {status['seconds']:.1f} s"
+              + (" (cached)" if status['cached'] else ""))
+        commits.slice_done(fingerprint, status)
+
+def _run_parsed(parsed: List[Tuple], n_rows: int, workers: int, store: ResultStore,
+                options: Dict, statuses: List[Dict], log: Optional[IO],
+                cohort: Optional[CohortAggregator], commits: SliceCommits, fingerprints: Dict[int, str]) -> None:
+    # statuses is filled in place, so an interrupted run still reports the finished slices
+    # slices committed by an earlier run (resume) are only reported
+    resumed = {idx for idx, fp in fingerprints.items() if fp in commits.done}
+    if workers <= 1:
+        for idx, mouse_id, params, error in parsed:
+            outcome = None
+            if idx in resumed:
+                _finished(statuses, _status(idx, mouse_id, params=params, resumed=True), n_rows, log, commits, None)
+                continue
+            if error is None:
+                if options['verbose']:
+                    print(f"\n##### Slice {idx}/{n_rows} (mouse {mouse_id}) #####")
+                try:
+                    outcome = process_slice(params, store, options, cohort)
+                except Exception as e:
+                    traceback.print_exc()
+                    error = e
+            _finished(statuses, _status(idx, mouse_id, error, outcome, params), n_rows, log,
+                      commits, fingerprints.get(idx))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(analyze_slice, params, options) if error is None and idx not in resumed else None
+                   for idx, _, params, error in parsed]
+        # single writer: wait for the slices in manifest order
+        for (idx, mouse_id, params, error), future in zip(parsed, futures):
+            outcome = None
+            if idx in resumed:
+                _finished(statuses, _status(idx, mouse_id, params=params, resumed=True), n_rows, log, commits, None)
+                continue
+            if future is not None:
+                try:
+                    outcome = future.result()
+                    finish_slice(params, outcome, store, options, cohort)
+                except Exception as e:
+                    traceback.print_exc()
+                    error = e
+            _finished(statuses, _status(idx, mouse_id, error, outcome, params), n_rows, log,
+                      commits, fingerprints.get(idx))
+
+def print_status_summary(statuses: List[Dict]) -> None:
+    print("\n=== Batch Summary ===")
+    for s in statuses:
+        line = f"Row {s['row']:>4}  mouse {s['mouse_id']:<12} {s['status'].upper():<6}"
+        if s['seconds'] is not None:
+            line += f"  {s['seconds']:.1f} s"
+        if s['peak_mb'] is not None:
+            line += f"  peak {s['peak_mb']:.1f} MB"
+        elif s.get('peak_rss_mb') is not None:
+            line += f"  rss {s['peak_rss_mb']:.0f} MB"
+        if s['cached']:
+            line += "  (cached)"
+        if s.get('resumed'):
+            line += "  (done in an earlier run)"
+        if s['error']:
+            line += f"  ({s['error']})"
+        print(line)
+    n_ok = sum(s['status'] == 'ok' for s in statuses)
+    print(f"{n_ok}/{len(statuses)} slices processed, {len(statuses) - n_ok} failed")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the morphometric pipeline on a manifest of slices.")
+    parser.add_argument('manifest', help="CSV or YAML manifest, one row per slice")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of worker processes (default: 1, no pool)")
+    parser.add_argument('--format', choices=sorted(STORE_FORMATS), default='csv',
+                        help="result backend (default: csv, same files as the interactive mode)")
+    parser.add_argument('--output-dir', default='.', help="folder for the result tables (default: current)")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f"per-slice result cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size-mb', type=float, default=DEFAULT_MAX_BYTES / 2**20,
+                        help="cache size cap, least recently used entries are evicted")
+    parser.add_argument('--no-cache', action='store_true', help="always recompute every slice")
+    parser.add_argument('--clear-cache', action='store_true', help="empty the cache before running")
+    parser.add_argument('--tile-rows', type=int, default=DEFAULT_TILE_SHAPE[0],
+                        help=f"rows of the image tiles streamed at a time (default: {DEFAULT_TILE_SHAPE[0]})")
+    parser.add_argument('--tile-cols', type=int, default=DEFAULT_TILE_SHAPE[1],
+                        help="columns of the image tiles (default: full width)")
+    parser.add_argument('--roi', choices=['none', 'pixels', 'centroid'], default='none',
+                        help="restrict statistics to the subiculum: clip objects to the mask (pixels) "
+                             "or keep whole objects with their centroid inside (centroid)")
+    parser.add_argument('--profile-bins', type=int, default=DEFAULT_PROFILE_BINS,
+                        help="number of proximal-distal bins in profile_data, 0 = no profile "
+                             f"(default: {DEFAULT_PROFILE_BINS})")
+    parser.add_argument('--profile-axis', choices=PROFILE_AXES, default=DEFAULT_PROFILE_AXIS,
+                        help="bin along the curved centreline of the mask (skeleton) or along the "
+                             f"straight line between the ends (line) (default: {DEFAULT_PROFILE_AXIS})")
+    parser.add_argument('--proximity-radius', type=float, default=DEFAULT_PROXIMITY_RADIUS_UM,
+                        help="count cells within this many um of each plaque "
+                             f"(default: {DEFAULT_PROXIMITY_RADIUS_UM:g})")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print the overall and left / right stats of every slice")
+    parser.add_argument('--log-file', default=None,
+                        help=f"append JSON log lines (per-stage time, memory, counts) to this file, "
+                             f"'-' = stderr (default: {DEFAULT_LOG_NAME} in the output folder)")
+    parser.add_argument('--no-log', action='store_true', help="no JSON log")
+    parser.add_argument('--report', default=None, help="also write the aggregated run report as JSON")
+    parser.add_argument('--cohort-state', default=None,
+                        help=f"running cohort statistics, see cohort.py "
+                             f"(default: {DEFAULT_STATE_NAME} in the output folder)")
+    parser.add_argument('--no-cohort', action='store_true', help="don't update the cohort statistics")
+    parser.add_argument('--density-dir', default=None,
+                        help=f"per-slice cell / plaque density maps (.npz), see density_map.py "
+                             f"(default: {DEFAULT_DENSITY_DIR} in the output folder)")
+    parser.add_argument('--density-sigma', type=float, default=DEFAULT_DENSITY_SIGMA,
+                        help=f"smoothing of the density maps, in midline lengths (default: {DEFAULT_DENSITY_SIGMA:g})")
+    parser.add_argument('--no-density-maps', action='store_true', help="don't write density maps")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the slices an earlier (interrupted) run of this manifest already committed")
+    parser.add_argument('--checkpoint-every', type=int, default=DEFAULT_OPTIONS['checkpoint_every'],
+                        help="write the result tables after this many slices (default: every slice)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="log the peak memory of every stage with tracemalloc (slows the analysis down)")
+    parser.add_argument('--checkpoint', default=None,
+                        help=f"checkpoint file (default: {DEFAULT_CHECKPOINT_NAME} in the output folder)")
+    args = parser.parse_args(argv)
+
+    options = {
+        'cache_dir': None if args.no_cache else args.cache_dir,
+        'cache_max_bytes': int(args.cache_size_mb * 2**20),
+        'tile_shape': (args.tile_rows, args.tile_cols),
+        'roi_mode': None if args.roi == 'none' else args.roi,
+        'proximity_radius_um': args.proximity_radius,
+        'profile_bins': args.profile_bins,
+        'profile_axis': args.profile_axis,
+        'verbose': args.verbose,
+        'density_dir': None if args.no_density_maps else
+        args.density_dir or os.path.join(args.output_dir, DEFAULT_DENSITY_DIR),
+        'density_sigma': args.density_sigma,
+        'checkpoint_every': args.checkpoint_every,
+        'trace_memory': args.trace_memory
+    }
+    if options['cache_dir'] and args.clear_cache:
+        print(f"Removed {clear_cache(options['cache_dir'])} cache entries")
+
+    log_path = None
+    if not args.no_log:
+        log_path = args.log_file or os.path.join(args.output_dir, DEFAULT_LOG_NAME)
+        if log_path != '-':
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    log = open_log(log_path)
+    try:
+        statuses = run_manifest(args.manifest, workers=args.workers,
+                                store=open_store(args.format, args.output_dir), options=options,
+                                log=log, report_path=args.report,
+                                cohort_path=None if args.no_cohort else
+                                args.cohort_state or os.path.join(args.output_dir, DEFAULT_STATE_NAME),
+                                checkpoint_path=args.checkpoint or os.path.join(args.output_dir,
+                                                                                DEFAULT_CHECKPOINT_NAME),
+                                resume=args.resume)
+    finally:
+        if log is not None and log is not sys.stderr:
+            log.close()
+    print_status_summary(statuses)
+    return 0 if all(s['status'] == 'ok' for s in statuses) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
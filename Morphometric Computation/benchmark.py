@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import numpy as np
+from PIL import Image
+from typing import Callable, Dict, List, Optional, Tuple
+from image_io import load_label_masks, masks_cache_path, DEFAULT_TILE_SHAPE
+from label_stats import compute_label_stats
+from analyze_SUB import analyze_mask_sub, SUB_MASK_VALUE
+from cal_area import analyze_mask, overlap_by_side
+from save_results import save_results
+from result_store import open_store
+
+# one benchmark case = one synthetic slice
+DEFAULT_CASE = {
+    'height': 2048,
+    'width': 3072,
+    'n_cells': 2000,
+    'cell_radius': 8,
+    'n_plaques': 200,
+    'plaque_radius': 20,
+    'seed': 0
+}
+PIXEL_TO_MICROMETER = 0.17
+
+# ---------------- synthetic inputs ----------------
+
+def make_label_image(shape: Tuple[int, int], n_objects: int, radius: float,
+                     rng: np.random.Generator) -> np.ndarray:
+    """
+    Cellpose-style label image: n_objects disks (radius +-30%) at random
+    positions, labelled 1..n_objects, later disks cover earlier ones
+    """
+    n_rows, n_cols = shape
+    dtype = np.uint16 if n_objects < 2**16 else np.uint32
+    labels = np.zeros(shape, dtype=dtype)
+    centers_y = rng.integers(0, n_rows, n_objects)
+    centers_x = rng.integers(0, n_cols, n_objects)
+    radii = radius * rng.uniform(0.7, 1.3, n_objects)
+    for label, (cy, cx, r) in enumerate(zip(centers_y, centers_x, radii), start=1):
+        # only draw inside the bounding box of the disk
+        r0, r1 = max(int(cy - r), 0), min(int(cy + r) + 1, n_rows)
+        c0, c1 = max(int(cx - r), 0), min(int(cx + r) + 1, n_cols)
+        yy, xx = np.ogrid[r0:r1, c0:c1]
+        disk = (yy - cy) ** 2 + (xx - cx) ** 2 <= r * r
+        labels[r0:r1, c0:c1][disk] = label
+    return labels
+
+def make_sub_mask(shape: Tuple[int, int]) -> np.ndarray:
+    # ellipse in the middle of the image, SUB_MASK_VALUE inside
+    n_rows, n_cols = shape
+    yy, xx = np.ogrid[:n_rows, :n_cols]
+    inside = ((yy - n_rows / 2) / (0.35 * n_rows)) ** 2 + ((xx - n_cols / 2) / (0.42 * n_cols)) ** 2 < 1
+    return np.where(inside, SUB_MASK_VALUE, 0).astype(np.uint8)
+
+def write_synthetic_slice(out_dir: str, case: Dict) -> Dict:
+    """
+    write cell_seg.npy, ab_seg.npy (pickled dicts like Cellpose) and sub.tif
+    for one case, return the parameters analyze_mask_sub / analyze_mask need
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(case['seed'])
+    shape = (case['height'], case['width'])
+    paths = {
+        'cell_npy_path': os.path.join(out_dir, 'cell_seg.npy'),
+        'ab_npy_path': os.path.join(out_dir, 'ab_seg.npy'),
+        'sub_path': os.path.join(out_dir, 'sub.tif')
+    }
+    for key, n, radius in (('cell_npy_path', case['n_cells'], case['cell_radius']),
+                           ('ab_npy_path', case['n_plaques'], case['plaque_radius'])):
+        masks = make_label_image(shape, n, radius, rng)
+        np.save(paths[key], {'masks': masks, 'outlines': np.zeros_like(masks)}, allow_pickle=True)
+    Image.fromarray(make_sub_mask(shape)).save(paths['sub_path'])
+
+    # subiculum ends on the left / right tip of the ellipse, in pixel
+    n_rows, n_cols = shape
+    return {
+        **paths,
+        'pixel_to_micrometer': PIXEL_TO_MICROMETER,
+        'physical_width': n_cols * PIXEL_TO_MICROMETER,
+        'physical_height': n_rows * PIXEL_TO_MICROMETER,
+        'left_sub_end': (0.1 * n_cols, 0.5 * n_rows),
+        'right_sub_end': (0.9 * n_cols, 0.5 * n_rows),
+        'age': '6 months'
+    }
+
+# ---------------- timing ----------------
+
+def _measure(func: Callable, repeat: int, setup: Optional[Callable] = None) -> Dict:
+    """
+    run func repeat times for the timing, then once more under tracemalloc
+    for the peak memory (tracemalloc slows allocations, so it is kept out of
+    the timed runs)
+    """
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'min_s': min(seconds),
+        'median_s': statistics.median(seconds),
+        'runs_s': seconds,
+        'peak_mb': peak_bytes / 2**20
+    }
+
+def run_case(case: Dict, work_dir: str, repeat: int = 3, tile_shape=DEFAULT_TILE_SHAPE) -> Dict:
+    """
+    time every stage of one synthetic slice
+      load          - unpickle both Cellpose files and write the masks cache (cold)
+      sub           - analyze_mask_sub
+      label_stats   - per-label area & centroid of cells and plaques
+      overlap_split - cell & ab overlap split into left / right
+      analyze_mask  - the whole of analyze_mask (warm masks cache)
+      csv_write     - save_results into an empty CSV store
+    """
+    params = write_synthetic_slice(work_dir, case)
+    mask_paths = [params['cell_npy_path'], params['ab_npy_path']]
+    masks_cache_dir = os.path.join(work_dir, 'masks_cache')
+
+    def drop_masks_cache():
+        for path in mask_paths:
+            cache_path = masks_cache_path(path, masks_cache_dir)
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+    def load():
+        return [load_label_masks(path, masks_cache_dir) for path in mask_paths]
+
+    stages = {'load': _measure(load, repeat, setup=drop_masks_cache)}
+    cell_masks, ab_masks = load()
+
+    sub_result = analyze_mask_sub(params['sub_path'], params['pixel_to_micrometer'],
+                                  params['left_sub_end'], params['right_sub_end'], tile_shape=tile_shape)
+    stages['sub'] = _measure(
+        lambda: analyze_mask_sub(params['sub_path'], params['pixel_to_micrometer'],
+                                 params['left_sub_end'], params['right_sub_end'], tile_shape=tile_shape),
+        repeat)
+
+    midpoint = sub_result["midline"]["midpoint_um"]
+    vec = sub_result["dividing_line"]["direction_vector"]
+    stages['label_stats'] = _measure(
+        lambda: (compute_label_stats(cell_masks, tile_shape=tile_shape),
+                 compute_label_stats(ab_masks, tile_shape=tile_shape)),
+        repeat)
+    stages['overlap_split'] = _measure(
+        lambda: overlap_by_side(cell_masks, ab_masks, params['pixel_to_micrometer'], midpoint, vec, tile_shape),
+        repeat)
+
+    def run_analyze_mask():
+        return analyze_mask(params['cell_npy_path'], params['ab_npy_path'], params['pixel_to_micrometer'],
+                            params['age'], midpoint, vec, tile_shape=tile_shape, verbose=False,
+                            masks_cache_dir=masks_cache_dir)
+
+    stages['analyze_mask'] = _measure(run_analyze_mask, repeat)
+    mask_result = run_analyze_mask()
+
+    out_dir = os.path.join(work_dir, 'results')
+
+    def drop_results():
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    def write_csv():
+        store = open_store('csv', out_dir)
+        save_results('bench', 'Female', '5XFAD', params['age'], params['pixel_to_micrometer'],
+                     params['physical_width'], params['physical_height'], mask_result, sub_result,
+                     slice_id='bench', store=store)
+        store.flush()
+
+    stages['csv_write'] = _measure(write_csv, repeat, setup=drop_results)
+
+    return {
+        'case': case,
+        'n_pixels': case['height'] * case['width'],
+        'n_cells_found': mask_result['total']['cell_count'],
+        'n_plaques_found': mask_result['total']['plaques'],
+        'stages': stages
+    }
+
+# ---------------- report ----------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(cases: List[Dict], repeat: int = 3, tile_shape=DEFAULT_TILE_SHAPE,
+                  work_dir: Optional[str] = None) -> Dict:
+    """
+    run every case, synthetic inputs go to a temp folder (or work_dir, kept)
+
+    return data structure (written as JSON by main)
+    {
+        "commit": ..., "timestamp": ..., "python": ..., "numpy": ..., "platform": ...,
+        "repeat": ..., "tile_shape": [rows, cols],
+        "results": [
+            {"case": {...}, "n_pixels": ..., "n_cells_found": ..., "n_plaques_found": ...,
+             "stages": {"load": {"min_s", "median_s", "runs_s", "peak_mb"}, ...}},
+            ...
+        ]
+    }
+    """
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'tile_shape': list(tile_shape),
+        'results': []
+    }
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = work_dir = tempfile.mkdtemp(prefix='morpho_bench_')
+    try:
+        for i, case in enumerate(cases):
+            result = run_case(case, os.path.join(work_dir, f"case_{i}"), repeat, tile_shape)
+            report['results'].append(result)
+            print_case(result)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return report
+
+def print_case(result: Dict) -> None:
+    case = result['case']
+    print(f"\n{case['height']} x {case['width']} px, {case['n_cells']} cells (r={case['cell_radius']}), "
+          f"{case['n_plaques']} plaques (r={case['plaque_radius']})")
+    for name, stage in result['stages'].items():
+        print(f"  {name:<14} {stage['median_s'] * 1000:10.1f} ms   peak {stage['peak_mb']:8.1f} MB")
+
+def _parse_size(value: str) -> Tuple[int, int]:
+    # "2048x3072" -> (2048, 3072), rows x cols
+    rows, cols = value.lower().split('x')
+    return int(rows), int(cols)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Time analyze_mask_sub / analyze_mask / save_results on synthetic slices")
+    parser.add_argument('--size', type=_parse_size, action='append',
+                        help="image size as ROWSxCOLS, repeat for several sizes "
+                             f"(default: {DEFAULT_CASE['height']}x{DEFAULT_CASE['width']})")
+    parser.add_argument('--cells', type=int, action='append', help="number of cells, repeat for several counts")
+    parser.add_argument('--plaques', type=int, default=DEFAULT_CASE['n_plaques'])
+    parser.add_argument('--cell-radius', type=float, default=DEFAULT_CASE['cell_radius'])
+    parser.add_argument('--plaque-radius', type=float, default=DEFAULT_CASE['plaque_radius'])
+    parser.add_argument('--seed', type=int, default=DEFAULT_CASE['seed'])
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage (default: 3)")
+    parser.add_argument('--tile-rows', type=int, default=DEFAULT_TILE_SHAPE[0])
+    parser.add_argument('--tile-cols', type=int, default=DEFAULT_TILE_SHAPE[1])
+    parser.add_argument('--work-dir', default=None, help="keep the synthetic inputs in this folder")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON report (default: benchmark.json)")
+    args = parser.parse_args(argv)
+
+    cases = []
+    for height, width in args.size or [(DEFAULT_CASE['height'], DEFAULT_CASE['width'])]:
+        for n_cells in args.cells or [DEFAULT_CASE['n_cells']]:
+            cases.append({
+                'height': height, 'width': width,
+                'n_cells': n_cells, 'cell_radius': args.cell_radius,
+                'n_plaques': args.plaques, 'plaque_radius': args.plaque_radius,
+                'seed': args.seed
+            })
+
+    report = run_benchmark(cases, args.repeat, (args.tile_rows, args.tile_cols), args.work_dir)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark report written to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,18 @@ import numpy as np
 import os
 import pandas as pd
 from PIL import Image
+from label_stats import compute_label_stats, new_label_accumulator, accumulate_label_stats, \
+    finish_label_stats, region_border_labels, new_pair_accumulator, accumulate_label_pairs, \
+    finish_label_pairs, pair_totals
+from image_io import load_label_masks, open_tiff, iter_tiles, DEFAULT_TILE_SHAPE
+from analyze_SUB import SUB_MASK_VALUE
+from side_split import is_left, count_mask_by_side
+from band_profile import bin_positions, bin_mask, position_of_points
+from run_log import stage
+from object_table import OBJECT_TYPES, SIDES, new_object_table, number_by_side, sequential_sum
+
+# restrict the analysis to the subiculum, see analyze_mask
+ROI_MODES = (None, 'pixels', 'centroid')
 
 def calculate_overlap_area(ab_masks, cell_masks, pixel_to_micrometer):
     # Find the overlap region
@@ -15,150 +27,287 @@ def calculate_overlap_area(ab_masks, cell_masks, pixel_to_micrometer):
     
     return overlap_area_um2
 
-# parameters should be in um
-def is_left(x, y, midpoint, perpendicular_vector):
-        # vector of (x,y) relative to midpoint
-        vec_x = x - midpoint[0]
-        vec_y = y - midpoint[1]
-        # cal cross product, decide direction
-        cross = vec_x * perpendicular_vector[1] - vec_y * perpendicular_vector[0]
-        # if cross > 0, point vector is on the left of perpendicular vector (counterclockwise from perp to point)
-        # Q? using cross < 0 produces the correct Left Or Right? Why?
-        return cross < 0
+def overlap_by_side(cell_masks, ab_masks, pixel_to_micrometer, sub_midpoint, perpendicular_vector,
+                    tile_shape=DEFAULT_TILE_SHAPE, region=None, sub_mask=None, pairs=None,
+                    axis=None, bin_pixels=None):
+    # pixel count of the ab & cell overlap as np.array([left, right]), split tile by tile,
+    # so no full-size overlap mask is ever allocated
+    # pairs: optional label pair accumulator, gets the (cell label, ab label) of every overlap pixel
+    # axis, bin_pixels: optional profile axis, overlap pixels per bin are added to bin_pixels in place
+    overlap_pixels = np.zeros(2, dtype=np.int64)
+    for r0, r1, c0, c1 in iter_tiles(cell_masks.shape, tile_shape, region):
+        cell_tile = np.asarray(cell_masks[r0:r1, c0:c1])
+        ab_tile = np.asarray(ab_masks[r0:r1, c0:c1])
+        overlap_tile = (ab_tile != 0) & (cell_tile != 0)
+        if sub_mask is not None:
+            overlap_tile &= np.asarray(sub_mask[r0:r1, c0:c1]) == SUB_MASK_VALUE
+        overlap_pixels += count_mask_by_side(
+            overlap_tile, pixel_to_micrometer, sub_midpoint, perpendicular_vector, row_offset=r0, col_offset=c0)
+        if pairs is not None:
+            accumulate_label_pairs(pairs, cell_tile[overlap_tile], ab_tile[overlap_tile])
+        if axis is not None:
+            bin_pixels += bin_mask(axis, overlap_tile, pixel_to_micrometer, row_offset=r0, col_offset=c0)
+    return overlap_pixels
+
+# one object table row per label in stats: side, centroid, position and overlap, see object_table
+def _object_rows(stats, obj_type, pixel_to_micrometer, sub_midpoint, perpendicular_vector,
+                 pair_labels, pair_pixels, profile_axis=None, add_overlap_to_area=False):
+    rows = new_object_table(len(stats['labels']))
+    rows['label'] = stats['labels']
+    rows['type'] = OBJECT_TYPES.index(obj_type)
+    rows['area_um2'] = stats['area_pixels'] * (pixel_to_micrometer**2)
+    rows['x_um'] = stats['centroid_x'] * pixel_to_micrometer
+    rows['y_um'] = stats['centroid_y'] * pixel_to_micrometer
+
+    # determine side for every label at once
+    left = is_left(rows['x_um'], rows['y_um'], sub_midpoint, perpendicular_vector)
+    rows['side'] = np.where(left, SIDES.index('LEFT'), SIDES.index('RIGHT'))
+    number_by_side(rows)
+    # proximal-distal position (0 = left end, 1 = right end) along the profile axis
+    rows['pd_position'] = position_of_points(profile_axis, rows['x_um'], rows['y_um']) \
+        if profile_axis is not None else np.nan
+
+    # overlap with the other object type; for 6 weeks the overlap was excluded
+    # from the ab areas, add it back so the fraction is of the whole plaque
+    overlap_pixels, partners = pair_totals(stats['labels'], pair_labels, pair_pixels)
+    area_pixels = stats['area_pixels'] + overlap_pixels if add_overlap_to_area else stats['area_pixels']
+    rows['object_area_um2'] = area_pixels * (pixel_to_micrometer**2)
+    rows['overlap_area_um2'] = overlap_pixels * (pixel_to_micrometer**2)
+    rows['overlap_fraction'] = overlap_pixels / np.maximum(area_pixels, 1)
+    rows['n_partners'] = partners
+
+    # shape descriptors (label_stats, shape=True)
+    rows['perimeter_um'] = stats['perimeter_pixels'] * pixel_to_micrometer
+    rows['major_axis_um'] = stats['major_axis_pixels'] * pixel_to_micrometer
+    rows['minor_axis_um'] = stats['minor_axis_pixels'] * pixel_to_micrometer
+    rows['eccentricity'] = stats['eccentricity']
+    rows['orientation_deg'] = stats['orientation_deg']
+    rows['extent'] = stats['extent']
+    rows['compactness'] = 4 * np.pi * stats['area_pixels'] / np.maximum(stats['perimeter_pixels'], 1) ** 2
+    return rows
+
+def _side_totals(rows, side):
+    # count & total area of one side
+    on_side = rows['side'] == SIDES.index(side)
+    return {'count': int(on_side.sum()), 'area': sequential_sum(rows['area_um2'][on_side])}
+
+# how far the window grows per step when whole objects cross it (pixel)
+ROI_GROW_STEP = 256
+
+def _centroid_roi_stats(label_image, exclude, region, sub_crop, tile_shape):
+    # whole-object stats of the labels in region whose centroid pixel is inside sub_crop
+    acc = new_label_accumulator(shape=True)
+    accumulate_label_stats(acc, label_image, exclude, tile_shape=tile_shape, region=region)
+    in_region = acc['counts'] > 0
+
+    # objects crossing the window are incomplete: grow the window on those sides,
+    # adding only the new strips, until no object of the region touches its border
+    n_rows, n_cols = label_image.shape
+    window = list(region)
+    while True:
+        border = region_border_labels(label_image, tuple(window), exclude)
+        grow_sides = [side for side, labels in border.items()
+                      if in_region[labels[labels < in_region.size]].any()]
+        if not grow_sides:
+            break
+        strips = []
+        if 'top' in grow_sides:
+            strips.append((max(window[0] - ROI_GROW_STEP, 0), window[0], window[2], window[3]))
+            window[0] = strips[-1][0]
+        if 'bottom' in grow_sides:
+            strips.append((window[1], min(window[1] + ROI_GROW_STEP, n_rows), window[2], window[3]))
+            window[1] = strips[-1][1]
+        # left / right strips span the grown rows, so the corners are added once
+        if 'left' in grow_sides:
+            strips.append((window[0], window[1], max(window[2] - ROI_GROW_STEP, 0), window[2]))
+            window[2] = strips[-1][2]
+        if 'right' in grow_sides:
+            strips.append((window[0], window[1], window[3], min(window[3] + ROI_GROW_STEP, n_cols)))
+            window[3] = strips[-1][3]
+        for strip in strips:
+            accumulate_label_stats(acc, label_image, exclude, tile_shape=tile_shape, region=strip)
+
+    stats = finish_label_stats(acc)
+
+    # keep objects of the region whose centroid pixel is inside the subiculum
+    cy = np.rint(stats['centroid_y']).astype(np.int64) - region[0]
+    cx = np.rint(stats['centroid_x']).astype(np.int64) - region[2]
+    keep = (cy >= 0) & (cy < sub_crop.shape[0]) & (cx >= 0) & (cx < sub_crop.shape[1])
+    keep[keep] = sub_crop[cy[keep], cx[keep]]
+    # labels above the largest one in region only come from the grown strips
+    keep &= stats['labels'] < in_region.size
+    keep[keep] = in_region[stats['labels'][keep]]
+    return {key: value[keep] for key, value in stats.items()}
 
 # Function to analyze the mask
-def analyze_mask(cell_npy_path, ab_npy_path, pixel_to_micrometer, age, sub_midpoint, perpendicular_vector):
- # Load cell and ab masks
-    cell_data = np.load(cell_npy_path, allow_pickle=True).item()
-    ab_data = np.load(ab_npy_path, allow_pickle=True).item()
+def analyze_mask(cell_npy_path, ab_npy_path, pixel_to_micrometer, age, sub_midpoint, perpendicular_vector,
+                 tile_shape=DEFAULT_TILE_SHAPE, sub_path=None, bounding_box=None, roi_mode=None,
+                 profile_axis=None, stage_log=None, verbose=True, masks_cache_dir=None):
+    """
+    roi_mode restricts everything to the subiculum (sub_path: mask .tif,
+    bounding_box: sub_result["geometry"]["bounding_box"]); only the bounding
+    box of all inputs is read
+      None       - whole image, every object counted (original behaviour)
+      'pixels'   - only pixels inside the subiculum mask count, objects are
+                   clipped to the mask (areas match the normalizing sub area)
+      'centroid' - whole objects whose centroid pixel is inside the mask
+    intracellular ab (overlap) is restricted to the mask in both ROI modes
+
+    return data structure
+    {
+        "objects": ...,   # structured array, one row per cell / plaque (object_table.OBJECT_DTYPE):
+                          # label, type, side, id, area, centroid, position, overlap
+        "left": {"cell_count", "cell_area", "plaques", "plaque_area", "intra_plaque"},
+        "right": {...}, "total": {...},
+        "profile": ...    # see below, None without profile_axis
+    }
+    object_table.legacy_view adds the per-object lists of the old format
+
+    the per-object overlap (intracellular ab of a cell, part of a plaque inside
+    cells, number of overlapping objects) comes from a sparse
+    (cell label, ab label) pixel count table of the overlap
+
+    the shape of every object (perimeter, major / minor axis, eccentricity,
+    orientation, extent, compactness) is accumulated in the same label pass
+    as area and centroid (label_stats, shape=True); in the 'pixels' ROI mode
+    it describes the part of the object inside the subiculum
+
+    profile_axis (band_profile.profile_axis of the slice) fills the proximal-distal
+    position of every centroid ('pd_position' in objects) and 'profile', the bins
+    of every cell / plaque centroid and overlap pixel
+    {
+        "n_bins": ...,
+        "cell_count": [...], "cell_area_um2": [...],
+        "plaque_count": [...], "plaque_area_um2": [...],
+        "intra_plaque_area_um2": [...]
+    }
 
-    # Extract masks
-    cell_masks = np.array(cell_data['masks'])
-    ab_masks = np.array(ab_data['masks'])
+    stage_log (run_log.StageLog) records time / memory / counts of the load,
+    overlap, label_stats and split stages; verbose prints the overall and
+    left / right stats
+    masks_cache_dir: folder for the raw masks of the Cellpose files (see
+    image_io.load_label_masks), None = unpickle them every time
+    """
+    if roi_mode not in ROI_MODES:
+        raise ValueError(f"Unknown roi_mode {roi_mode!r}, expected one of {ROI_MODES}")
 
-    intra_overlap_area_um2 = calculate_overlap_area(ab_masks, cell_masks, pixel_to_micrometer)
-    print(f"Total intracellular ab accumulation area: {intra_overlap_area_um2:.2f} μm²")
+    # Load only the label images (memory-mapped or lazily decoded, see image_io.load_label_masks)
+    with stage(stage_log, 'load') as counts:
+        cell_masks = load_label_masks(cell_npy_path, masks_cache_dir)
+        ab_masks = load_label_masks(ab_npy_path, masks_cache_dir)
+        if cell_masks.shape != ab_masks.shape:
+            raise ValueError(f"Cell and ab masks differ in size: {cell_masks.shape} vs {ab_masks.shape}")
 
-    if (age == '6 weeks'):
-        # remove any intracellular ab (overlap of ab and cell) for 6 week
-        ab_masks[cell_masks != 0] = 0
+        # ROI: crop to the subiculum bounding box (as a region, nothing is copied)
+        region = None
+        sub_mask = None
+        if roi_mode is not None:
+            if sub_path is None or bounding_box is None:
+                raise ValueError("roi_mode needs sub_path and bounding_box")
+            sub_mask = open_tiff(sub_path)
+            if sub_mask.shape != cell_masks.shape:
+                raise ValueError(f"Subiculum mask and cell masks differ in size: {sub_mask.shape} vs {cell_masks.shape}")
+            region = (int(bounding_box['min_row']), int(bounding_box['max_row']) + 1,
+                      int(bounding_box['min_col']), int(bounding_box['max_col']) + 1)
+        counts['pixels'] = int(cell_masks.shape[0] * cell_masks.shape[1])
+
+    # overlap of ab and cell, split into sides, plus which cell overlaps which ab (sparse label pairs)
+    with stage(stage_log, 'overlap') as counts:
+        pair_acc = new_pair_accumulator()
+        overlap_bin_pixels = np.zeros(profile_axis['n_bins'] if profile_axis else 0, dtype=np.int64)
+        overlap_pixels = overlap_by_side(cell_masks, ab_masks, pixel_to_micrometer, sub_midpoint, perpendicular_vector,
+                                         tile_shape, region, sub_mask, pair_acc,
+                                         profile_axis, overlap_bin_pixels)  # in Pixels!! [left, right]
+        overlap_pairs = finish_label_pairs(pair_acc)
+        counts['overlap_pixels'] = int(overlap_pixels.sum())
+        counts['label_pairs'] = len(overlap_pairs['pixels'])
+
+    # convert to actual area in um
+    left_overlap, right_overlap = overlap_pixels * (pixel_to_micrometer**2)
+    intra_overlap_area_um2 = overlap_pixels.sum() * (pixel_to_micrometer**2)
+    if verbose:
+        print(f"Total intracellular ab accumulation area: {intra_overlap_area_um2:.2f} μm²")
+
+    # remove any intracellular ab (overlap of ab and cell) for 6 week:
+    # cell pixels are treated as background when counting ab, ab_masks is not modified
+    ab_exclude = cell_masks if age == '6 weeks' else None
 
     # -------- NEW!! stat about each side of SUB --------
-    left_cell, right_cell = {'count':0, 'area':0.0, 'area_list':[], 'centroids':[]}, {'count':0, 'area':0.0, 'area_list':[], 'centroids':[]}
-    left_ab, right_ab = {'count':0, 'area':0.0, 'area_list':[], 'centroids':[]}, {'count':0, 'area':0.0, 'area_list':[], 'centroids':[]}
-
-    cell_mask_area_dist_um2 = []
-    ab_mask_area_dist_um2 = []
-
-    # STAT about CELL
-    for cell_id in np.unique(cell_masks):
-        if cell_id == 0:
-            continue
-            
-        mask = cell_masks == cell_id
-        area_pixels = np.sum(mask)
-        area_um = area_pixels * (pixel_to_micrometer**2)
-
-        # global cell area dist
-        cell_mask_area_dist_um2.append(area_um)
-        
-        # cell centroid in pixel
-        y_coords, x_coords = np.where(mask)
-        centroid = (np.mean(x_coords), np.mean(y_coords))
-        centroid_um = (centroid[0] * pixel_to_micrometer, centroid[1] * pixel_to_micrometer)
-
-        # determine side
-        if is_left(*centroid_um, sub_midpoint, perpendicular_vector):
-            left_cell['count'] += 1
-            left_cell['area'] += area_um
-            left_cell['area_list'].append(area_um)
-            left_cell['centroids'].append(centroid_um)
+    # per-label area, centroid & shape in one pass over each label image
+    with stage(stage_log, 'label_stats') as counts:
+        if roi_mode is None:
+            cell_stats = compute_label_stats(cell_masks, tile_shape=tile_shape, shape=True)
+            ab_stats = compute_label_stats(ab_masks, exclude=ab_exclude, tile_shape=tile_shape, shape=True)
+        elif roi_mode == 'pixels':
+            cell_stats = compute_label_stats(cell_masks, tile_shape=tile_shape, shape=True,
+                                             inside=sub_mask, inside_value=SUB_MASK_VALUE, region=region)
+            ab_stats = compute_label_stats(ab_masks, exclude=ab_exclude, tile_shape=tile_shape, shape=True,
+                                           inside=sub_mask, inside_value=SUB_MASK_VALUE, region=region)
         else:
-            right_cell['count'] += 1
-            right_cell['area'] += area_um
-            right_cell['area_list'].append(area_um)
-            right_cell['centroids'].append(centroid_um)
-
-    # STAT about AB
-    for ab_id in np.unique(ab_masks):
-        if ab_id == 0:
-            continue
-            
-        mask = ab_masks == ab_id
-        area_pixels = np.sum(mask)
-        area_um = area_pixels * (pixel_to_micrometer**2)
-        # global ab area distribution
-        ab_mask_area_dist_um2.append(area_um)
-        
-        # AB centroid
-        y_coords, x_coords = np.where(mask)
-        centroid = (np.mean(x_coords), np.mean(y_coords))
-        centroid_um = (centroid[0] * pixel_to_micrometer, centroid[1] * pixel_to_micrometer)
-        
-        # side
-        if is_left(*centroid_um, sub_midpoint, perpendicular_vector):
-            left_ab['count'] += 1
-            left_ab['area'] += area_um
-            left_ab['area_list'].append(area_um)
-            left_ab['centroids'].append(centroid_um)
-        else:
-            right_ab['count'] += 1
-            right_ab['area'] += area_um
-            right_ab['area_list'].append(area_um)
-            right_ab['centroids'].append(centroid_um)
-
-    # Cal pixel overlapping
-    overlap_mask = (ab_masks != 0) & (cell_masks != 0)
-    overlap_pixels = np.sum(overlap_mask)
-    y_coords, x_coords = np.where(overlap_mask)
-    
-    # in Pixels!!
-    left_overlap = np.sum([is_left(x, y, sub_midpoint, perpendicular_vector) for x, y in zip(x_coords, y_coords)])
-    right_overlap = overlap_pixels - left_overlap
-    
-    # convert to actual area in um
-    left_overlap *= (pixel_to_micrometer**2)
-    right_overlap *= (pixel_to_micrometer**2)
-
-    print("\n=== Overall Stat ===")
-    print(f"Cell Count: {left_cell['count'] + right_cell['count']}")
-    print(f"AB Area: {left_ab['area'] + right_ab['area']:.2f} μm²")
-    print(f"Intra AB Area: {intra_overlap_area_um2:.2f} μm²")
-
-    print("\n=== Left Stat ===")
-    print(f"Left Cell Count: {left_cell['count']}")
-    print(f"Left Cell Area: {left_cell['area']:.2f} μm²")
-    print(f"Left AB Count: {left_ab['count']}")
-    print(f"Left AB Area: {left_ab['area']:.2f} μm²")
-
-    print("\n=== Right Stat ===")
-    print(f"Right Cell Count: {right_cell['count']}")
-    print(f"Right Cell Area: {right_cell['area']:.2f} μm²")
-    print(f"Right AB Count: {right_ab['count']}")
-    print(f"Right AB Area: {right_ab['area']:.2f} μm²")
+            sub_crop = np.asarray(sub_mask[region[0]:region[1], region[2]:region[3]]) == SUB_MASK_VALUE
+            cell_stats = _centroid_roi_stats(cell_masks, None, region, sub_crop, tile_shape)
+            ab_stats = _centroid_roi_stats(ab_masks, ab_exclude, region, sub_crop, tile_shape)
+        counts['cells'] = len(cell_stats['labels'])
+        counts['plaques'] = len(ab_stats['labels'])
+
+    # object table: left / right split and per-object overlap
+    with stage(stage_log, 'split') as counts:
+        cell_rows = _object_rows(cell_stats, 'cell', pixel_to_micrometer, sub_midpoint, perpendicular_vector,
+                                 overlap_pairs['label_a'], overlap_pairs['pixels'], profile_axis)
+        ab_rows = _object_rows(ab_stats, 'plaque', pixel_to_micrometer, sub_midpoint, perpendicular_vector,
+                               overlap_pairs['label_b'], overlap_pairs['pixels'], profile_axis,
+                               add_overlap_to_area=ab_exclude is not None)
+        objects = np.concatenate([cell_rows, ab_rows])
+        left_cell, right_cell = _side_totals(cell_rows, 'LEFT'), _side_totals(cell_rows, 'RIGHT')
+        left_ab, right_ab = _side_totals(ab_rows, 'LEFT'), _side_totals(ab_rows, 'RIGHT')
+
+        # proximal-distal bins from the positions already in the object table
+        profile = None
+        if profile_axis is not None:
+            profile = {'n_bins': profile_axis['n_bins']}
+            for name, rows in (('cell', cell_rows), ('plaque', ab_rows)):
+                bin_counts, bin_areas = bin_positions(profile_axis, rows['pd_position'], rows['area_um2'])
+                profile[f'{name}_count'] = bin_counts.tolist()
+                profile[f'{name}_area_um2'] = bin_areas.tolist()
+            profile['intra_plaque_area_um2'] = (overlap_bin_pixels * (pixel_to_micrometer**2)).tolist()
+        counts['left_cells'] = left_cell['count']
+        counts['right_cells'] = right_cell['count']
+        counts['left_plaques'] = left_ab['count']
+        counts['right_plaques'] = right_ab['count']
+
+    if verbose:
+        print("\n=== Overall Stat ===")
+        print(f"Cell Count: {left_cell['count'] + right_cell['count']}")
+        print(f"AB Area: {left_ab['area'] + right_ab['area']:.2f} μm²")
+        print(f"Intra AB Area: {intra_overlap_area_um2:.2f} μm²")
+
+        print("\n=== Left Stat ===")
+        print(f"Left Cell Count: {left_cell['count']}")
+        print(f"Left Cell Area: {left_cell['area']:.2f} μm²")
+        print(f"Left AB Count: {left_ab['count']}")
+        print(f"Left AB Area: {left_ab['area']:.2f} μm²")
+
+        print("\n=== Right Stat ===")
+        print(f"Right Cell Count: {right_cell['count']}")
+        print(f"Right Cell Area: {right_cell['area']:.2f} μm²")
+        print(f"Right AB Count: {right_ab['count']}")
+        print(f"Right AB Area: {right_ab['area']:.2f} μm²")
 
     return {
-        'cell_global_dist': cell_mask_area_dist_um2,
-        'ab_global_dist': ab_mask_area_dist_um2,
+        'objects': objects,   # object_table.OBJECT_DTYPE rows, cells then plaques in label order
         'left': {
-            'cell_dist': left_cell['area_list'],
-            'ab_dist': left_ab['area_list'],
-            'cell_centroids': left_cell['centroids'],
-            'ab_centroids': left_ab['centroids'],
             'cell_count': left_cell['count'],
             'cell_area': left_cell['area'],
             'plaques': left_ab['count'],
-            'plaque_area': left_ab['area']
+            'plaque_area': left_ab['area'],
+            'intra_plaque': left_overlap
         },
         'right': {
-            'cell_dist': right_cell['area_list'],
-            'ab_dist': right_ab['area_list'],
-            'cell_centroids': right_cell['centroids'],
-            'ab_centroids': right_ab['centroids'],
             'cell_count': right_cell['count'],
             'cell_area': right_cell['area'],
             'plaques': right_ab['count'],
-            'plaque_area': right_ab['area']
+            'plaque_area': right_ab['area'],
+            'intra_plaque': right_overlap
         },
         'total': {
             'cell_count': left_cell['count'] + right_cell['count'],
@@ -166,5 +315,6 @@ def analyze_mask(cell_npy_path, ab_npy_path, pixel_to_micrometer, age, sub_midpo
             'plaques': left_ab['count'] + right_ab['count'],
             'plaque_area': left_ab['area'] + right_ab['area'],
             'intra_plaque': intra_overlap_area_um2
-        }
-    }
\ No newline at end of file
+        },
+        'profile': profile   # None without profile_axis
+    }
@@ -0,0 +1,212 @@
+import warnings
+import numpy as np
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# the subiculum mask is skeletonized on a grid of at most this many blocks per side
+CENTRELINE_GRID = 512
+
+# 8-neighbours of a pixel, clockwise from the top (P2..P9 in Zhang & Suen 1984)
+_NEIGHBOURS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+def downsample_factor(shape: Tuple[int, int], grid: int = CENTRELINE_GRID) -> int:
+    # block size (pixel) so the longer side fits in grid blocks
+    return max(1, -(-max(shape) // grid))
+
+def new_coverage(shape: Tuple[int, int], factor: int) -> np.ndarray:
+    """per-block count of mask pixels, filled tile by tile with accumulate_coverage"""
+    return np.zeros((-(-shape[0] // factor), -(-shape[1] // factor)), dtype=np.int64)
+
+def accumulate_coverage(coverage: np.ndarray, mask_tile: np.ndarray, factor: int,
+                        row_offset: int = 0, col_offset: int = 0) -> None:
+    # add the mask pixels of one tile to their blocks (tiles need not be block aligned)
+    n_rows, n_cols = mask_tile.shape
+    block_rows = np.arange(row_offset, row_offset + n_rows) // factor
+    block_cols = np.arange(col_offset, col_offset + n_cols) // factor
+    row_starts = np.flatnonzero(np.r_[True, block_rows[1:] != block_rows[:-1]])
+    col_starts = np.flatnonzero(np.r_[True, block_cols[1:] != block_cols[:-1]])
+    sums = np.add.reduceat(np.add.reduceat(mask_tile.astype(np.int64), row_starts, axis=0), col_starts, axis=1)
+    coverage[block_rows[0]:block_rows[-1] + 1, block_cols[0]:block_cols[-1] + 1] += sums
+
+def _block_pixels(shape: Tuple[int, int], factor: int) -> np.ndarray:
+    # number of image pixels in every block, smaller at the bottom / right edge
+    rows = np.minimum(factor, shape[0] - np.arange(0, shape[0], factor))
+    cols = np.minimum(factor, shape[1] - np.arange(0, shape[1], factor))
+    return rows[:, None] * cols[None, :]
+
+def thin(mask: np.ndarray) -> np.ndarray:
+    """
+    Zhang-Suen thinning of a binary image, every sub-iteration is evaluated
+    on the whole image at once; returns a one pixel wide skeleton
+    """
+    img = np.pad(mask.astype(bool), 1)
+    while True:
+        changed = False
+        for step in (0, 1):
+            p = [np.roll(np.roll(img, -dr, axis=0), -dc, axis=1) for dr, dc in _NEIGHBOURS]
+            n_neighbours = sum(q.astype(np.uint8) for q in p)
+            # number of 0 -> 1 transitions in the sequence P2, P3, ..., P9, P2
+            transitions = sum((~p[i] & p[(i + 1) % 8]).astype(np.uint8) for i in range(8))
+            p2, p4, p6, p8 = p[0], p[2], p[4], p[6]
+            if step == 0:
+                side = ~(p2 & p4 & p6) & ~(p4 & p6 & p8)
+            else:
+                side = ~(p2 & p4 & p8) & ~(p2 & p6 & p8)
+            remove = img & (n_neighbours >= 2) & (n_neighbours <= 6) & (transitions == 1) & side
+            if remove.any():
+                img &= ~remove
+                changed = True
+        if not changed:
+            return img[1:-1, 1:-1]
+
+def _bfs(start: Tuple[int, int], pixels: set) -> Tuple[Dict, Tuple[int, int]]:
+    # breadth-first search over 8-connected skeleton pixels: parent links + farthest pixel
+    parent = {start: None}
+    queue = deque([start])
+    last = start
+    while queue:
+        last = queue.popleft()
+        r, c = last
+        for dr, dc in _NEIGHBOURS:
+            nxt = (r + dr, c + dc)
+            if nxt in pixels and nxt not in parent:
+                parent[nxt] = last
+                queue.append(nxt)
+    return parent, last
+
+def longest_path(skeleton: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    longest shortest path through the largest connected piece of the skeleton
+    (two BFS passes: farthest pixel from anywhere, then farthest from that one),
+    i.e. the main axis without the side branches
+    warns if the skeleton has more than one piece: everything off the largest
+    piece is placed at its nearest point of the path (often an end, t = 0 or 1)
+    """
+    pixels = set(zip(*np.nonzero(skeleton)))
+    if not pixels:
+        raise ValueError("Subiculum mask is empty, no centreline")
+
+    # largest connected piece
+    best = None
+    n_pieces = 0
+    unvisited = set(pixels)
+    while unvisited:
+        parent, _ = _bfs(next(iter(unvisited)), unvisited)
+        unvisited -= parent.keys()
+        n_pieces += 1
+        if best is None or len(parent) > len(best):
+            best = set(parent)
+    if n_pieces > 1:
+        warnings.warn(f"Subiculum mask is in {n_pieces} pieces, the centreline follows the largest one "
+                      f"({len(best)} of {len(pixels)} skeleton blocks)")
+
+    _, end_a = _bfs(next(iter(best)), best)
+    parent, end_b = _bfs(end_a, best)
+    path = [end_b]
+    while parent[path[-1]] is not None:
+        path.append(parent[path[-1]])
+    return path
+
+def nearest_seed_map(shape: Tuple[int, int], seeds: np.ndarray) -> np.ndarray:
+    """
+    index of the nearest seed (row, col) for every cell of a grid, by jump
+    flooding: each pass looks at 8 cells step away and keeps the closer seed,
+    with step halving from the grid size down to 1 (plus a final 1-step pass)
+    log2(grid size) whole-grid passes instead of one search per cell; the
+    result is exact for nearly all cells, the rest get a seed marginally farther
+    (tests/test_centreline.py compares it with a brute-force search)
+    """
+    seeds = np.asarray(seeds, dtype=np.int64).reshape(-1, 2)
+    nearest = np.full(shape, -1, dtype=np.int64)
+    nearest[seeds[:, 0], seeds[:, 1]] = np.arange(len(seeds))
+    best_d2 = np.where(nearest >= 0, 0, np.iinfo(np.int64).max)
+    rows, cols = np.indices(shape)
+
+    step = 1 << max(int(np.ceil(np.log2(max(shape)))) - 1, 0)
+    steps = []
+    while step >= 1:
+        steps.append(step)
+        step //= 2
+    for step in steps + [1]:
+        for dr in (-step, 0, step):
+            for dc in (-step, 0, step):
+                if (dr == 0 and dc == 0) or abs(dr) >= shape[0] or abs(dc) >= shape[1]:
+                    continue
+                # seed of the cell at (row + dr, col + dc), -1 outside the grid
+                candidate = np.full(shape, -1, dtype=np.int64)
+                dst = (slice(max(-dr, 0), shape[0] - max(dr, 0)), slice(max(-dc, 0), shape[1] - max(dc, 0)))
+                src = (slice(max(dr, 0), shape[0] - max(-dr, 0)), slice(max(dc, 0), shape[1] - max(-dc, 0)))
+                candidate[dst] = nearest[src]
+                valid = candidate >= 0
+                seed = seeds[np.where(valid, candidate, 0)]
+                d2 = (seed[..., 0] - rows) ** 2 + (seed[..., 1] - cols) ** 2
+                closer = valid & (d2 < best_d2)
+                nearest[closer] = candidate[closer]
+                best_d2[closer] = d2[closer]
+    return nearest
+
+def skeleton_centreline(coverage: np.ndarray, image_shape: Tuple[int, int], factor: int,
+                        pixel_to_micrometer: float,
+                        left_end: Optional[Tuple[float, float]] = None) -> Dict:
+    """
+    centreline of the subiculum from its block coverage (new_coverage /
+    accumulate_coverage): blocks at least half covered are thinned to a
+    skeleton, its longest path is the centreline
+    the line starts at the end closest to left_end (x, y in pixel), or at the
+    end with the smaller x without it
+    raises ValueError if the line has no length (a small, round or square mask
+    thins to a single block): such a mask has no main axis, the ends must be given
+    every block then gets the normalized arc length t (0 at the start, 1 at the
+    end) of its nearest centreline point, so looking up an object is O(1)
+
+    return data structure
+    {
+        "factor": ...,            # block size in pixel
+        "pixel_to_micrometer": ...,
+        "points_um": [...],       # (x, y) along the line, in um
+        "length_um": ...,
+        "left_end_pixel": (x, y), "right_end_pixel": (x, y),
+        "t_map": ...              # float32 array, one t per block
+    }
+    """
+    mask = coverage * 2 >= _block_pixels(image_shape, factor)
+    mask &= coverage > 0
+    path = np.array(longest_path(thin(mask)), dtype=np.float64)  # (block row, block col)
+
+    # block centres in pixel (x, y)
+    xy = (path[:, ::-1] + 0.5) * factor - 0.5
+    if left_end is not None:
+        flip = np.hypot(*(xy[-1] - left_end)) < np.hypot(*(xy[0] - left_end))
+    else:
+        flip = xy[-1, 0] < xy[0, 0]
+    if flip:
+        path, xy = path[::-1], xy[::-1]
+
+    points_um = xy * pixel_to_micrometer
+    arc_um = np.r_[0.0, np.cumsum(np.hypot(*np.diff(points_um, axis=0).T))]
+    length_um = arc_um[-1]
+    if not length_um > 0:
+        raise ValueError(f"Subiculum centreline has no length ({len(path)} block(s)): the mask has no main axis "
+                         f"to follow, give left_sub_end and right_sub_end (and use the line profile axis)")
+    t_path = arc_um / length_um
+
+    # nearest centreline point of every block
+    t_map = t_path[nearest_seed_map(coverage.shape, path.astype(np.int64))].astype(np.float32)
+
+    return {
+        "factor": factor,
+        "pixel_to_micrometer": pixel_to_micrometer,
+        "points_um": [tuple(p) for p in points_um.tolist()],
+        "length_um": float(length_um),
+        "left_end_pixel": tuple(xy[0].tolist()),
+        "right_end_pixel": tuple(xy[-1].tolist()),
+        "t_map": t_map
+    }
+
+def t_of_pixels(centreline: Dict, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """normalized position along the centreline of image pixels (row, col), by block lookup"""
+    t_map = centreline["t_map"]
+    factor = centreline["factor"]
+    block_rows = np.clip(np.asarray(rows, dtype=np.int64) // factor, 0, t_map.shape[0] - 1)
+    block_cols = np.clip(np.asarray(cols, dtype=np.int64) // factor, 0, t_map.shape[1] - 1)
+    return t_map[block_rows, block_cols]
@@ -0,0 +1,35 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional
+
+# slices of a batch run whose results are committed, kept in the output folder
+DEFAULT_CHECKPOINT_NAME = 'batch_checkpoint.json'
+
+def slice_fingerprint(params: Dict, input_paths: List[str], options: Optional[Dict] = None) -> str:
+    """
+    identity of one slice for resuming: its parsed manifest row, the options that
+    change the result and size + mtime of every input (cheap, no content hash),
+    so an edited input or a changed option is analyzed again
+    """
+    stats = [(os.path.getsize(path), os.stat(path).st_mtime_ns) for path in input_paths]
+    digest = hashlib.sha256(json.dumps([params, options or {}, stats], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def load_checkpoint(path: str) -> Dict[str, Dict]:
+    # fingerprint -> {'row', 'mouse_id', 'slice_id'}, empty without a checkpoint
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)['done']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def save_checkpoint(path: str, done: Dict[str, Dict], manifest_path: str = '') -> None:
+    """write the finished slices, temp file + fsync + rename (never half a file)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'manifest': manifest_path, 'done': done}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,313 @@
+import os
+import sys
+import math
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from result_store import ResultStore, STORE_FORMATS, open_store
+
+# default grouping of the cohort summary
+GROUP_COLUMNS = ['genotype', 'age', 'sex', 'side']
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# quantiles are within this relative error of the exact value
+SKETCH_RELATIVE_ACCURACY = 0.01
+# running cohort statistics, kept next to the result tables
+DEFAULT_STATE_NAME = 'cohort_stats.pkl'
+
+# one value per slice and side (summary_stats columns)
+SLICE_METRICS = ['n_cells', 'total_cell_area', 'mean_cell_area', 'cell_area_pct',
+                 'n_plaques', 'total_plaque_area', 'mean_plaque_area', 'plaque_area_pct', 'intra_plaque_pct']
+# one value per cell / plaque (distribution_data area_um2 by type)
+OBJECT_METRICS = {'cell': 'cell_area_um2', 'plaque': 'plaque_area_um2'}
+# slice labels taken from summary_stats, metadata can override them
+LABEL_COLUMNS = ['sex', 'genotype', 'age']
+
+class RunningStats:
+    """count, mean, variance (Welford), min and max of a stream of values; mergeable"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0   # sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        batch = RunningStats()
+        batch.n = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        batch.min, batch.max = float(values.min()), float(values.max())
+        self.merge(batch)
+
+    def merge(self, other: 'RunningStats') -> None:
+        # Chan et al. pairwise update of mean and m2
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        # sample variance, NaN below 2 values
+        return self.m2 / (self.n - 1) if self.n > 1 else math.nan
+
+class QuantileSketch:
+    """
+    mergeable quantile sketch with relative error (DDSketch, Masson et al. 2019):
+    every value goes to the bucket ceil(log_gamma |x|), one counter per bucket,
+    so memory grows with the log of the value range, not with the number of values
+    """
+
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.positive: Counter = Counter()
+        self.negative: Counter = Counter()
+        self.zero = 0
+        self.n = 0
+
+    def _bucket(self, magnitudes: np.ndarray) -> np.ndarray:
+        return np.ceil(np.log(magnitudes) / np.log(self.gamma)).astype(np.int64)
+
+    def add(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.zero += int((values == 0).sum())
+        for store, part in ((self.positive, values[values > 0]), (self.negative, -values[values < 0])):
+            if len(part):
+                keys, counts = np.unique(self._bucket(part), return_counts=True)
+                store.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        if other.gamma != self.gamma:
+            raise ValueError("can't merge sketches of different accuracy")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zero += other.zero
+        self.n += other.n
+
+    def quantiles(self, qs: Sequence[float]) -> List[float]:
+        if self.n == 0:
+            return [math.nan] * len(qs)
+        # buckets in value order: negatives (largest magnitude first), zero, positives
+        neg_keys = sorted(self.negative, reverse=True)
+        pos_keys = sorted(self.positive)
+        values = np.array([-self._value(k) for k in neg_keys] + [0.0] + [self._value(k) for k in pos_keys])
+        counts = np.array([self.negative[k] for k in neg_keys] + [self.zero] + [self.positive[k] for k in pos_keys])
+        cumulative = np.cumsum(counts)
+        ranks = np.asarray(qs, dtype=np.float64) * (self.n - 1)
+        return values[np.searchsorted(cumulative, ranks, side='right')].tolist()
+
+    def _value(self, key: int) -> float:
+        # value in the middle of the bucket (in relative terms)
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+class MetricAccumulator:
+    """running stats + quantile sketch of one metric"""
+
+    def __init__(self):
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch()
+
+    def add(self, values) -> None:
+        self.stats.add(values)
+        self.sketch.add(values)
+
+    def merge(self, other: 'MetricAccumulator') -> None:
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+
+def slice_accumulators(tables: Dict[str, pd.DataFrame]) -> Dict[Tuple[str, str], MetricAccumulator]:
+    """
+    statistics of one slice from its result tables (see save_results.build_result_tables),
+    keyed by (side, metric); distribution_data's GLOBAL rows count as side TOTAL
+    """
+    accumulators = {}
+    summary = tables['summary_stats']
+    for metric in SLICE_METRICS:
+        for side, value in zip(summary['side'], summary[metric]):
+            accumulators.setdefault((side, metric), MetricAccumulator()).add([value])
+
+    dist = tables.get('distribution_data')
+    if dist is not None and not dist.empty:
+        sides = dist['side'].replace('GLOBAL', 'TOTAL')
+        for (obj_type, side), areas in dist['area_um2'].groupby([dist['type'], sides]):
+            if obj_type in OBJECT_METRICS:
+                accumulators.setdefault((side, OBJECT_METRICS[obj_type]), MetricAccumulator()).add(areas.to_numpy())
+    return accumulators
+
+def load_metadata(path: str) -> pd.DataFrame:
+    """
+    per-mouse (or per-slice) metadata CSV: mouse_id, optional slice_id (empty = all
+    slices of the mouse), optional exclude (1 / true / yes), and any label columns,
+    e.g. mouse_label, or sex / genotype / age to correct the values saved with the slice;
+    every label column can be used to group the summary
+    """
+    meta = pd.read_csv(path, dtype=str, keep_default_na=False)
+    if 'mouse_id' not in meta.columns:
+        raise ValueError(f"Metadata {path} has no mouse_id column")
+    meta['mouse_id'] = meta['mouse_id'].str.strip()
+    if 'slice_id' not in meta.columns:
+        meta['slice_id'] = ''
+    meta['exclude'] = meta.get('exclude', pd.Series('', index=meta.index)).str.strip().str.lower() \
+        .isin(['1', 'true', 'yes', 'y'])
+    return meta
+
+def slice_labels(mouse_id: str, slice_id: str, labels: Dict, meta: Optional[pd.DataFrame]) -> Optional[Dict]:
+    """labels of one slice after the metadata (see load_metadata), None if it is excluded"""
+    labels = {'mouse_id': mouse_id, 'slice_id': slice_id, **labels}
+    if meta is not None:
+        rows = meta[(meta['mouse_id'] == mouse_id) & meta['slice_id'].isin(['', slice_id])]
+        if rows['exclude'].any():
+            return None
+        # slice rows win over mouse rows
+        for _, row in rows.sort_values('slice_id').iterrows():
+            labels.update({col: value for col, value in row.items()
+                           if col not in ('mouse_id', 'slice_id', 'exclude') and value != ''})
+    return labels
+
+class CohortAggregator:
+    """
+    running per-slice statistics of a cohort, merged into group summaries on demand
+    each slice keeps only its accumulators (no object rows), so a summary over
+    any grouping costs one merge per slice; adding a slice again replaces it,
+    the same way the result store replaces its rows
+    """
+
+    def __init__(self):
+        # (mouse_id, slice_id) -> {'labels': {...}, 'metrics': {(side, metric): MetricAccumulator}}
+        self.slices: Dict[Tuple[str, str], Dict] = {}
+
+    def add_slice(self, tables: Dict[str, pd.DataFrame]) -> None:
+        summary = tables['summary_stats']
+        first = summary.iloc[0]
+        key = (str(first['mouse_id']), str(first['slice_id']))
+        self.slices[key] = {
+            'labels': {col: first[col] for col in LABEL_COLUMNS},
+            'metrics': slice_accumulators(tables)
+        }
+
+    def remove_slice(self, mouse_id: str, slice_id: str) -> None:
+        self.slices.pop((str(mouse_id), str(slice_id)), None)
+
+    def _slice_labels(self, meta: Optional[pd.DataFrame]) -> Iterable[Tuple[Tuple[str, str], Dict]]:
+        # labels of every slice after the metadata, excluded slices are skipped
+        for (mouse_id, slice_id), entry in self.slices.items():
+            labels = slice_labels(mouse_id, slice_id, entry['labels'], meta)
+            if labels is not None:
+                yield (mouse_id, slice_id), labels
+
+    def summary(self, metadata: Optional[pd.DataFrame] = None, by: Sequence[str] = GROUP_COLUMNS,
+                quantiles: Sequence[float] = DEFAULT_QUANTILES) -> pd.DataFrame:
+        """
+        one row per group (the columns in by, 'side' is the summary_stats side) and metric
+        columns: n, n_mice, n_slices, mean, variance, sd, min, max, q05, q25, q50...
+        """
+        groups: Dict[Tuple, Dict] = {}
+        for key, labels in self._slice_labels(metadata):
+            for (side, metric), acc in self.slices[key]['metrics'].items():
+                group_labels = {**labels, 'side': side}
+                missing = [col for col in by if col not in group_labels]
+                if missing:
+                    raise KeyError(f"Unknown group columns {missing}")
+                group = tuple(group_labels[col] for col in by) + (metric,)
+                entry = groups.setdefault(group, {'acc': MetricAccumulator(), 'mice': set(), 'slices': set()})
+                entry['acc'].merge(acc)
+                entry['mice'].add(key[0])
+                entry['slices'].add(key)
+
+        q_names = [f"q{round(q * 100):02d}" for q in quantiles]
+        rows = []
+        for group, entry in groups.items():
+            stats = entry['acc'].stats
+            row = dict(zip(list(by) + ['metric'], group))
+            row.update({
+                'n': stats.n,
+                'n_mice': len(entry['mice']),
+                'n_slices': len(entry['slices']),
+                'mean': stats.mean if stats.n else math.nan,
+                'variance': stats.variance,
+                'sd': math.sqrt(stats.variance) if stats.n > 1 else math.nan,
+                'min': stats.min if stats.n else math.nan,
+                'max': stats.max if stats.n else math.nan
+            })
+            row.update(zip(q_names, entry['acc'].sketch.quantiles(quantiles)))
+            rows.append(row)
+        columns = list(by) + ['metric', 'n', 'n_mice', 'n_slices', 'mean', 'variance', 'sd', 'min', 'max'] + q_names
+        return pd.DataFrame(rows, columns=columns).sort_values(list(by) + ['metric'], ignore_index=True)
+
+    def save(self, path: str) -> None:
+        # temp file + rename, a crash never leaves a half-written state
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+def load_cohort(path: str) -> CohortAggregator:
+    """the saved aggregator, or an empty one when there is none yet"""
+    if not os.path.exists(path):
+        return CohortAggregator()
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def rebuild_cohort(store: ResultStore) -> CohortAggregator:
+    """aggregator over every slice already in a result store (one full read of two tables)"""
+    cohort = CohortAggregator()
+    summary = store.read('summary_stats')
+    dist = store.read('distribution_data', columns=['mouse_id', 'slice_id', 'type', 'side', 'area_um2'])
+    for col in ('mouse_id', 'slice_id'):
+        summary[col] = summary[col].fillna('').astype(str)
+        dist[col] = dist[col].fillna('').astype(str)
+    dist_by_slice = dict(iter(dist.groupby(['mouse_id', 'slice_id'], sort=False)))
+    for key, slice_summary in summary.groupby(['mouse_id', 'slice_id'], sort=False):
+        cohort.add_slice({'summary_stats': slice_summary, 'distribution_data': dist_by_slice.get(key)})
+    return cohort
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Summarize the cohort from the running per-slice statistics.")
+    parser.add_argument('--results-dir', default='.', help="folder of the result tables (default: current)")
+    parser.add_argument('--format', choices=sorted(STORE_FORMATS), default='csv', help="result backend")
+    parser.add_argument('--state', default=None,
+                        help=f"saved statistics (default: {DEFAULT_STATE_NAME} in the results folder)")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="rebuild the statistics from the result tables (e.g. results saved before this existed)")
+    parser.add_argument('--metadata', default=None, help="CSV with mouse_id, exclude and label columns")
+    parser.add_argument('--by', nargs='+', default=GROUP_COLUMNS,
+                        help=f"group columns (default: {' '.join(GROUP_COLUMNS)})")
+    parser.add_argument('-o', '--output', default=None, help="write the summary to this CSV (default: print)")
+    args = parser.parse_args(argv)
+
+    state_path = args.state or os.path.join(args.results_dir, DEFAULT_STATE_NAME)
+    if args.rebuild or not os.path.exists(state_path):
+        cohort = rebuild_cohort(open_store(args.format, args.results_dir))
+        cohort.save(state_path)
+    else:
+        cohort = load_cohort(state_path)
+
+    metadata = load_metadata(args.metadata) if args.metadata else None
+    summary = cohort.summary(metadata, by=args.by)
+    if args.output:
+        summary.to_csv(args.output, index=False)
+        print(f"Cohort summary ({len(summary)} rows) written to {args.output}")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(summary)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
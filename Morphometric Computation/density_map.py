@@ -0,0 +1,232 @@
+import os
+import sys
+import math
+import argparse
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+from object_table import OBJECT_TYPES
+from cohort import load_metadata, slice_labels
+from result_store import slice_file_name
+
+# grid of the density maps in the subiculum frame, in midline lengths (see midline_frame)
+# u from left end (0) to right end (1), v perpendicular to the midline
+DEFAULT_DENSITY_EXTENT = (-0.1, 1.1, -0.6, 0.6)   # u_min, u_max, v_min, v_max
+DEFAULT_DENSITY_GRID = (120, 120)                 # (v bins, u bins), 0.01 midline lengths each
+# sd of the gaussian kernel, in midline lengths, 0 = raw counts per bin
+DEFAULT_DENSITY_SIGMA = 0.03
+# one .npz per slice, in this folder of the output folder
+DEFAULT_DENSITY_DIR = 'density_maps'
+# maps of every slice, float32: objects per mm2 and area fraction of each object type
+MAP_NAMES = [f'{obj_type}_{kind}' for obj_type in OBJECT_TYPES for kind in ('density', 'area_fraction')]
+# labels saved with each map (summary_stats values of the slice)
+LABEL_COLUMNS = ['mouse_id', 'slice_id', 'sex', 'genotype', 'age']
+# default grouping of the averaged maps
+GROUP_COLUMNS = ['genotype', 'age']
+
+def midline_frame(midline: Dict) -> Dict:
+    """
+    frame of the subiculum normalized to its midline (analyze_mask_sub "midline"),
+    so maps of slices and animals of different size and rotation line up:
+    u = (p - left_end) . d / L^2   0 at the left end, 1 at the right end
+    v = (p - left_end) . n / L^2   n = d rotated by +90 degrees in image coordinates
+                                   (x right, y down), i.e. towards +y for a left -> right midline
+    d = right_end - left_end, L = |d| (um)
+    """
+    x1, y1 = midline['left_end_um']
+    x2, y2 = midline['right_end_um']
+    dx, dy = x2 - x1, y2 - y1
+    length = math.hypot(dx, dy)
+    if length == 0:
+        raise ValueError("Left and right end of the subiculum are the same point")
+    return {'origin': (x1, y1), 'direction': (dx / length, dy / length), 'length_um': length}
+
+def to_frame(frame: Dict, x_um, y_um) -> Tuple[np.ndarray, np.ndarray]:
+    """(u, v) of points in um"""
+    x = np.asarray(x_um, dtype=np.float64) - frame['origin'][0]
+    y = np.asarray(y_um, dtype=np.float64) - frame['origin'][1]
+    cos, sin = frame['direction']
+    return (x * cos + y * sin) / frame['length_um'], (y * cos - x * sin) / frame['length_um']
+
+def _deposit(u: np.ndarray, v: np.ndarray, weights: Optional[np.ndarray], extent, grid) -> np.ndarray:
+    # sum of weights (or number of points) per grid bin, points off the grid are dropped
+    n_v, n_u = grid
+    u_min, u_max, v_min, v_max = extent
+    cols = np.floor((u - u_min) / (u_max - u_min) * n_u).astype(np.int64)
+    rows = np.floor((v - v_min) / (v_max - v_min) * n_v).astype(np.int64)
+    inside = (cols >= 0) & (cols < n_u) & (rows >= 0) & (rows < n_v)
+    flat = rows[inside] * n_u + cols[inside]
+    w = weights[inside] if weights is not None else None
+    return np.bincount(flat, weights=w, minlength=n_v * n_u).reshape(grid).astype(np.float64)
+
+def gaussian_kernel(sigma_bins: float) -> np.ndarray:
+    # normalized 2D gaussian, truncated at 4 sd
+    radius = max(int(math.ceil(4 * sigma_bins)), 1)
+    k = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma_bins) ** 2)
+    k /= k.sum()
+    return np.outer(k, k)
+
+def fft_smooth(grids: np.ndarray, sigma_bins: float) -> np.ndarray:
+    """
+    convolve a stack of grids (..., rows, cols) with a gaussian, zero-padded so it
+    is a linear (not circular) convolution; the cost depends on the grid size
+    only, not on the number of objects deposited in it
+    mass closer than 4 sd to the grid border partly leaves the grid
+    """
+    if sigma_bins <= 0:
+        return grids
+    kernel = gaussian_kernel(sigma_bins)
+    radius = kernel.shape[0] // 2
+    n_rows, n_cols = grids.shape[-2:]
+    shape = (n_rows + kernel.shape[0] - 1, n_cols + kernel.shape[1] - 1)
+    spectrum = np.fft.rfft2(grids, s=shape) * np.fft.rfft2(kernel, s=shape)
+    smoothed = np.fft.irfft2(spectrum, s=shape)[..., radius:radius + n_rows, radius:radius + n_cols]
+    # round-off of the transform leaves tiny negative values in empty areas
+    return np.maximum(smoothed, 0)
+
+def density_maps(mask_result: Dict, midline: Dict, sigma: float = DEFAULT_DENSITY_SIGMA,
+                 extent: Sequence[float] = DEFAULT_DENSITY_EXTENT,
+                 grid: Tuple[int, int] = DEFAULT_DENSITY_GRID) -> Dict:
+    """
+    kernel-smoothed density of cell and plaque centroids of one slice (analyze_mask
+    "objects"), on a grid in the midline frame (see midline_frame); every object is
+    deposited in the bin of its centroid, then all maps are smoothed at once with
+    fft_smooth (sigma in midline lengths)
+
+    return data structure
+    {
+        "cell_density": ..., "plaque_density": ...,              # (v bins, u bins), objects per mm2
+        "cell_area_fraction": ..., "plaque_area_fraction": ...,  # object area / slice area in the bin
+                                                                 # (the whole area sits at the centroid, so
+                                                                 # objects larger than the kernel can exceed 1)
+        "n_outside": {"cell": ..., "plaque": ...},               # centroids off the grid
+        "extent": [...], "sigma": ..., "midline_length_um": ...
+    }
+    """
+    frame = midline_frame(midline)
+    n_v, n_u = grid
+    u_min, u_max, v_min, v_max = extent
+    bin_area_um2 = ((u_max - u_min) / n_u * frame['length_um']) * ((v_max - v_min) / n_v * frame['length_um'])
+
+    objects = mask_result['objects']
+    grids = np.empty((len(MAP_NAMES), n_v, n_u))
+    n_outside = {}
+    for i, obj_type in enumerate(OBJECT_TYPES):
+        rows = objects[objects['type'] == i]
+        u, v = to_frame(frame, rows['x_um'], rows['y_um'])
+        grids[2 * i] = _deposit(u, v, None, extent, grid)
+        grids[2 * i + 1] = _deposit(u, v, rows['area_um2'], extent, grid)
+        n_outside[obj_type] = int(len(rows) - grids[2 * i].sum())
+
+    smoothed = fft_smooth(grids, sigma * n_u / (u_max - u_min)) / bin_area_um2
+    maps = {}
+    for name, values in zip(MAP_NAMES, smoothed):
+        # counts per um2 -> per mm2, areas per um2 are already a fraction
+        maps[name] = (values * 1e6 if name.endswith('density') else values).astype(np.float32)
+    maps.update({'n_outside': n_outside, 'extent': list(extent), 'sigma': sigma,
+                 'midline_length_um': frame['length_um']})
+    return maps
+
+def map_path(density_dir: str, mouse_id: str, slice_id: str) -> str:
+    # one file per slice, saving the slice again replaces it
+    return os.path.join(density_dir, slice_file_name(mouse_id, slice_id) + '.npz')
+
+def save_density_maps(path: str, maps: Dict, labels: Dict) -> None:
+    """compressed .npz with the maps, the grid and the slice labels (no pickles)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # temp file + rename, a crash never leaves a half-written map
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(
+        tmp_path,
+        **{name: maps[name] for name in MAP_NAMES},
+        extent=np.asarray(maps['extent'], dtype=np.float64),
+        sigma=np.float64(maps['sigma']),
+        midline_length_um=np.float64(maps['midline_length_um']),
+        **{col: np.str_(labels.get(col, '')) for col in LABEL_COLUMNS}
+    )
+    os.replace(tmp_path, path)
+
+def load_density_maps(path: str) -> Dict:
+    with np.load(path) as f:
+        maps = {name: f[name] for name in MAP_NAMES}
+        maps['extent'] = f['extent'].tolist()
+        maps['sigma'] = float(f['sigma'])
+        maps['labels'] = {col: str(f[col]) for col in LABEL_COLUMNS}
+    return maps
+
+def average_density_maps(density_dir: str, metadata=None, by: Sequence[str] = GROUP_COLUMNS) -> List[Dict]:
+    """
+    cohort-average maps: mean over the slices of each mouse, then over the mice of
+    each group (columns in by, from the saved labels or the metadata, see
+    cohort.load_metadata); excluded slices are skipped
+    all maps must be on the same grid
+
+    return data structure
+    [{"labels": {...}, "n_mice": ..., "n_slices": ..., "cell_density": ..., ...}, ...]
+    """
+    mice: Dict[Tuple, Dict] = {}
+    grid_key = None
+    for name in sorted(os.listdir(density_dir)):
+        if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+            continue
+        maps = load_density_maps(os.path.join(density_dir, name))
+        saved = maps['labels']
+        labels = slice_labels(saved['mouse_id'], saved['slice_id'],
+                              {col: saved[col] for col in LABEL_COLUMNS[2:]}, metadata)
+        if labels is None:
+            continue
+        key = (maps['extent'], maps['sigma'], maps[MAP_NAMES[0]].shape)
+        if grid_key is None:
+            grid_key = key
+        elif key != grid_key:
+            raise ValueError(f"{name} is on another grid than the other maps: {key} vs {grid_key}")
+        missing = [col for col in by if col not in labels]
+        if missing:
+            raise KeyError(f"Unknown group columns {missing}")
+        group = tuple(labels[col] for col in by)
+        entry = mice.setdefault(group + (labels['mouse_id'],), {'group': group, 'n_slices': 0,
+                                                                'sums': np.zeros((len(MAP_NAMES),) + key[2])})
+        entry['n_slices'] += 1
+        entry['sums'] += np.stack([maps[m] for m in MAP_NAMES])
+
+    groups: Dict[Tuple, Dict] = {}
+    for entry in mice.values():
+        agg = groups.setdefault(entry['group'], {'n_mice': 0, 'n_slices': 0, 'sums': 0})
+        agg['n_mice'] += 1
+        agg['n_slices'] += entry['n_slices']
+        agg['sums'] = agg['sums'] + entry['sums'] / entry['n_slices']
+    result = []
+    for group in sorted(groups):
+        agg = groups[group]
+        mean = (agg['sums'] / agg['n_mice']).astype(np.float32)
+        result.append({'labels': dict(zip(by, group)), 'n_mice': agg['n_mice'], 'n_slices': agg['n_slices'],
+                       'extent': list(grid_key[0]), **dict(zip(MAP_NAMES, mean))})
+    return result
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Average the per-slice density maps of a cohort by group.")
+    parser.add_argument('--maps-dir', default=DEFAULT_DENSITY_DIR,
+                        help=f"folder of the per-slice maps (default: {DEFAULT_DENSITY_DIR})")
+    parser.add_argument('--metadata', default=None, help="CSV with mouse_id, exclude and label columns")
+    parser.add_argument('--by', nargs='+', default=GROUP_COLUMNS,
+                        help=f"group columns (default: {' '.join(GROUP_COLUMNS)})")
+    parser.add_argument('-o', '--output', default='density_means.npz',
+                        help="write the group means to this .npz, one '<map>/<group>' array each "
+                             "(default: density_means.npz)")
+    args = parser.parse_args(argv)
+
+    metadata = load_metadata(args.metadata) if args.metadata else None
+    means = average_density_maps(args.maps_dir, metadata, by=args.by)
+    if not means:
+        print(f"No density maps in {args.maps_dir}")
+        return 1
+    arrays = {'extent': np.asarray(means[0]['extent'])}
+    for entry in means:
+        group = '_'.join(str(v) for v in entry['labels'].values())
+        print(f"{group}: {entry['n_mice']} mice, {entry['n_slices']} slices")
+        arrays.update({f"{name}/{group}": entry[name] for name in MAP_NAMES})
+    np.savez_compressed(args.output, **arrays)
+    print(f"Mean density maps of {len(means)} groups written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import os
+import zlib
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+from typing import Dict, Iterator, Optional, Tuple
+
+# raw masks extracted from Cellpose _seg.npy files, kept in this folder of the result cache
+# (never next to the inputs, which may be read-only or watched, see watch.py)
+MASKS_CACHE_DIRNAME = 'masks'
+MASKS_CACHE_SUFFIX = '.masks.npy'
+
+def masks_cache_path(npy_path: str, cache_dir: str) -> str:
+    # one entry per input file, image_seg.npy -> <cache_dir>/image_seg-<hash of the full path>.masks.npy
+    name = os.path.splitext(os.path.basename(npy_path))[0]
+    digest = hashlib.sha1(os.path.abspath(npy_path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{name}-{digest}{MASKS_CACHE_SUFFIX}")
+
+def load_label_masks(npy_path: str, cache_dir: Optional[str] = None) -> np.ndarray:
+    """
+    load only the label image from a Cellpose _seg.npy (or a label .tif,
+    which is opened with open_tiff and streamed tile by tile)
+    the pickled dict (flows, outlines, images...) has to be unpickled once;
+    with cache_dir the masks are then cached there as a raw .npy and memory-mapped
+    read-only, so later loads cost no unpickling and no copy (an entry older than
+    its input is rewritten); without cache_dir nothing is written
+    plain (non-pickled) .npy label images are memory-mapped directly
+    """
+    if os.path.splitext(npy_path)[1].lower() in ('.tif', '.tiff'):
+        return open_tiff(npy_path)
+
+    cache_path = masks_cache_path(npy_path, cache_dir) if cache_dir else None
+    if cache_path and os.path.isfile(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(npy_path):
+        return np.load(cache_path, mmap_mode='r')
+
+    # already a raw label array, nothing to extract
+    try:
+        return np.load(npy_path, mmap_mode='r')
+    except ValueError:
+        pass  # object array -> pickled Cellpose dict
+
+    seg_data = np.load(npy_path, allow_pickle=True).item()
+    masks = np.asarray(seg_data['masks'])
+    del seg_data  # drop flows/outlines as soon as possible
+
+    if not cache_path:
+        return masks
+    # write to a temp file first, a half-written cache must never be picked up
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, masks)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # cache folder not writable, just use the in-memory array
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return masks
+    del masks
+    return np.load(cache_path, mmap_mode='r')
+
+
+# (rows, cols) of one tile, None = full width / height
+TileShape = Tuple[Optional[int], Optional[int]]
+DEFAULT_TILE_SHAPE = (512, None)
+
+def iter_tiles(
+    shape: Tuple[int, int],
+    tile_shape: TileShape = DEFAULT_TILE_SHAPE,
+    region: Optional[Tuple[int, int, int, int]] = None
+) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    yield (row_start, row_end, col_start, col_end) of every tile, row-major
+    region: (row_start, row_end, col_start, col_end), only tile this part of the image
+    """
+    row_start, row_end, col_start, col_end = region if region is not None else (0, shape[0], 0, shape[1])
+    tile_rows = tile_shape[0] or (row_end - row_start)
+    tile_cols = tile_shape[1] or (col_end - col_start)
+    for r0 in range(row_start, row_end, max(tile_rows, 1)):
+        for c0 in range(col_start, col_end, max(tile_cols, 1)):
+            yield r0, min(r0 + tile_rows, row_end), c0, min(c0 + tile_cols, col_end)
+
+# TIFF tags used by LazyTiff
+_COMPRESSION_NONE = 1
+_COMPRESSION_DEFLATE = (8, 32946)
+_COMPRESSION_PACKBITS = 32773
+_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+# decoded TIFF strips / tiles and fully decoded images kept per process
+DECODE_CACHE_BYTES = 256 * 2**20
+
+class DecodeCache:
+    """
+    least recently used cache of decoded arrays, bounded by their total size
+    keys include the file's mtime and size, so an edited file is never served stale
+    """
+
+    def __init__(self, max_bytes: int = DECODE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._arrays: OrderedDict = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[np.ndarray]:
+        array = self._arrays.get(key)
+        if array is None:
+            self.misses += 1
+            return None
+        self._arrays.move_to_end(key)
+        self.hits += 1
+        return array
+
+    def put(self, key, array: np.ndarray) -> None:
+        if array.nbytes > self.max_bytes:
+            return
+        array.flags.writeable = False  # shared by every reader
+        if key in self._arrays:
+            self.n_bytes -= self._arrays.pop(key).nbytes
+        self._arrays[key] = array
+        self.n_bytes += array.nbytes
+        while self.n_bytes > self.max_bytes:
+            _, old = self._arrays.popitem(last=False)
+            self.n_bytes -= old.nbytes
+
+    def clear(self) -> None:
+        self._arrays.clear()
+        self.n_bytes = 0
+
+_decode_cache = DecodeCache()
+# open images by file identity, so analyze_mask_sub and analyze_mask share one reader
+_open_images: Dict[Tuple, object] = {}
+
+def _file_identity(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+def clear_decode_cache() -> None:
+    """drop every decoded block and open image, e.g. after each slice of a batch"""
+    _decode_cache.clear()
+    _open_images.clear()
+
+def decode_cache_stats() -> Dict[str, int]:
+    return {'hits': _decode_cache.hits, 'misses': _decode_cache.misses, 'bytes': _decode_cache.n_bytes}
+
+def _unpack_bits(data: bytes) -> bytes:
+    # PackBits: header n < 128 -> copy n + 1 bytes, n > 128 -> repeat next byte 257 - n times
+    out = bytearray()
+    i, n_data = 0, len(data)
+    while i < n_data:
+        header = data[i]
+        i += 1
+        if header < 128:
+            out += data[i:i + header + 1]
+            i += header + 1
+        elif header > 128:
+            out += data[i:i + 1] * (257 - header)
+            i += 1
+    return bytes(out)
+
+class LazyTiff:
+    """
+    read-only 2D array view of a single-channel TIFF (striped or tiled)
+    slicing it, e.g. tiff[r0:r1, c0:c1], reads and decodes only the strips
+    or tiles that overlap the slice, so images larger than RAM can be streamed
+    uncompressed strips stored back to back are memory-mapped instead
+    supports uncompressed, Deflate (with or without predictor 2) and PackBits
+    data, anything else (e.g. the floating point predictor 3) raises
+    NotImplementedError when opened
+    decoded blocks go to the per-process DecodeCache, so reading the same
+    part again (another tile pass, another function) does not decode it again
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            byte_order = '<' if f.read(2) == b'II' else '>'
+        with Image.open(path) as img:
+            tags = dict(img.tag_v2)
+            n_cols, n_rows = img.size
+
+        bits = tags.get(258, (1,))
+        bits = bits[0] if isinstance(bits, tuple) else bits
+        sample_format = tags.get(339, (1,))
+        sample_format = sample_format[0] if isinstance(sample_format, tuple) else sample_format
+        self.compression = tags.get(259, _COMPRESSION_NONE)
+        self.predictor = tags.get(317, 1)
+        if tags.get(277, 1) != 1 or bits not in (8, 16, 32, 64) or sample_format not in _SAMPLE_FORMATS:
+            raise NotImplementedError(f"Only single-channel 8/16/32/64-bit TIFFs can be read lazily: {path}")
+        if self.compression not in (_COMPRESSION_NONE, _COMPRESSION_PACKBITS) + _COMPRESSION_DEFLATE:
+            raise NotImplementedError(f"TIFF compression {self.compression} can't be read lazily: {path}")
+        if self.predictor not in (1, 2):
+            raise NotImplementedError(f"TIFF predictor {self.predictor} can't be read lazily: {path}")
+
+        self.shape = (n_rows, n_cols)
+        self.ndim = 2
+        self.size = n_rows * n_cols
+        self.dtype = np.dtype(f"{byte_order}{_SAMPLE_FORMATS[sample_format]}{bits // 8}")
+
+        if 322 in tags:
+            # tiled: fixed-size blocks, padded at the right / bottom edge
+            self.block_shape = (tags[323], tags[322])
+            self.offsets, self.byte_counts = tags[324], tags[325]
+        else:
+            # striped: full-width blocks of RowsPerStrip rows
+            self.block_shape = (min(tags.get(278, n_rows), n_rows), n_cols)
+            self.offsets, self.byte_counts = tags[273], tags[279]
+        self.blocks_across = -(-n_cols // self.block_shape[1])
+        self.identity = _file_identity(path)
+
+        # uncompressed full-width strips back to back = one plain array in the file
+        self._memmap = None
+        if self.compression == _COMPRESSION_NONE and self.predictor == 1 and 322 not in tags:
+            offsets = np.asarray(self.offsets, dtype=np.int64)
+            byte_counts = np.asarray(self.byte_counts, dtype=np.int64)
+            if np.array_equal(offsets[1:], offsets[:-1] + byte_counts[:-1]) and \
+                    byte_counts.sum() >= self.size * self.dtype.itemsize:
+                self._memmap = np.memmap(path, dtype=self.dtype, mode='r', offset=int(offsets[0]), shape=self.shape)
+
+    def _read_block(self, index: int) -> np.ndarray:
+        key = (self.identity, index)
+        block = _decode_cache.get(key)
+        if block is None:
+            block = self._decode_block(index)
+            _decode_cache.put(key, block)
+        return block
+
+    def _decode_block(self, index: int) -> np.ndarray:
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[index])
+            data = f.read(self.byte_counts[index])
+        if self.compression in _COMPRESSION_DEFLATE:
+            data = zlib.decompress(data)
+        elif self.compression == _COMPRESSION_PACKBITS:
+            data = _unpack_bits(data)
+        block_rows, block_cols = self.block_shape
+        # the last strip can be shorter than RowsPerStrip
+        n_values = len(data) // self.dtype.itemsize
+        block = np.frombuffer(data, dtype=self.dtype, count=n_values - n_values % block_cols)
+        block = block.reshape(-1, block_cols)
+        if self.predictor == 2:
+            # horizontal differencing
+            block = np.cumsum(block, axis=1, dtype=block.dtype)
+        return block
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        row_slice, col_slice = key
+        r0, r1, r_step = row_slice.indices(self.shape[0])
+        c0, c1, c_step = col_slice.indices(self.shape[1])
+        if r_step != 1 or c_step != 1:
+            raise IndexError("LazyTiff only supports contiguous slices")
+        if self._memmap is not None:
+            return np.asarray(self._memmap[r0:r1, c0:c1]).astype(self.dtype.newbyteorder('='), copy=False)
+        out = np.empty((max(r1 - r0, 0), max(c1 - c0, 0)), dtype=self.dtype.newbyteorder('='))
+        if out.size == 0:
+            return out
+
+        block_rows, block_cols = self.block_shape
+        for block_r in range(r0 // block_rows, (r1 - 1) // block_rows + 1):
+            for block_c in range(c0 // block_cols, (c1 - 1) // block_cols + 1):
+                block = self._read_block(block_r * self.blocks_across + block_c)
+                # overlap of the block and the requested slice, in image coords
+                br0, bc0 = block_r * block_rows, block_c * block_cols
+                ir0, ir1 = max(r0, br0), min(r1, br0 + block.shape[0])
+                ic0, ic1 = max(c0, bc0), min(c1, bc0 + block_cols)
+                out[ir0 - r0:ir1 - r0, ic0 - c0:ic1 - c0] = block[ir0 - br0:ir1 - br0, ic0 - bc0:ic1 - bc0]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:, :]
+        return array if dtype is None else array.astype(dtype)
+
+def open_tiff(path: str):
+    """
+    2D image from a TIFF: a LazyTiff when the layout allows decoding strips /
+    tiles on demand, otherwise the fully decoded array (PIL)
+    opening the same (unchanged) file again returns the same reader / array,
+    so e.g. the subiculum mask is decoded once per slice, not once per function
+    """
+    identity = _file_identity(path)
+    image = _open_images.get(identity)
+    if image is not None:
+        return image
+    try:
+        image = LazyTiff(path)
+    except (NotImplementedError, KeyError):
+        image = _decode_cache.get((identity, 'full'))
+        if image is None:
+            with Image.open(path) as img:
+                image = np.array(img)
+            _decode_cache.put((identity, 'full'), image)
+    _open_images[identity] = image
+    return image
@@ -0,0 +1,322 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+from image_io import iter_tiles, TileShape, DEFAULT_TILE_SHAPE
+
+# (row_start, row_end, col_start, col_end) of a part of the image
+Region = Tuple[int, int, int, int]
+
+# start value of the bounding box accumulators (everything else starts at 0)
+_NO_PIXEL = np.iinfo(np.int64).max
+_FILL = {"min_row": _NO_PIXEL, "min_col": _NO_PIXEL, "max_row": -1, "max_col": -1}
+
+def _grow(array: np.ndarray, n_bins: int, fill=0) -> np.ndarray:
+    # pad a per-label accumulator with fill up to n_bins labels
+    if array.size >= n_bins:
+        return array
+    return np.concatenate([array, np.full(n_bins - array.size, fill, dtype=array.dtype)])
+
+def new_label_accumulator(shape: bool = False) -> Dict[str, np.ndarray]:
+    """
+    empty per-label sums, filled by accumulate_label_stats
+    shape adds second moments, bounding box and boundary pixel counts
+    (see finish_label_stats for the descriptors made from them)
+    """
+    acc = {
+        "counts": np.zeros(1, dtype=np.int64),
+        "sum_x": np.zeros(1, dtype=np.float64),
+        "sum_y": np.zeros(1, dtype=np.float64)
+    }
+    if shape:
+        acc.update({
+            "sum_xx": np.zeros(1, dtype=np.float64),
+            "sum_yy": np.zeros(1, dtype=np.float64),
+            "sum_xy": np.zeros(1, dtype=np.float64),
+            "boundary": np.zeros(1, dtype=np.int64),
+            **{key: np.full(1, fill, dtype=np.int64) for key, fill in _FILL.items()}
+        })
+    return acc
+
+def masked_tile(label_image, r0: int, r1: int, c0: int, c1: int,
+                exclude: Optional[np.ndarray] = None,
+                inside: Optional[np.ndarray] = None, inside_value: int = 255) -> np.ndarray:
+    """
+    label_image[r0:r1, c0:c1] with pixels set to background (0) where
+    exclude != 0 or, when inside is given, where inside != inside_value
+    """
+    tile = np.asarray(label_image[r0:r1, c0:c1])
+    if exclude is not None:
+        tile = np.where(np.asarray(exclude[r0:r1, c0:c1]) != 0, 0, tile)
+    if inside is not None:
+        tile = np.where(np.asarray(inside[r0:r1, c0:c1]) == inside_value, tile, 0)
+    return tile
+
+def _haloed_tile(label_image, r0: int, r1: int, c0: int, c1: int, exclude=None, inside=None,
+                 inside_value: int = 255) -> np.ndarray:
+    # masked_tile with a 1 pixel border of its neighbours (background outside the image)
+    n_rows, n_cols = label_image.shape
+    h0, h1, g0, g1 = max(r0 - 1, 0), min(r1 + 1, n_rows), max(c0 - 1, 0), min(c1 + 1, n_cols)
+    core = masked_tile(label_image, h0, h1, g0, g1, exclude, inside, inside_value)
+    return np.pad(core, ((h0 - (r0 - 1), (r1 + 1) - h1), (g0 - (c0 - 1), (c1 + 1) - g1)))
+
+def _boundary_pixels(haloed: np.ndarray) -> np.ndarray:
+    # object pixels of the tile with a 4-neighbour of another label (or background)
+    centre = haloed[1:-1, 1:-1]
+    edge = (haloed[:-2, 1:-1] != centre) | (haloed[2:, 1:-1] != centre) | \
+           (haloed[1:-1, :-2] != centre) | (haloed[1:-1, 2:] != centre)
+    return centre[edge & (centre != 0)]
+
+def accumulate_label_stats(
+    acc: Dict[str, np.ndarray],
+    label_image: np.ndarray,
+    exclude: Optional[np.ndarray] = None,
+    inside: Optional[np.ndarray] = None,
+    inside_value: int = 255,
+    tile_shape: TileShape = DEFAULT_TILE_SHAPE,
+    region: Optional[Region] = None
+) -> None:
+    """
+    add per-label pixel counts and coordinate sums of one region of the image
+    (default: all of it) to acc, tile by tile
+    sums are in full-image coordinates, so several regions can be added to the
+    same accumulator as long as they don't overlap
+    an accumulator made with shape=True also gets the shape sums; tiles are
+    then read with their neighbouring rows / columns, so boundary pixels at
+    tile and region edges are found as in one piece
+    """
+    shape = "boundary" in acc
+    # column / row index pattern of a tile, relative to the tile origin
+    patterns = {}
+
+    for r0, r1, c0, c1 in iter_tiles(label_image.shape, tile_shape, region):
+        if shape:
+            haloed = _haloed_tile(label_image, r0, r1, c0, c1, exclude, inside, inside_value)
+            flat = np.ascontiguousarray(haloed[1:-1, 1:-1]).ravel()
+        else:
+            flat = masked_tile(label_image, r0, r1, c0, c1, exclude, inside, inside_value).ravel()
+        if flat.size == 0:
+            continue
+
+        # labels are not known up front, grow the accumulators as they show up
+        n_bins = int(flat.max()) + 1
+        if n_bins > acc["counts"].size:
+            for key in acc:
+                acc[key] = _grow(acc[key], n_bins, _FILL.get(key, 0))
+        n_bins = acc["counts"].size
+
+        tile_shape_rc = (r1 - r0, c1 - c0)
+        if tile_shape_rc not in patterns:
+            tile_rows, tile_cols = tile_shape_rc
+            patterns[tile_shape_rc] = (
+                np.tile(np.arange(tile_cols, dtype=np.float64), tile_rows),
+                np.repeat(np.arange(tile_rows, dtype=np.float64), tile_cols)
+            )
+        col_idx, row_idx = patterns[tile_shape_rc]
+
+        # pixel count per label
+        tile_counts = np.bincount(flat, minlength=n_bins)
+        acc["counts"] += tile_counts
+        # sum of column / row index per label, shifted by the tile origin
+        local_x = np.bincount(flat, weights=col_idx, minlength=n_bins)
+        local_y = np.bincount(flat, weights=row_idx, minlength=n_bins)
+        acc["sum_x"] += local_x + c0 * tile_counts
+        acc["sum_y"] += local_y + r0 * tile_counts
+        if shape:
+            _accumulate_shape(acc, flat, haloed, col_idx, row_idx, local_x, local_y, tile_counts, r0, c0)
+
+def _accumulate_shape(acc, flat, haloed, col_idx, row_idx, local_x, local_y, tile_counts, r0, c0) -> None:
+    n_bins = acc["counts"].size
+    # second moments: sums over (local + origin)^2 from the local sums
+    local_xx = np.bincount(flat, weights=col_idx * col_idx, minlength=n_bins)
+    local_yy = np.bincount(flat, weights=row_idx * row_idx, minlength=n_bins)
+    local_xy = np.bincount(flat, weights=col_idx * row_idx, minlength=n_bins)
+    acc["sum_xx"] += local_xx + 2 * c0 * local_x + c0 * c0 * tile_counts
+    acc["sum_yy"] += local_yy + 2 * r0 * local_y + r0 * r0 * tile_counts
+    acc["sum_xy"] += local_xy + r0 * local_x + c0 * local_y + r0 * c0 * tile_counts
+
+    acc["boundary"] += np.bincount(_boundary_pixels(haloed), minlength=n_bins)
+
+    # bounding box, only over object pixels (usually a small part of the tile)
+    on = flat != 0
+    labels = flat[on]
+    rows = row_idx[on].astype(np.int64) + r0
+    cols = col_idx[on].astype(np.int64) + c0
+    np.minimum.at(acc["min_row"], labels, rows)
+    np.maximum.at(acc["max_row"], labels, rows)
+    np.minimum.at(acc["min_col"], labels, cols)
+    np.maximum.at(acc["max_col"], labels, cols)
+
+def finish_label_stats(acc: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """turn accumulated sums into the compute_label_stats result"""
+    counts = acc["counts"]
+    # keep labels that are actually present, skip background
+    labels = np.nonzero(counts)[0]
+    labels = labels[labels != 0]
+    area_pixels = counts[labels]
+
+    stats = {
+        "labels": labels,
+        "area_pixels": area_pixels,
+        "centroid_x": acc["sum_x"][labels] / area_pixels,
+        "centroid_y": acc["sum_y"][labels] / area_pixels
+    }
+    if "boundary" in acc:
+        stats.update(_shape_descriptors(acc, labels, stats))
+    return stats
+
+def _shape_descriptors(acc, labels, stats) -> Dict[str, np.ndarray]:
+    area = stats["area_pixels"].astype(np.float64)
+    # central second moments (covariance of the pixel coordinates)
+    mu20 = np.maximum(acc["sum_xx"][labels] / area - stats["centroid_x"] ** 2, 0)
+    mu02 = np.maximum(acc["sum_yy"][labels] / area - stats["centroid_y"] ** 2, 0)
+    mu11 = acc["sum_xy"][labels] / area - stats["centroid_x"] * stats["centroid_y"]
+    # eigenvalues of the covariance matrix = variance along the major / minor axis
+    half_sum = (mu20 + mu02) / 2
+    root = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+    major, minor = half_sum + root, np.maximum(half_sum - root, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eccentricity = np.where(major > 0, np.sqrt(1 - minor / major), 0.0)
+
+    bbox_rows = acc["max_row"][labels] - acc["min_row"][labels] + 1
+    bbox_cols = acc["max_col"][labels] - acc["min_col"][labels] + 1
+    return {
+        "perimeter_pixels": acc["boundary"][labels],
+        "major_axis_pixels": 4 * np.sqrt(major),
+        "minor_axis_pixels": 4 * np.sqrt(minor),
+        "eccentricity": eccentricity,
+        "orientation_deg": np.degrees(0.5 * np.arctan2(2 * mu11, mu20 - mu02)),
+        "bbox_rows": bbox_rows,
+        "bbox_cols": bbox_cols,
+        "extent": area / (bbox_rows * bbox_cols)
+    }
+
+def compute_label_stats(
+    label_image: np.ndarray,
+    exclude: Optional[np.ndarray] = None,
+    tile_shape: TileShape = DEFAULT_TILE_SHAPE,
+    inside: Optional[np.ndarray] = None,
+    inside_value: int = 255,
+    region: Optional[Region] = None,
+    shape: bool = False
+) -> Dict[str, np.ndarray]:
+    """
+    per-label area and centroid for every nonzero label, in a single pass
+    over the flattened label image (no per-label boolean masks)
+    the image is reduced tile by tile (see image_io.iter_tiles): per-label pixel
+    counts and coordinate sums are accumulated across tiles, so labels that
+    span tile borders get the same area & centroid as in one piece, and
+    memory-mapped / lazily decoded inputs are never fully loaded
+    exclude: optional image of the same shape, pixels where exclude != 0 are
+    treated as background (e.g. ab pixels inside cells for 6 weeks)
+    inside: optional image of the same shape, only pixels where
+    inside == inside_value are counted (e.g. the subiculum mask)
+    region: only look at this part of the image (e.g. the subiculum bounding box)
+    shape: also compute shape descriptors from moment / boundary sums (same pass)
+
+    return data structure (all arrays sorted by label, same order as np.unique)
+    {
+        "labels": ...,        # label ids, background (0) excluded
+        "area_pixels": ...,   # pixel count per label
+        "centroid_x": ...,    # mean column per label, in pixel
+        "centroid_y": ...,    # mean row per label, in pixel
+        # with shape only:
+        "perimeter_pixels": ...,    # object pixels with a 4-neighbour outside the object
+        "major_axis_pixels": ...,   # 4 * sd along the major / minor axis of the second
+        "minor_axis_pixels": ...,   # moments (full length for an ellipse)
+        "eccentricity": ...,        # 0 = circle, -> 1 = line
+        "orientation_deg": ...,     # major axis, from +x towards +y (clockwise on screen), -90..90
+        "bbox_rows": ..., "bbox_cols": ...,   # bounding box size
+        "extent": ...               # area / bounding box area
+    }
+    """
+    acc = new_label_accumulator(shape)
+    accumulate_label_stats(acc, label_image, exclude, inside, inside_value, tile_shape, region)
+    return finish_label_stats(acc)
+
+def region_border_labels(label_image, region: Region, exclude: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    labels found on each edge of region that is not an edge of the image
+    return {"top": ..., "bottom": ..., "left": ..., "right": ...}
+    """
+    n_rows, n_cols = label_image.shape
+    r0, r1, c0, c1 = region
+    edges = {
+        "top": (r0, r0 + 1, c0, c1) if r0 > 0 else None,
+        "bottom": (r1 - 1, r1, c0, c1) if r1 < n_rows else None,
+        "left": (r0, r1, c0, c0 + 1) if c0 > 0 else None,
+        "right": (r0, r1, c1 - 1, c1) if c1 < n_cols else None
+    }
+    border = {}
+    for side, edge in edges.items():
+        if edge is None:
+            border[side] = np.zeros(0, dtype=np.int64)
+            continue
+        line = masked_tile(label_image, *edge, exclude=exclude)
+        border[side] = np.unique(line[line != 0])
+    return border
+
+# label pairs are packed into one uint64 key: (label_a << 32) | label_b
+_PAIR_SHIFT = np.uint64(32)
+# merge the per-tile pair tables once they hold this many entries
+PAIR_MERGE_SIZE = 1 << 22
+
+def new_pair_accumulator() -> Dict[str, list]:
+    """empty sparse label_a x label_b pixel count table, filled by accumulate_label_pairs"""
+    return {"keys": [], "counts": []}
+
+def _merge_pairs(acc: Dict[str, list]) -> None:
+    keys, inverse = np.unique(np.concatenate(acc["keys"]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(acc["counts"])).astype(np.int64)
+    acc["keys"], acc["counts"] = [keys], [counts]
+
+def accumulate_label_pairs(acc: Dict[str, list], labels_a: np.ndarray, labels_b: np.ndarray) -> None:
+    """
+    add co-occurring labels to acc: labels_a[i] and labels_b[i] are the two
+    labels of one pixel (e.g. a tile of each label image at pixels where both
+    are nonzero), only the distinct pairs and their pixel counts are kept
+    """
+    if labels_a.size == 0:
+        return
+    keys = (labels_a.astype(np.uint64) << _PAIR_SHIFT) | labels_b.astype(np.uint64)
+    keys, counts = np.unique(keys, return_counts=True)
+    acc["keys"].append(keys)
+    acc["counts"].append(counts)
+    if sum(k.size for k in acc["keys"]) > PAIR_MERGE_SIZE:
+        _merge_pairs(acc)
+
+def finish_label_pairs(acc: Dict[str, list]) -> Dict[str, np.ndarray]:
+    """
+    return data structure (one entry per distinct pair, sorted by label_a, label_b)
+    {
+        "label_a": ...,
+        "label_b": ...,
+        "pixels": ...     # number of pixels where both labels are present
+    }
+    """
+    if not acc["keys"]:
+        empty = np.zeros(0, dtype=np.int64)
+        return {"label_a": empty, "label_b": empty, "pixels": empty}
+    _merge_pairs(acc)
+    keys, counts = acc["keys"][0], acc["counts"][0]
+    return {
+        "label_a": (keys >> _PAIR_SHIFT).astype(np.int64),
+        "label_b": (keys & np.uint64(0xFFFFFFFF)).astype(np.int64),
+        "pixels": counts
+    }
+
+def pair_totals(labels: np.ndarray, pair_labels: np.ndarray, pair_pixels: np.ndarray):
+    """
+    per label in labels: total pair pixels and number of distinct partners,
+    from one side of a finish_label_pairs table (0 for labels without pairs)
+    """
+    totals = np.zeros(len(labels), dtype=np.int64)
+    partners = np.zeros(len(labels), dtype=np.int64)
+    if len(pair_labels) == 0:
+        return totals, partners
+    unique_labels, inverse = np.unique(pair_labels, return_inverse=True)
+    pixel_sums = np.bincount(inverse, weights=pair_pixels).astype(np.int64)
+    partner_counts = np.bincount(inverse)
+    pos = np.minimum(np.searchsorted(unique_labels, labels), len(unique_labels) - 1)
+    found = unique_labels[pos] == labels
+    totals[found] = pixel_sums[pos[found]]
+    partners[found] = partner_counts[pos[found]]
+    return totals, partners
@@ -1,10 +1,17 @@
 import os
+import sys
 from cal_area import analyze_mask
 from analyze_SUB import analyze_mask_sub
 from save_results import save_results
+from band_profile import slice_profile_axis, DEFAULT_PROFILE_BINS
+from batch import main as batch_main, default_slice_id, AGE_MAPPING, SEX_MAPPING, GENOTYPE_MAPPING
 
 # Main function
 if __name__ == "__main__":
+    # headless mode: python main.py manifest.csv (see batch.py), otherwise fall back to prompts
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
+
     # Get image paths from user input
     cell_npy_path = input("Please enter the path to your CELL BODY segmentation mask image file (e.g., C:/path/to/image_seg.npy): ").strip('"')
     ab_npy_path = input("Please enter the path to your AMYLOID BETA segmentation mask image file (e.g., C:/path/to/image_seg.npy): ").strip('"')
@@ -29,12 +36,8 @@ if __name__ == "__main__":
     pixel_to_micrometer = physical_width / pixel_width  # Assumes square pixels
     print(f"Calculated pixel size: {pixel_to_micrometer:.5f} μm/pixel")
 
-    left_sub_end_pixel = tuple(map(float, input("please enter the left end of the subiculum (e.g. 1000, 2000) in pixel: ").split(',')))
-    right_sub_end_pixel = tuple(map(float, input("please enter the right end of the subiculum (e.g. 1000, 2000) in pixel: ").split(',')))
-
     age_choice = input("6-week-old segmentation is handled differently by removing intracellular ab accumulation. Choose Age (1. 6 weeks, 2. 10 weeks, 3. 6 months):")
-    age_mapping = {'1': '6 weeks','2': '10 weeks','3': '6 months'}
-    age = age_mapping.get(age_choice, "NA")
+    age = AGE_MAPPING.get(age_choice, "NA")
 
     # sub_result structure:
     # {
@@ -53,7 +56,8 @@ if __name__ == "__main__":
     #         "direction_vector": (...),
     #         "is_vertical": ...,
     #         "is_horizontal": ...,
-    #         'midpoint_um': ...
+    #         'midpoint_um': ...,
+    #         'left_end_um': ..., 'right_end_um': ...
     #     },
     #     "dividing_line": {
     #         "slope": ...,
@@ -61,40 +65,51 @@ if __name__ == "__main__":
     #         "direction_vector": (...),
     #         "is_vertical": ...,
     #         "is_horizontal": ...
-    #     }
+    #     },
+    #     "centreline": {...},
+    #     "profile": {...}
     # }
-    
-    sub_result = analyze_mask_sub(sub_path, pixel_to_micrometer, left_sub_end_pixel, right_sub_end_pixel)
+
+    # the ends of the subiculum come from the centreline of the mask
+    sub_result = analyze_mask_sub(sub_path, pixel_to_micrometer, profile_bins=DEFAULT_PROFILE_BINS)
+    left_end = sub_result["centreline"]["left_end_pixel"]
+    right_end = sub_result["centreline"]["right_end_pixel"]
+    print(f"Subiculum ends from the mask centreline (pixel): left ({left_end[0]:.0f}, {left_end[1]:.0f}), "
+          f"right ({right_end[0]:.0f}, {right_end[1]:.0f})")
+    # without typed ends the end with the smaller x is taken as LEFT (proximal)
+    print("Warning: LEFT is the centreline end with the smaller x. If the slice is mirrored, run it through "
+          "batch.py with left_sub_end / right_sub_end in the manifest to set the sides.")
 
     # mask result is of the following structure:
     #     {
-    #     'cell_global_dist': [],
-    #     'ab_global_dist': [],
+    #     'objects': ...,   # one row per cell / plaque: label, type, side, area, centroid...
     #     'left': {
-    #         'cell_dist': [],
-    #         'ab_dist': [],
+    #         'cell_count': ...,
+    #         'cell_area': ...,
     #         ...else...
     #     },
     #     'right': { ... },
-    #     'total': { ... }
+    #     'total': { ... },
+    #     'profile': { ... }
     # }
+    # (object_table.legacy_view gives the old per-object lists)
     mask_result = analyze_mask(
         cell_npy_path, ab_npy_path, pixel_to_micrometer, age, 
-        sub_result["midline"]["midpoint_um"], sub_result["dividing_line"]["direction_vector"]
+        sub_result["midline"]["midpoint_um"], sub_result["dividing_line"]["direction_vector"],
+        profile_axis=slice_profile_axis(sub_result)
     )
 
     mouse_id = input("Enter Mouse ID: ")
     sex_choice = input("Choose Sex (1. Female, 2.Male): ")
-    sex_mapping = {'1': 'Female', '2':'Male'}
-    sex = sex_mapping.get(sex_choice, "NA")
+    sex = SEX_MAPPING.get(sex_choice, "NA")
 
     genotype_choice = input("Choose Genotype (1.WT, 2.5XFAD): ")
-    genotype_mapping = {'1': 'WT', '2':'5XFAD'}
-    genotype = genotype_mapping.get(genotype_choice, "NA")
+    genotype = GENOTYPE_MAPPING.get(genotype_choice, "NA")
 
     save_results(
         mouse_id, sex, genotype, age,
         pixel_to_micrometer, physical_width, physical_height,
         mask_result, 
-        sub_result        
+        sub_result,
+        slice_id=default_slice_id(cell_npy_path)
     )
\ No newline at end of file
@@ -0,0 +1,85 @@
+import numpy as np
+from typing import Dict, Optional
+
+# object types and sides, stored as small integer codes in the object table
+OBJECT_TYPES = ('cell', 'plaque')
+SIDES = ('LEFT', 'RIGHT')
+
+# one row per cell / plaque of a slice, the native result of analyze_mask
+OBJECT_DTYPE = np.dtype([
+    ('label', np.int64),                # label in the segmentation mask
+    ('type', np.uint8),                 # index into OBJECT_TYPES
+    ('side', np.uint8),                 # index into SIDES
+    ('id', np.int64),                   # 1, 2, ... per type and side, in label order
+    ('area_um2', np.float64),           # 6 weeks: plaques without the intracellular part
+    ('x_um', np.float64),               # centroid
+    ('y_um', np.float64),
+    ('pd_position', np.float64),        # 0 = left end, 1 = right end, NaN without profile axis
+    ('overlap_area_um2', np.float64),   # cell: intracellular ab, plaque: part inside cells
+    ('object_area_um2', np.float64),    # area the overlap is a fraction of (whole plaque)
+    ('overlap_fraction', np.float64),
+    ('n_partners', np.int64),           # objects of the other type it overlaps
+    # shape, see label_stats.compute_label_stats
+    ('perimeter_um', np.float64),       # boundary pixels * pixel size
+    ('major_axis_um', np.float64),      # from the second moments
+    ('minor_axis_um', np.float64),
+    ('eccentricity', np.float64),       # 0 = circle, -> 1 = line
+    ('orientation_deg', np.float64),    # major axis, from +x towards +y (image rows), -90..90
+    ('extent', np.float64),             # area / bounding box area
+    ('compactness', np.float64)         # 4 pi area / perimeter^2, higher = more compact
+])
+# shape columns of spatial_data
+SHAPE_FIELDS = ['perimeter_um', 'major_axis_um', 'minor_axis_um', 'eccentricity', 'orientation_deg',
+                'extent', 'compactness']
+
+def new_object_table(n_objects: int) -> np.ndarray:
+    return np.zeros(n_objects, dtype=OBJECT_DTYPE)
+
+def number_by_side(table: np.ndarray) -> None:
+    # fill 'id': running number within each side, rows of one type in label order
+    for side in range(len(SIDES)):
+        on_side = table['side'] == side
+        table['id'][on_side] = np.arange(1, on_side.sum() + 1)
+
+def select(table: np.ndarray, obj_type: str, side: Optional[str] = None) -> np.ndarray:
+    """rows of one type (and side), as a new array in table order"""
+    keep = table['type'] == OBJECT_TYPES.index(obj_type)
+    if side is not None:
+        keep &= table['side'] == SIDES.index(side.upper())
+    return table[keep]
+
+def sequential_sum(values: np.ndarray):
+    # left-to-right sum, same rounding as the old per-object += (0 when empty)
+    return float(np.cumsum(values)[-1]) if len(values) else 0
+
+def legacy_view(mask_result: Dict) -> Dict:
+    """
+    analyze_mask result with the per-object lists of the old format added
+    (cell_global_dist, left / right cell_dist, ab_centroids, overlap_objects, ...)
+    for code written against it; built on demand, the object table stays the source
+    """
+    objects = mask_result['objects']
+    view = {**mask_result}
+    view['cell_global_dist'] = select(objects, 'cell')['area_um2'].tolist()
+    view['ab_global_dist'] = select(objects, 'plaque')['area_um2'].tolist()
+    has_positions = mask_result.get('profile') is not None
+    for side in ('left', 'right'):
+        side_view = {**mask_result[side]}
+        for prefix, obj_type in (('cell', 'cell'), ('ab', 'plaque')):
+            rows = select(objects, obj_type, side)
+            side_view[f'{prefix}_dist'] = rows['area_um2'].tolist()
+            side_view[f'{prefix}_centroids'] = list(zip(rows['x_um'].tolist(), rows['y_um'].tolist()))
+            side_view[f'{prefix}_positions'] = rows['pd_position'].tolist() if has_positions else None
+        view[side] = side_view
+    view['overlap_objects'] = {}
+    for obj_type in OBJECT_TYPES:
+        rows = select(objects, obj_type)
+        view['overlap_objects'][obj_type] = {
+            'label': rows['label'].tolist(),
+            'side': np.asarray(SIDES)[rows['side']].tolist(),
+            'area_um2': rows['object_area_um2'].tolist(),
+            'overlap_area_um2': rows['overlap_area_um2'].tolist(),
+            'overlap_fraction': rows['overlap_fraction'].tolist(),
+            'n_partners': rows['n_partners'].tolist()
+        }
+    return view
@@ -0,0 +1,291 @@
+import sys
+import math
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+from object_table import OBJECT_TYPES, SIDES
+from result_store import ResultStore, STORE_FORMATS, open_store
+from cohort import load_metadata, slice_labels, LABEL_COLUMNS
+
+# null models: 'labels' permutes the side labels of the objects of each type within a slice,
+# 'rotation' turns the dividing line around the midline midpoint by a uniform random angle
+NULL_MODELS = ('labels', 'rotation')
+DEFAULT_N_PERMUTATIONS = 10000
+# permutations per task of the process pool, every chunk has its own seed,
+# so the result depends on the seed only, not on the number of workers
+DEFAULT_CHUNK_SIZE = 500
+# side matrix elements (permutations x objects) built at a time, bounds the memory per worker
+BLOCK_ELEMENTS = 2**22
+# default grouping of the tests (summary_stats labels or metadata columns)
+GROUP_COLUMNS = ['genotype', 'age']
+# side statistics, same definitions as summary_stats (mean area is 0 without objects)
+METRICS = ['n_cells', 'total_cell_area', 'mean_cell_area', 'n_plaques', 'total_plaque_area', 'mean_plaque_area']
+# metrics a label permutation cannot change: no p_value / effect_z under the 'labels' null
+LABEL_FIXED_METRICS = ['n_cells', 'n_plaques']
+
+def slice_data(objects: np.ndarray, midpoint_um: Tuple[float, float], labels: Optional[Dict] = None) -> Dict:
+    """
+    what the engine needs of one slice: per object type the areas, the observed
+    side (LEFT = True) and the centroid relative to the midline midpoint
+    objects: analyze_mask "objects" (or the same columns rebuilt by load_slices)
+    """
+    types = {}
+    for i, obj_type in enumerate(OBJECT_TYPES):
+        rows = objects[objects['type'] == i]
+        types[obj_type] = {
+            'area': np.ascontiguousarray(rows['area_um2'], dtype=np.float64),
+            'left': rows['side'] == SIDES.index('LEFT'),
+            'rel': np.stack([rows['x_um'] - midpoint_um[0], rows['y_um'] - midpoint_um[1]]).astype(np.float64)
+        }
+    return {'labels': labels or {}, 'types': types}
+
+def side_differences(left: np.ndarray, area: np.ndarray) -> np.ndarray:
+    """
+    LEFT - RIGHT of count, total area and mean area of one object type, for a
+    batch of side assignments at once
+    left: (n_permutations, n_objects) bool, area: (n_objects,)
+    return (n_permutations, 3)
+    """
+    n_objects = left.shape[1]
+    n_left = left.sum(axis=1, dtype=np.int64)
+    n_right = n_objects - n_left
+    # one matrix-vector product sums the left areas of every permutation
+    area_left = left.astype(np.float64) @ area
+    area_right = area.sum() - area_left
+    mean_left = np.divide(area_left, n_left, out=np.zeros_like(area_left), where=n_left > 0)
+    mean_right = np.divide(area_right, n_right, out=np.zeros_like(area_right), where=n_right > 0)
+    return np.stack([n_left - n_right, area_left - area_right, mean_left - mean_right], axis=1)
+
+def _null_sides(obj: Dict, null: str, n: int, rng: np.random.Generator) -> np.ndarray:
+    # (n, n_objects) side assignments drawn from the null model
+    if null == 'labels':
+        # a permutation of the labels = a uniform random subset of n_left objects on the left:
+        # the n_left smallest of uniform keys, found with a partition (no full shuffle per draw)
+        n_objects = obj['left'].size
+        n_left = int(obj['left'].sum())
+        if n_left in (0, n_objects):
+            return np.broadcast_to(obj['left'], (n, n_objects))
+        keys = rng.random((n, n_objects))
+        kth = np.partition(keys, n_left - 1, axis=1)[:, n_left - 1]
+        return keys <= kth[:, None]
+    # is_left with the dividing line turned to angle theta (side_split.is_left: cross < 0);
+    # a uniform angle makes the original direction of the line irrelevant
+    theta = rng.uniform(0, 2 * np.pi, n)
+    direction = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+    cross = np.outer(direction[:, 1], obj['rel'][0]) - np.outer(direction[:, 0], obj['rel'][1])
+    return cross < 0
+
+def slice_null(data: Dict, null: str, n: int, rng: np.random.Generator) -> np.ndarray:
+    """(n, len(METRICS)) LEFT - RIGHT differences of one slice under the null model"""
+    result = np.empty((n, len(METRICS)))
+    for i, obj_type in enumerate(OBJECT_TYPES):
+        obj = data['types'][obj_type]
+        # blocks of permutations, so the side matrix stays below BLOCK_ELEMENTS
+        block = max(BLOCK_ELEMENTS // max(obj['area'].size, 1), 1)
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            result[start:stop, 3 * i:3 * i + 3] = side_differences(
+                _null_sides(obj, null, stop - start, rng), obj['area'])
+    return result
+
+def slice_observed(data: Dict) -> np.ndarray:
+    # the observed differences, computed the same way as every permutation
+    return np.concatenate([side_differences(data['types'][obj_type]['left'][None, :],
+                                            data['types'][obj_type]['area'])[0]
+                           for obj_type in OBJECT_TYPES])
+
+# slices and groups of the running test, set once per worker process (see _init_worker)
+_worker_state: Dict = {}
+
+def _init_worker(slices: List[Dict], groups: np.ndarray, n_groups: int, null: str) -> None:
+    _worker_state.update(slices=slices, groups=groups, n_groups=n_groups, null=null)
+
+def _chunk(n: int, seed: np.random.SeedSequence) -> np.ndarray:
+    """
+    group means of one chunk of permutations: (n_groups, n, len(METRICS))
+    each slice gets its own permutation in every draw, the group statistic is the
+    mean over its slices of LEFT - RIGHT, like the observed one
+    """
+    state = _worker_state
+    rng = np.random.default_rng(seed)
+    sums = np.zeros((state['n_groups'], n, len(METRICS)))
+    for data, group in zip(state['slices'], state['groups']):
+        sums[group] += slice_null(data, state['null'], n, rng)
+    counts = np.bincount(state['groups'], minlength=state['n_groups'])
+    return sums / counts[:, None, None]
+
+def permutation_test(slices: List[Dict], by: Sequence[str] = GROUP_COLUMNS, null: str = 'labels',
+                     n_permutations: int = DEFAULT_N_PERMUTATIONS, seed: Optional[int] = 0,
+                     workers: int = 1, chunk_size: int = DEFAULT_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    proximal (LEFT) vs distal (RIGHT) test per group and metric
+    statistic: mean over the slices of the group of LEFT - RIGHT (paired by slice)
+    null distribution: n_permutations resamples of every slice under the null model
+    ('labels': counts are fixed by it, so only the area metrics are tested, the
+    count rows have NaN p_value and effect_z)
+
+    one row per group and metric, columns:
+    by..., metric, n_mice, n_slices, mean_left, mean_right, observed,
+    null_mean, null_sd,
+    p_value,       # two-sided, (1 + #|null - null_mean| >= |observed - null_mean|) / (1 + n_permutations)
+    effect_z,      # (observed - null_mean) / null_sd
+    cohens_dz      # mean / sd of the per-slice differences
+    """
+    if null not in NULL_MODELS:
+        raise ValueError(f"Unknown null model {null!r}, expected one of {NULL_MODELS}")
+    if not slices:
+        raise ValueError("No slices to test")
+    group_keys: Dict[Tuple, int] = {}
+    for data in slices:
+        missing = [col for col in by if col not in data['labels']]
+        if missing:
+            raise KeyError(f"Unknown group columns {missing}")
+        group_keys.setdefault(tuple(data['labels'][col] for col in by), len(group_keys))
+    groups = np.array([group_keys[tuple(data['labels'][col] for col in by)] for data in slices])
+    n_groups = len(group_keys)
+
+    sizes = [min(chunk_size, n_permutations - start) for start in range(0, n_permutations, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers <= 1:
+        _init_worker(slices, groups, n_groups, null)
+        chunks = [_chunk(n, s) for n, s in zip(sizes, seeds)]
+    else:
+        # the slices are sent once per worker, each task only carries its size and seed
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(slices, groups, n_groups, null)) as pool:
+            chunks = list(pool.map(_chunk, sizes, seeds))
+    null_means = np.concatenate(chunks, axis=1)   # (n_groups, n_permutations, metrics)
+
+    observed = np.array([slice_observed(data) for data in slices])
+    left_values = np.array([_left_values(data) for data in slices])
+    rows = []
+    for group, g in group_keys.items():
+        in_group = groups == g
+        diffs = observed[in_group]
+        obs = diffs.mean(axis=0)
+        null_dist = null_means[g]
+        null_mean = null_dist.mean(axis=0)
+        null_sd = null_dist.std(axis=0, ddof=1) if n_permutations > 1 else np.full(len(METRICS), math.nan)
+        # a constant null still has a float-noise sd (e.g. 1e-13): relative to the values
+        varies = null_sd > 1e-9 * np.maximum(np.abs(null_dist).max(axis=0), 1)
+        # tolerance: a permutation equal to the observed one must count as extreme
+        # two-sided around the null mean: with unequal side counts a label permutation
+        # of e.g. total area is not centred on 0
+        tol = 1e-9 * np.maximum(np.abs(obs), 1)
+        n_extreme = (np.abs(null_dist - null_mean) >= np.abs(obs - null_mean) - tol).sum(axis=0)
+        diff_sd = diffs.std(axis=0, ddof=1) if len(diffs) > 1 else np.full(len(METRICS), math.nan)
+        mean_left = left_values[in_group].mean(axis=0)
+        mice = {data['labels'].get('mouse_id') for data, keep in zip(slices, in_group) if keep}
+        for m, metric in enumerate(METRICS):
+            tested = not (null == 'labels' and metric in LABEL_FIXED_METRICS)
+            rows.append({
+                **dict(zip(by, group)),
+                'metric': metric,
+                'n_mice': len(mice),
+                'n_slices': int(in_group.sum()),
+                'mean_left': mean_left[m],
+                'mean_right': mean_left[m] - obs[m],
+                'observed': obs[m],
+                'null_mean': null_mean[m],
+                'null_sd': null_sd[m],
+                'p_value': (1 + n_extreme[m]) / (1 + n_permutations) if tested else math.nan,
+                'effect_z': (obs[m] - null_mean[m]) / null_sd[m] if tested and varies[m] else math.nan,
+                'cohens_dz': obs[m] / diff_sd[m] if diff_sd[m] > 0 else math.nan
+            })
+    columns = list(by) + ['metric', 'n_mice', 'n_slices', 'mean_left', 'mean_right', 'observed',
+                          'null_mean', 'null_sd', 'p_value', 'effect_z', 'cohens_dz']
+    return pd.DataFrame(rows, columns=columns).sort_values(list(by) + ['metric'], ignore_index=True)
+
+def _left_values(data: Dict) -> np.ndarray:
+    # LEFT side value of every metric (RIGHT = LEFT - difference)
+    values = []
+    for obj_type in OBJECT_TYPES:
+        obj = data['types'][obj_type]
+        n_left = int(obj['left'].sum())
+        area_left = float(obj['area'][obj['left']].sum())
+        values += [n_left, area_left, area_left / n_left if n_left else 0]
+    return np.array(values)
+
+def load_slices(store: ResultStore, metadata: Optional[pd.DataFrame] = None) -> List[Dict]:
+    """
+    per-object tables of every saved slice, rebuilt from spatial_data (centroid, side),
+    distribution_data (area) and geometry_metadata (midline midpoint); the object
+    rows of both tables are joined on type, side and id (no row order is assumed,
+    SQLite returns rows in any order)
+    labels come from summary_stats and the metadata (cohort.load_metadata),
+    excluded slices are left out
+    """
+    key = ['mouse_id', 'slice_id', 'type', 'side', 'id']
+    spatial = store.read('spatial_data', columns=key + ['x_um', 'y_um'])
+    dist = store.read('distribution_data', columns=key + ['area_um2'])
+    dist = dist[dist['side'] != 'GLOBAL']
+    geometry = store.read('geometry_metadata', columns=['mouse_id', 'slice_id', 'midline_midpoint_x',
+                                                        'midline_midpoint_y'])
+    summary = store.read('summary_stats', columns=['mouse_id', 'slice_id'] + LABEL_COLUMNS)
+    for table in (spatial, dist, geometry, summary):
+        for col in ('mouse_id', 'slice_id'):
+            table[col] = table[col].fillna('').astype(str)
+    for table in (spatial, dist):
+        table['id'] = table['id'].astype(np.int64)
+    if len(spatial) != len(dist):
+        raise ValueError(f"spatial_data ({len(spatial)} objects) and distribution_data "
+                         f"({len(dist)} objects) do not match")
+    # objects in label order within each type and side, like the object table
+    objects = spatial.merge(dist, on=key, how='inner', validate='one_to_one').sort_values(key, kind='stable')
+    if len(objects) != len(spatial):
+        raise ValueError("spatial_data and distribution_data do not match")
+
+    labels_of = {k: rows.iloc[0][LABEL_COLUMNS].to_dict()
+                 for k, rows in summary.groupby(['mouse_id', 'slice_id'], sort=False)}
+    objects_of = dict(iter(objects.groupby(['mouse_id', 'slice_id'], sort=False)))
+    slices = []
+    for _, row in geometry.iterrows():
+        k = (row['mouse_id'], row['slice_id'])
+        labels = slice_labels(k[0], k[1], labels_of.get(k, {}), metadata)
+        if labels is None:
+            continue
+        rows = objects_of.get(k, objects.iloc[:0])
+        table = np.zeros(len(rows), dtype=[('type', np.uint8), ('side', np.uint8), ('area_um2', np.float64),
+                                           ('x_um', np.float64), ('y_um', np.float64)])
+        table['type'] = rows['type'].map(OBJECT_TYPES.index).to_numpy()
+        table['side'] = rows['side'].map(SIDES.index).to_numpy()
+        for col in ('area_um2', 'x_um', 'y_um'):
+            table[col] = rows[col].to_numpy()
+        slices.append(slice_data(table, (row['midline_midpoint_x'], row['midline_midpoint_y']), labels))
+    return slices
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Permutation tests of proximal vs distal differences per group.")
+    parser.add_argument('--results-dir', default='.', help="folder of the result tables (default: current)")
+    parser.add_argument('--format', choices=sorted(STORE_FORMATS), default='csv', help="result backend")
+    parser.add_argument('--metadata', default=None, help="CSV with mouse_id, exclude and label columns")
+    parser.add_argument('--by', nargs='+', default=GROUP_COLUMNS,
+                        help=f"group columns (default: {' '.join(GROUP_COLUMNS)})")
+    parser.add_argument('--null', choices=NULL_MODELS, default='labels',
+                        help="permute the side labels of the objects within each slice (labels) or turn "
+                             "the dividing line by a random angle (rotation) (default: labels)")
+    parser.add_argument('-n', '--n-permutations', type=int, default=DEFAULT_N_PERMUTATIONS,
+                        help=f"number of resamples (default: {DEFAULT_N_PERMUTATIONS})")
+    parser.add_argument('--seed', type=int, default=0, help="random seed, same seed = same result (default: 0)")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of worker processes (default: 1, no pool)")
+    parser.add_argument('-o', '--output', default=None, help="write the tests to this CSV (default: print)")
+    args = parser.parse_args(argv)
+
+    metadata = load_metadata(args.metadata) if args.metadata else None
+    slices = load_slices(open_store(args.format, args.results_dir), metadata)
+    tests = permutation_test(slices, by=args.by, null=args.null, n_permutations=args.n_permutations,
+                             seed=args.seed, workers=args.workers)
+    if args.output:
+        tests.to_csv(args.output, index=False)
+        print(f"Permutation tests ({len(tests)} rows, {args.n_permutations} {args.null} resamples) "
+              f"written to {args.output}")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(tests)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
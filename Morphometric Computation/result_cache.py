@@ -0,0 +1,94 @@
+import os
+import json
+import pickle
+import hashlib
+from typing import Dict, List, Optional
+
+# bump this whenever analyze_mask / analyze_mask_sub change their output,
+# entries written by any other version are ignored and pruned
+ALGORITHM_VERSION = '6'
+
+DEFAULT_CACHE_DIR = '.result_cache'
+DEFAULT_MAX_BYTES = 2 * 2**30  # 2 GB
+
+def hash_file(path: str, block_size: int = 2**20) -> str:
+    # content hash, so renamed/copied inputs still hit and edited inputs miss
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def slice_cache_key(input_paths: List[str], params: Dict) -> str:
+    """
+    key of one slice: content hash of every input file + the parameters that
+    change the result (pixel size, subiculum ends, age...) + ALGORITHM_VERSION
+    """
+    digest = hashlib.sha256()
+    for path in input_paths:
+        digest.update(hash_file(path).encode())
+    # tuples and lists must hash the same, json handles both as lists
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return f"v{ALGORITHM_VERSION}-{digest.hexdigest()}"
+
+def _entry_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.pkl')
+
+def load_cached(cache_dir: str, key: str) -> Optional[object]:
+    # return the cached result or None, a hit refreshes the entry for LRU
+    path = _entry_path(cache_dir, key)
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        os.utime(path)
+        return result
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def store_cached(cache_dir: str, key: str, result: object, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+    """write one entry (temp file + rename), then evict down to max_bytes"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _entry_path(cache_dir, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes)
+
+def _entries(cache_dir: str) -> List[os.DirEntry]:
+    if not os.path.isdir(cache_dir):
+        return []
+    return [e for e in os.scandir(cache_dir) if e.is_file() and e.name.endswith('.pkl')]
+
+def evict(cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES) -> int:
+    """
+    delete stale-version entries, then least recently used entries until the
+    cache fits in max_bytes; return the number of deleted entries
+    """
+    deleted = clear(cache_dir, stale_only=True)
+    entries = sorted(_entries(cache_dir), key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        try:
+            os.remove(entry.path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
+
+def clear(cache_dir: str, stale_only: bool = False) -> int:
+    """delete every entry, or only the ones from another ALGORITHM_VERSION"""
+    prefix = f"v{ALGORITHM_VERSION}-"
+    deleted = 0
+    for entry in _entries(cache_dir):
+        if stale_only and entry.name.startswith(prefix):
+            continue
+        try:
+            os.remove(entry.path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
@@ -0,0 +1,357 @@
+import os
+import json
+import shutil
+import sqlite3
+import contextlib
+import pandas as pd
+from typing import Dict, List, Optional, Set, Tuple
+
+# the result tables written by save_results
+TABLES = ['summary_stats', 'distribution_data', 'geometry_metadata', 'spatial_data', 'overlap_data',
+          'profile_data']
+# every row of every table belongs to one slice
+KEY_COLUMNS = ['mouse_id', 'slice_id']
+# CSV / Parquet flushes: renames still to be done, see ResultStore._commit_staged
+JOURNAL_NAME = '.flush_journal.json'
+_STAGED_SUFFIX = '.staged'
+
+def slice_file_name(mouse_id: str, slice_id: str) -> str:
+    # <mouse_id>__<slice_id> as one file name: path separators in the ids become '_'
+    name = f"{mouse_id}__{slice_id}"
+    for sep in (os.sep, os.altsep, '/'):
+        if sep:
+            name = name.replace(sep, '_')
+    return name
+
+def _fsync(path: str) -> None:
+    # make sure the data is on disk before anything points at it
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class ResultStore:
+    """
+    results backend keyed by (mouse_id, slice_id)
+    add() only queues the tables of one slice, flush() writes everything queued
+    in one go, replacing any rows already stored for the same slices (upsert)
+    a flush is all or nothing over all tables: file backends write every new
+    file next to its target first, then a journal of the renames (and CSV
+    appends), then rename;
+    opening the store finishes (journal written) or drops (no journal) a flush
+    that was interrupted
+    """
+
+    def __init__(self, output_dir: str = '.'):
+        self.output_dir = output_dir
+        self._pending: Dict[str, List[pd.DataFrame]] = {}
+        # (staged file or None = delete, target), plus the target size for an append
+        self._staged: List[Tuple] = []
+        self.recover()
+
+    def add(self, tables: Dict[str, pd.DataFrame]) -> None:
+        for name, df in tables.items():
+            self._pending.setdefault(name, []).append(df)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        tables = {}
+        for name, dfs in self._pending.items():
+            new_rows = pd.concat(dfs, ignore_index=True)
+            new_rows[KEY_COLUMNS] = new_rows[KEY_COLUMNS].astype(str)
+            tables[name] = new_rows
+        # every flushed slice is replaced in every table, also in tables
+        # where it has no rows this time (e.g. no plaques any more)
+        keys = set()
+        for new_rows in tables.values():
+            keys.update(new_rows[KEY_COLUMNS].itertuples(index=False, name=None))
+        for name in TABLES:
+            tables.setdefault(name, pd.DataFrame(columns=KEY_COLUMNS))
+        self._staged = []
+        self._write(tables, keys)
+        self._commit_staged()
+        self._pending = {}
+
+    def _stage(self, path: str) -> str:
+        # file to write instead of path, renamed to path when the flush commits
+        staged = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + _STAGED_SUFFIX)
+        self._staged.append((staged, path))
+        return staged
+
+    def _stage_delete(self, path: str) -> None:
+        self._staged.append((None, path))
+
+    def _stage_append(self, path: str) -> str:
+        # file of rows added to the end of path when the flush commits; the journal keeps
+        # the current size of path, so finishing an interrupted append never doubles rows
+        staged = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + _STAGED_SUFFIX)
+        self._staged.append((staged, path, os.path.getsize(path)))
+        return staged
+
+    def _commit_staged(self) -> None:
+        if not self._staged:
+            return
+        for staged, *_ in self._staged:
+            if staged is not None:
+                _fsync(staged)
+        # once the journal is on disk the flush counts as done
+        journal = os.path.join(self.output_dir, JOURNAL_NAME)
+        with open(journal + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self._staged, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(journal + '.tmp', journal)
+        _apply_journal(journal)
+        self._staged = []
+
+    def recover(self) -> None:
+        """finish a flush interrupted after its journal was written, drop any other staged files"""
+        journal = os.path.join(self.output_dir, JOURNAL_NAME)
+        if os.path.exists(journal):
+            _apply_journal(journal)
+        for folder in [self.output_dir] + [os.path.join(self.output_dir, name) for name in TABLES]:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if entry.name.startswith('.') and entry.name.endswith(_STAGED_SUFFIX):
+                    os.remove(entry.path)
+
+    def _write(self, tables: Dict[str, pd.DataFrame], keys: Set[Tuple[str, str]]) -> None:
+        for name, new_rows in tables.items():
+            self._upsert(name, new_rows, keys)
+
+    def read(self, name: str, columns: Optional[List[str]] = None,
+             mouse_ids: Optional[List[str]] = None) -> pd.DataFrame:
+        """read one table, optionally only some columns and some mice"""
+        raise NotImplementedError
+
+    def _upsert(self, name: str, new_rows: pd.DataFrame, keys: Set[Tuple[str, str]]) -> None:
+        # replace all rows of the slices in keys by new_rows
+        raise NotImplementedError
+
+def _apply_journal(journal: str) -> None:
+    # renames / deletes are idempotent, so a crash in here is finished by the next recover()
+    with open(journal, encoding='utf-8') as f:
+        staged = json.load(f)
+    for staged_path, path, *append_at in staged:
+        if staged_path is None:
+            if os.path.exists(path):
+                os.remove(path)
+        elif not os.path.exists(staged_path):
+            continue
+        elif append_at:
+            _append_file(staged_path, path, append_at[0])
+        else:
+            os.replace(staged_path, path)
+    os.remove(journal)
+
+def _append_file(staged_path: str, path: str, size: int) -> None:
+    # cut path back to its size before the flush (an earlier, interrupted append), then append
+    with open(path, 'r+b') as f, open(staged_path, 'rb') as rows:
+        f.truncate(size)
+        f.seek(size)
+        shutil.copyfileobj(rows, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(staged_path)
+
+def _keys_of(df: pd.DataFrame) -> Set[Tuple[str, str]]:
+    return set(zip(df['mouse_id'].astype(str), df['slice_id'].astype(str)))
+
+def _in_keys(df: pd.DataFrame, keys: Set[Tuple[str, str]]) -> pd.Series:
+    # one vectorised lookup of the (mouse_id, slice_id) pairs
+    pairs = pd.MultiIndex.from_arrays([df['mouse_id'].astype(str), df['slice_id'].astype(str)])
+    return pd.Series(pairs.isin(list(keys)) if keys else False, index=df.index, dtype=bool)
+
+class CsvStore(ResultStore):
+    """
+    one CSV per table, same file names and columns as before (plus slice_id)
+    slices not in a file yet are appended to it, only replacing a stored
+    slice (or new columns) rewrites the whole file
+    """
+
+    def __init__(self, output_dir: str = '.'):
+        # table -> ((size, mtime), header, keys) of its file as last written / read here
+        self._known: Dict[str, Tuple[Tuple[int, int], List[str], Set[Tuple[str, str]]]] = {}
+        self._updates: Dict[str, Tuple[List[str], Set[Tuple[str, str]]]] = {}
+        super().__init__(output_dir)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.output_dir, name + '.csv')
+
+    def _read_all(self, name: str, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        # round_trip keeps the float values written by earlier runs bit-identical
+        df = pd.read_csv(path, usecols=columns, dtype={c: str for c in KEY_COLUMNS},
+                         float_precision='round_trip')
+        # files from before slice_id existed
+        if 'slice_id' not in df.columns and (columns is None or 'slice_id' in columns):
+            df.insert(1, 'slice_id', '')
+        if 'slice_id' in df.columns:
+            df['slice_id'] = df['slice_id'].fillna('')
+        return df
+
+    def _stored(self, name: str) -> Tuple[List[str], Set[Tuple[str, str]]]:
+        # header and slice keys of a table file, read again only if the file changed
+        path = self._path(name)
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        known = self._known.get(name)
+        if known is None or known[0] != signature:
+            header = list(pd.read_csv(path, nrows=0).columns)
+            # files from before slice_id existed are always rewritten
+            keys = _keys_of(self._read_all(name, KEY_COLUMNS)) if 'slice_id' in header else None
+            known = self._known[name] = (signature, header, keys)
+        return known[1], known[2]
+
+    def _write(self, tables, keys):
+        self._updates = {}
+        super()._write(tables, keys)
+
+    def _commit_staged(self):
+        super()._commit_staged()
+        for name, (header, keys) in self._updates.items():
+            stat = os.stat(self._path(name))
+            self._known[name] = ((stat.st_size, stat.st_mtime_ns), header, keys)
+        self._updates = {}
+
+    def _upsert(self, name, new_rows, keys):
+        path = self._path(name)
+        if os.path.exists(path):
+            header, stored_keys = self._stored(name)
+            if stored_keys is not None and stored_keys.isdisjoint(keys) and \
+                    (new_rows.empty or list(new_rows.columns) == header):
+                # only new slices: append, the rows already in the file are not touched
+                if not new_rows.empty:
+                    new_rows.to_csv(self._stage_append(path), index=False, header=False)
+                    self._updates[name] = (header, stored_keys | _keys_of(new_rows))
+                return
+        old_rows = self._read_all(name)
+        if old_rows is None and new_rows.empty:
+            return
+        if old_rows is not None:
+            old_rows = old_rows[~_in_keys(old_rows, keys)]
+            new_rows = pd.concat([old_rows, new_rows], ignore_index=True) if not new_rows.empty else old_rows
+        # rewrite the whole file, renamed over the old one when the flush commits
+        new_rows.to_csv(self._stage(path), index=False)
+        self._updates[name] = (list(new_rows.columns), _keys_of(new_rows))
+
+    def read(self, name, columns=None, mouse_ids=None):
+        usecols = None if columns is None else list(dict.fromkeys(columns + ['mouse_id']))
+        df = self._read_all(name, usecols)
+        if df is None:
+            return pd.DataFrame(columns=columns)
+        if mouse_ids is not None:
+            df = df[df['mouse_id'].isin([str(m) for m in mouse_ids])]
+        return df if columns is None else df[columns]
+
+class SqliteStore(ResultStore):
+    """all tables in one SQLite file (results.sqlite), each flush is one transaction"""
+
+    def __init__(self, output_dir: str = '.', filename: str = 'results.sqlite'):
+        super().__init__(output_dir)
+        self.path = os.path.join(output_dir, filename)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path)
+
+    @staticmethod
+    def _sql_type(dtype) -> str:
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(dtype):
+            return 'REAL'
+        return 'TEXT'
+
+    def _write(self, tables, keys):
+        # every table of the flush in one transaction: all rows land or none do
+        con = self._connect()
+        try:
+            for name, new_rows in tables.items():
+                self._upsert_rows(con, name, new_rows, keys)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def _upsert_rows(self, con: sqlite3.Connection, name: str, new_rows: pd.DataFrame,
+                     keys: Set[Tuple[str, str]]) -> None:
+        columns = [row[1] for row in con.execute(f'PRAGMA table_info("{name}")')]
+        if not columns and new_rows.empty:
+            return
+        if not columns:
+            col_defs = ', '.join(f'"{c}" {self._sql_type(t)}' for c, t in new_rows.dtypes.items())
+            con.execute(f'CREATE TABLE "{name}" ({col_defs})')
+            con.execute(f'CREATE INDEX "{name}_slice" ON "{name}" (mouse_id, slice_id)')
+        else:
+            # new columns added by a later version of the pipeline
+            for col, dtype in new_rows.dtypes.items():
+                if col not in columns:
+                    con.execute(f'ALTER TABLE "{name}" ADD COLUMN "{col}" {self._sql_type(dtype)}')
+
+        con.executemany(f'DELETE FROM "{name}" WHERE mouse_id = ? AND slice_id = ?', sorted(keys))
+
+        # plain python values (numpy scalars can't be bound), NaN -> NULL
+        values = new_rows.astype(object).where(new_rows.notna(), None)
+        col_list = ', '.join(f'"{c}"' for c in new_rows.columns)
+        placeholders = ', '.join('?' * len(new_rows.columns))
+        con.executemany(f'INSERT INTO "{name}" ({col_list}) VALUES ({placeholders})',
+                        values.itertuples(index=False, name=None))
+
+    def read(self, name, columns=None, mouse_ids=None):
+        select = '*' if columns is None else ', '.join(f'"{c}"' for c in columns)
+        query = f'SELECT {select} FROM "{name}"'
+        args = []
+        if mouse_ids is not None:
+            query += f" WHERE mouse_id IN ({', '.join('?' * len(mouse_ids))})"
+            args = [str(m) for m in mouse_ids]
+        # the connection's own context manager only commits, it never closes
+        with contextlib.closing(self._connect()) as con:
+            return pd.read_sql_query(query, con, params=args)
+
+class ParquetStore(ResultStore):
+    """
+    one Parquet file per table and slice: <output_dir>/<table>/<mouse_id>__<slice_id>.parquet
+    (slice_file_name: path separators in the ids are replaced)
+    rewriting a slice replaces its file; the folder reads as one dataset
+    (pandas.read_parquet or arrow::open_dataset in R)
+    """
+
+    def __init__(self, output_dir: str = '.'):
+        super().__init__(output_dir)
+        import pyarrow  # noqa: F401, fail early if Parquet support is missing
+
+    def _upsert(self, name, new_rows, keys):
+        table_dir = os.path.join(self.output_dir, name)
+        os.makedirs(table_dir, exist_ok=True)
+        groups = dict(iter(new_rows.groupby(KEY_COLUMNS, sort=False))) if not new_rows.empty else {}
+        for mouse_id, slice_id in keys:
+            path = os.path.join(table_dir, slice_file_name(mouse_id, slice_id) + '.parquet')
+            rows = groups.get((mouse_id, slice_id))
+            if rows is None:
+                # slice has no rows in this table any more
+                if os.path.exists(path):
+                    self._stage_delete(path)
+                continue
+            rows.to_parquet(self._stage(path), index=False)
+
+    def read(self, name, columns=None, mouse_ids=None):
+        table_dir = os.path.join(self.output_dir, name)
+        if not os.path.isdir(table_dir):
+            return pd.DataFrame(columns=columns)
+        filters = None if mouse_ids is None else [('mouse_id', 'in', [str(m) for m in mouse_ids])]
+        return pd.read_parquet(table_dir, columns=columns, filters=filters)
+
+STORE_FORMATS = {'csv': CsvStore, 'sqlite': SqliteStore, 'parquet': ParquetStore}
+
+def open_store(fmt: str = 'csv', output_dir: str = '.') -> ResultStore:
+    if fmt not in STORE_FORMATS:
+        raise ValueError(f"Unknown result format {fmt!r}, expected one of {list(STORE_FORMATS)}")
+    return STORE_FORMATS[fmt](output_dir)
@@ -0,0 +1,145 @@
+import sys
+import json
+import time
+import contextlib
+import tracemalloc
+from typing import Dict, IO, List, Optional
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+# JSON log lines of batch runs, appended in the output folder
+DEFAULT_LOG_NAME = 'run_log.jsonl'
+
+class StageLog:
+    """
+    wall time, peak memory and object counts of the stages of one slice
+    memory is measured with tracemalloc when it is running (batch runs with
+    --trace-memory, see traced_memory), otherwise peak_mb is None; stages must
+    not be nested, each one resets the tracemalloc peak
+
+    one record per stage:
+    {"stage": ..., "seconds": ..., "peak_mb": ...,   # peak above the memory in use at the start
+     "counts": {...}}                                # filled by the caller, e.g. {"cells": 299}
+    """
+
+    def __init__(self):
+        self.stages: List[Dict] = []
+        self._start = time.perf_counter()
+        self._tracing = tracemalloc.is_tracing()
+        self._base = self._peak = 0
+        if self._tracing:
+            tracemalloc.reset_peak()
+            self._base, self._peak = tracemalloc.get_traced_memory()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        counts = {}
+        start = time.perf_counter()
+        if self._tracing:
+            in_use, peak = tracemalloc.get_traced_memory()
+            self._peak = max(self._peak, peak)
+            tracemalloc.reset_peak()
+        try:
+            yield counts
+        finally:
+            record = {'stage': name, 'seconds': time.perf_counter() - start, 'peak_mb': None, 'counts': counts}
+            if self._tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                self._peak = max(self._peak, peak)
+                record['peak_mb'] = (peak - in_use) / 2**20
+            self.stages.append(record)
+
+    def peak_bytes(self) -> Optional[int]:
+        # peak since the log was created, over all stages and anything in between
+        if not self._tracing:
+            return None
+        return max(self._peak, tracemalloc.get_traced_memory()[1]) - self._base
+
+    def seconds(self) -> float:
+        return time.perf_counter() - self._start
+
+@contextlib.contextmanager
+def traced_memory(enabled: bool = True):
+    """
+    trace allocations (for StageLog peak_mb) only inside the block: tracemalloc
+    slows down every allocation (~15% on analyze_mask), so it is opt-in and must
+    not stay on in a worker between slices; a trace that was already running is
+    left alone
+    """
+    started = enabled and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if started:
+            tracemalloc.stop()
+
+def peak_rss_bytes() -> Optional[int]:
+    """
+    highest resident set size of this process so far (getrusage, costs nothing);
+    unlike tracemalloc it includes the memory-mapped label pages; None on Windows
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def stage(log: Optional[StageLog], name: str):
+    """log.stage(name), or a no-op when there is no log (interactive mode)"""
+    return log.stage(name) if log is not None else contextlib.nullcontext({})
+
+def open_log(path: Optional[str]) -> Optional[IO]:
+    # '-' = stderr, None = no JSON log
+    if path is None:
+        return None
+    if path == '-':
+        return sys.stderr
+    return open(path, 'a', encoding='utf-8')
+
+def write_event(stream: Optional[IO], event: Dict) -> None:
+    """one JSON object per line, flushed right away so a crashed run keeps its log"""
+    if stream is None:
+        return
+    stream.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **event}, default=str) + '\n')
+    stream.flush()
+
+def run_report(slices: List[Dict]) -> Dict:
+    """
+    aggregate the slice statuses of a run (see batch.run_manifest)
+
+    return data structure
+    {
+        "n_slices": ..., "n_ok": ..., "n_failed": ..., "n_cached": ...,
+        "seconds": ...,          # sum over the slices
+        "stages": {name: {"n": ..., "seconds_total": ..., "seconds_mean": ..., "seconds_max": ...,
+                          "peak_mb_max": ...}},
+        "slowest": [{"row", "mouse_id", "slice_id", "seconds"}, ...]   # at most 5
+    }
+    """
+    stages: Dict[str, Dict] = {}
+    for event in slices:
+        for record in event.get('stages', []):
+            agg = stages.setdefault(record['stage'], {'n': 0, 'seconds_total': 0.0, 'seconds_max': 0.0,
+                                                      'peak_mb_max': None})
+            agg['n'] += 1
+            agg['seconds_total'] += record['seconds']
+            agg['seconds_max'] = max(agg['seconds_max'], record['seconds'])
+            if record['peak_mb'] is not None:
+                agg['peak_mb_max'] = max(agg['peak_mb_max'] or 0.0, record['peak_mb'])
+    for agg in stages.values():
+        agg['seconds_mean'] = agg['seconds_total'] / agg['n']
+
+    timed = sorted((e for e in slices if e.get('seconds') is not None), key=lambda e: -e['seconds'])
+    return {
+        'n_slices': len(slices),
+        'n_ok': sum(e['status'] == 'ok' for e in slices),
+        'n_failed': sum(e['status'] != 'ok' for e in slices),
+        'n_cached': sum(bool(e.get('cached')) for e in slices),
+        'seconds': sum(e['seconds'] for e in timed),
+        'stages': stages,
+        'slowest': [{k: e.get(k) for k in ('row', 'mouse_id', 'slice_id', 'seconds')} for e in timed[:5]]
+    }
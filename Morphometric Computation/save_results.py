@@ -1,16 +1,53 @@
+import numpy as np
 import pandas as pd
-import os
+from typing import Dict, Optional
+from result_store import ResultStore, open_store
+from spatial_index import plaque_proximity, DEFAULT_PROXIMITY_RADIUS_UM
+from band_profile import bin_edges
+from object_table import OBJECT_TYPES, SIDES, SHAPE_FIELDS, new_object_table
 
 def save_results(mouse_id: str, sex: str, genotype: str, age: str, 
                 pixel_to_micrometer, physical_width, physical_height,
-                side_stats: dict, sub_geometry: dict):
+                side_stats: dict, sub_geometry: dict,
+                slice_id: str = '', store: Optional[ResultStore] = None,
+                proximity_radius_um: float = DEFAULT_PROXIMITY_RADIUS_UM):
     """
-    results are saved in 4 CSV files
+    results are saved in 5 tables (CSV files by default, see result_store.py)
     1. summary_stats.csv - include sides (proximal, distal) and global stat
     2. distribution_data.csv - the area distribution for each plaque and each neuron
     3. geometry_metadata.csv - data about the subiculum
-    4. spatial_data.csv - spatial distribution of centroids of each plaque and neuron
+    4. spatial_data.csv - spatial distribution of centroids of each plaque and neuron,
+       with distance from each cell to its nearest plaque, the number of
+       cells within proximity_radius_um of each plaque and the shape of each object
+    5. overlap_data.csv - per cell: intracellular ab area, per plaque: area inside cells
+    6. profile_data.csv - counts & areas in proximal-distal bins (long format),
+       only when the slice was analyzed with a profile axis
+    rows are keyed by (mouse_id, slice_id), saving the same slice again replaces its rows
+    with a store, the tables are only queued, call store.flush() to write them
+    returns the tables (see build_result_tables), e.g. for cohort.CohortAggregator
     """
+    tables = build_result_tables(
+        mouse_id, sex, genotype, age,
+        pixel_to_micrometer, physical_width, physical_height,
+        side_stats, sub_geometry, slice_id, proximity_radius_um
+    )
+    if store is None:
+        store = open_store('csv')
+        store.add(tables)
+        store.flush()
+    else:
+        store.add(tables)
+    return tables
+
+def build_result_tables(mouse_id: str, sex: str, genotype: str, age: str,
+                        pixel_to_micrometer, physical_width, physical_height,
+                        side_stats: dict, sub_geometry: dict,
+                        slice_id: str = '',
+                        proximity_radius_um: float = DEFAULT_PROXIMITY_RADIUS_UM) -> Dict[str, pd.DataFrame]:
+    """build the result tables of one slice, keyed by table name"""
+    tables = {}
+    mouse_id = str(mouse_id)
+    slice_id = str(slice_id)
     
     # ================== 1. summary_stats ==================
     summary_data = []
@@ -26,6 +63,7 @@ def save_results(mouse_id: str, sex: str, genotype: str, age: str,
         
         row = {
             'mouse_id': mouse_id,
+            'slice_id': slice_id,
             'sex': sex,
             'genotype': genotype,
             'age': age,
@@ -54,52 +92,32 @@ def save_results(mouse_id: str, sex: str, genotype: str, age: str,
         }
         summary_data.append(row)
     
-    _save_to_csv(pd.DataFrame(summary_data), 'summary_stats.csv')
+    tables['summary_stats'] = pd.DataFrame(summary_data)
     
     # ================== 2. Save Distribution ==================
-    dist_data = []
-    
-    # global cell area distribution
-    for area in side_stats.get('cell_global_dist', []):
-        dist_data.append({
-            'mouse_id': mouse_id,
-            'type': 'cell',
-            'side': 'GLOBAL',
-            'area_um2': area
-        })
-    # global ab area distrbution
-    for area in side_stats.get('ab_global_dist', []):
-        dist_data.append({
+    # whole columns of the object table, no per-object rows in Python
+    objects = side_stats.get('objects', new_object_table(0))
+    type_names = np.asarray(OBJECT_TYPES, dtype=object)
+    side_names = np.asarray(SIDES, dtype=object)
+    n_objects = len(objects)
+
+    # all cells, all plaques (GLOBAL), then cells & plaques of each side
+    by_side = np.argsort(objects['side'], kind='stable')
+    dist_order = np.r_[np.arange(n_objects), by_side]
+    if n_objects:
+        tables['distribution_data'] = pd.DataFrame({
             'mouse_id': mouse_id,
-            'type': 'plaque',
-            'side': 'GLOBAL',
-            'area_um2': area
+            'slice_id': slice_id,
+            'type': type_names[objects['type'][dist_order]],
+            'side': np.r_[np.full(n_objects, 'GLOBAL', dtype=object), side_names[objects['side'][by_side]]],
+            'id': objects['id'][dist_order],   # per type and side, same as spatial_data
+            'area_um2': objects['area_um2'][dist_order]
         })
     
-    # sides
-    for side in ['left', 'right']:
-        for area in side_stats.get(side, {}).get('cell_dist', []):
-            dist_data.append({
-                'mouse_id': mouse_id,
-                'type': 'cell',
-                'side': side.upper(),
-                'area_um2': area
-            })
-            
-        for area in side_stats.get(side, {}).get('ab_dist', []):
-            dist_data.append({
-                'mouse_id': mouse_id,
-                'type': 'plaque',
-                'side': side.upper(),
-                'area_um2': area
-            })
-    
-    if dist_data:
-        _save_to_csv(pd.DataFrame(dist_data), 'distribution_data.csv')
-    
     # ================== 3. subiculum geometry ==================
     geo_data = {
         'mouse_id': mouse_id,
+        'slice_id': slice_id,
         'sub_area_um2': sub_geometry['geometry']['area_um2'],
         'sub_width_um': sub_geometry['geometry']['width_um'],
         'sub_height_um': sub_geometry['geometry']['height_um'],
@@ -116,43 +134,91 @@ def save_results(mouse_id: str, sex: str, genotype: str, age: str,
         'divline_slope': sub_geometry['dividing_line'].get('slope'),
         'divline_intercept': sub_geometry['dividing_line'].get('intercept'),
         'divline_is_vertical': sub_geometry['dividing_line'].get('is_vertical', False),
-        'divline_is_horizontal': sub_geometry['dividing_line'].get('is_horizontal', False)
+        'divline_is_horizontal': sub_geometry['dividing_line'].get('is_horizontal', False),
+
+        # ends of the subiculum (typed in or from the centreline) & centreline length
+        'left_end_x_um': sub_geometry['midline'].get('left_end_um', (None, None))[0],
+        'left_end_y_um': sub_geometry['midline'].get('left_end_um', (None, None))[1],
+        'right_end_x_um': sub_geometry['midline'].get('right_end_um', (None, None))[0],
+        'right_end_y_um': sub_geometry['midline'].get('right_end_um', (None, None))[1],
+        'centreline_length_um': sub_geometry.get('centreline', {}).get('length_um')
     }
     
-    _save_to_csv(pd.DataFrame([geo_data]), 'geometry_metadata.csv')
+    tables['geometry_metadata'] = pd.DataFrame([geo_data])
 
     # ================== 4. Centroids distribution ==================
-    spatial_data = []
-    
-    # Cell centroids
-    for side in ['left', 'right']:
-        stats = side_stats.get(side, {})
-        for idx, (x, y) in enumerate(stats.get('cell_centroids', [])):
-            spatial_data.append({
-                'mouse_id': mouse_id,
-                'type': 'cell',
-                'side': side.upper(),
-                'id': idx + 1,  # Cell ID
-                'x_um': x,
-                'y_um': y
-            })
-    
-    # AB centroids
-    for side in ['left', 'right']:
-        stats = side_stats.get(side, {})
-        for idx, (x, y) in enumerate(stats.get('ab_centroids', [])):
-            spatial_data.append({
+    # cells then plaques, left side first
+    spatial = objects[np.lexsort((objects['side'], objects['type']))]
+    if n_objects:
+        spatial_df = pd.DataFrame({
+            'mouse_id': mouse_id,
+            'slice_id': slice_id,
+            'type': type_names[spatial['type']],
+            'side': side_names[spatial['side']],
+            'id': spatial['id'],   # per type and side
+            'x_um': spatial['x_um'],
+            'y_um': spatial['y_um'],
+            'pd_position': spatial['pd_position'],   # 0 = left end, 1 = right end
+            **{field: spatial[field] for field in SHAPE_FIELDS}
+        })
+
+        # plaque proximity, same cell / plaque order as the rows above
+        is_cell = spatial['type'] == OBJECT_TYPES.index('cell')
+        xy = np.column_stack([spatial['x_um'], spatial['y_um']])
+        proximity = plaque_proximity(xy[is_cell], xy[~is_cell], proximity_radius_um)
+
+        nearest_plaque_um = np.full(n_objects, np.nan)
+        nearest = proximity['nearest_plaque_um']
+        nearest_plaque_um[is_cell] = np.where(np.isinf(nearest), np.nan, nearest)  # NaN: no plaque in slice
+        cells_within_r = np.full(n_objects, np.nan)
+        cells_within_r[~is_cell] = proximity['cells_within_r']
+
+        spatial_df['nearest_plaque_um'] = nearest_plaque_um   # cells only
+        spatial_df['cells_within_r'] = cells_within_r         # plaques only
+        spatial_df['proximity_radius_um'] = proximity_radius_um
+        tables['spatial_data'] = spatial_df
+
+    # ================== 5. per-object cell / ab overlap ==================
+    if n_objects:
+        tables['overlap_data'] = pd.DataFrame({
+            'mouse_id': mouse_id,
+            'slice_id': slice_id,
+            'type': type_names[objects['type']],
+            'label': objects['label'],
+            'side': side_names[objects['side']],
+            'area_um2': objects['object_area_um2'],   # 6 weeks: whole plaque, incl. the part inside cells
+            'overlap_area_um2': objects['overlap_area_um2'],
+            'overlap_fraction': objects['overlap_fraction'],
+            'n_partners': objects['n_partners']
+        })
+
+    # ================== 6. proximal-distal profile ==================
+    profile = side_stats.get('profile')
+    if profile is not None:
+        n_bins = profile['n_bins']
+        edges = bin_edges(n_bins)
+        sub_area = np.asarray(sub_geometry.get('profile', {}).get('sub_area_um2', [np.nan] * n_bins))
+        profile_frames = []
+        for obj_type, count_key, area_key in (('cell', 'cell_count', 'cell_area_um2'),
+                                              ('plaque', 'plaque_count', 'plaque_area_um2'),
+                                              ('intra_plaque', None, 'intra_plaque_area_um2')):
+            area = np.asarray(profile[area_key], dtype=np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                area_pct = np.where(sub_area > 0, area / sub_area, 0)
+            profile_frames.append(pd.DataFrame({
                 'mouse_id': mouse_id,
-                'type': 'plaque',
-                'side': side.upper(),
-                'id': idx + 1,  # AB ID
-                'x_um': x,
-                'y_um': y
-            })
-    
-    if spatial_data:
-        _save_to_csv(pd.DataFrame(spatial_data), 'spatial_data.csv')
+                'slice_id': slice_id,
+                'n_bins': n_bins,
+                'axis': sub_geometry.get('profile', {}).get('axis', 'line'),
+                'bin': np.arange(1, n_bins + 1),   # 1 = left end (proximal)
+                't_start': edges[:-1],
+                't_end': edges[1:],
+                'type': obj_type,
+                'count': profile[count_key] if count_key else np.nan,
+                'area_um2': area,
+                'sub_area_um2': sub_area,
+                'area_pct': area_pct
+            }))
+        tables['profile_data'] = pd.concat(profile_frames, ignore_index=True)
 
-def _save_to_csv(df: pd.DataFrame, filename: str):
-    file_exists = os.path.exists(filename)
-    df.to_csv(filename, mode='a', index=False, header=not file_exists)
+    return tables
@@ -0,0 +1,62 @@
+import numpy as np
+from typing import Tuple
+
+# parameters should be in um
+def is_left(x, y, midpoint, perpendicular_vector):
+        # vector of (x,y) relative to midpoint
+        vec_x = x - midpoint[0]
+        vec_y = y - midpoint[1]
+        # cal cross product, decide direction
+        cross = vec_x * perpendicular_vector[1] - vec_y * perpendicular_vector[0]
+        # if cross > 0, point vector is on the left of perpendicular vector (counterclockwise from perp to point)
+        # Q? using cross < 0 produces the correct Left Or Right? Why?
+        return cross < 0
+
+def count_points_by_side(
+    x_um: np.ndarray,
+    y_um: np.ndarray,
+    midpoint: Tuple[float, float],
+    perpendicular_vector: Tuple[float, float]
+) -> np.ndarray:
+    """
+    count points on each side of the dividing line in one array operation
+    x_um, y_um are coordinate arrays in um
+    return np.array([left_count, right_count])
+    """
+    left = is_left(np.asarray(x_um, dtype=np.float64), np.asarray(y_um, dtype=np.float64),
+                   midpoint, perpendicular_vector)
+    n_left = int(np.count_nonzero(left))
+    return np.array([n_left, left.size - n_left])
+
+def count_mask_by_side(
+    mask: np.ndarray,
+    pixel_to_micrometer: float,
+    midpoint: Tuple[float, float],
+    perpendicular_vector: Tuple[float, float],
+    chunk_rows: int = 1024,
+    row_offset: int = 0,
+    col_offset: int = 0
+) -> np.ndarray:
+    """
+    count nonzero pixels of a 2D mask on each side of the dividing line
+    the cross product is separable in row and column, so it is evaluated on
+    the row/column grid by broadcasting, without building pixel coordinates
+    row_offset, col_offset: position of mask[0, 0] in the full image, when
+    mask is a tile of it
+    return np.array([left_pixels, right_pixels])
+    """
+    n_rows, n_cols = mask.shape
+    # column term and row term of the cross product (same formula as is_left)
+    col_term = (np.arange(col_offset, col_offset + n_cols) * pixel_to_micrometer - midpoint[0]) * perpendicular_vector[1]
+    row_term = (np.arange(row_offset, row_offset + n_rows) * pixel_to_micrometer - midpoint[1]) * perpendicular_vector[0]
+
+    n_left = 0
+    n_total = 0
+    # go through row chunks so the temporary grid stays small
+    for start in range(0, n_rows, chunk_rows):
+        chunk = mask[start:start + chunk_rows] != 0
+        left_grid = col_term[None, :] - row_term[start:start + chunk_rows, None] < 0
+        n_left += int(np.count_nonzero(chunk & left_grid))
+        n_total += int(np.count_nonzero(chunk))
+
+    return np.array([n_left, n_total - n_left])
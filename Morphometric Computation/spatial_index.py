@@ -0,0 +1,211 @@
+import numpy as np
+from typing import Optional, Tuple
+
+# radius (um) for the cells-around-plaque count in spatial_data
+DEFAULT_PROXIMITY_RADIUS_UM = 50.0
+
+# queries handled at once, bounds the size of the candidate pair arrays
+QUERY_CHUNK = 4096
+# up to this many points nearest() compares every query with every point:
+# a grid sized from a few points has tiny cells and far queries walk many shells
+BRUTE_FORCE_POINTS = 256
+# grid searches are capped, past the cap the remaining queries are compared with every point:
+# nearest() walks at most this many shells (a far query or a degenerate grid, e.g. collinear
+# or duplicate points, would walk thousands), count_within() looks at most at this many cells
+MAX_SHELLS = 64
+MAX_OFFSETS = 1024
+# query x point distances computed at once by the brute-force fallback
+BRUTE_FORCE_BLOCK = 2**22
+
+class GridIndex:
+    """
+    uniform grid over 2D points (e.g. centroids in um), built once per slice
+    points are sorted by grid cell, so the points of any cell are one
+    contiguous run found by binary search; queries are answered in batches
+    by looking only at the grid cells around each query point
+    """
+
+    def __init__(self, points, cell_size: Optional[float] = None, cover=None):
+        # cover: more points the grid should span (e.g. the later queries), not indexed;
+        # nearest() walks every empty shell between a far query and the grid
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        n_points = len(self.points)
+        span = self.points
+        if cover is not None:
+            span = np.concatenate([span, np.asarray(cover, dtype=np.float64).reshape(-1, 2)])
+        self.origin = span.min(axis=0) if len(span) else np.zeros(2)
+        extent = span.max(axis=0) - self.origin if len(span) else np.zeros(2)
+
+        if cell_size is None:
+            # about 2 points per cell on average
+            area = max(extent[0], 1.0) * max(extent[1], 1.0)
+            cell_size = np.sqrt(2.0 * area / max(n_points, 1))
+        self.cell_size = float(cell_size)
+        if self.cell_size <= 0:
+            raise ValueError(f"cell_size must be > 0, got {cell_size}")
+
+        self.n_cells = (np.floor(extent / self.cell_size).astype(np.int64) + 1)
+        keys = self._keys(self._cell_of(self.points))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def _cell_of(self, xy: np.ndarray) -> np.ndarray:
+        # (col, row) of the grid cell of every point, can be outside the grid
+        return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def _keys(self, cells: np.ndarray) -> np.ndarray:
+        return cells[:, 1] * self.n_cells[0] + cells[:, 0]
+
+    def _candidates(self, query_cells: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (query index, point index) of every point in the grid cells
+        query_cells + offsets, as 2 flat arrays
+        """
+        n_queries = len(query_cells)
+        cells = (query_cells[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+        query_idx = np.repeat(np.arange(n_queries), len(offsets))
+        inside = np.all((cells >= 0) & (cells < self.n_cells), axis=1)
+        cells, query_idx = cells[inside], query_idx[inside]
+
+        keys = self._keys(cells)
+        starts = np.searchsorted(self.sorted_keys, keys, side='left')
+        counts = np.searchsorted(self.sorted_keys, keys, side='right') - starts
+        # expand every (start, count) run into its point positions
+        query_idx = np.repeat(query_idx, counts)
+        run_starts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        point_idx = self.order[run_starts + np.arange(len(query_idx))]
+        return query_idx, point_idx
+
+    @staticmethod
+    def _square_offsets(ring: int) -> np.ndarray:
+        # all (dx, dy) with max(|dx|, |dy|) <= ring
+        d = np.arange(-ring, ring + 1)
+        return np.stack(np.meshgrid(d, d), axis=-1).reshape(-1, 2)
+
+    @staticmethod
+    def _shell_offsets(ring: int) -> np.ndarray:
+        # all (dx, dy) with max(|dx|, |dy|) == ring
+        offsets = GridIndex._square_offsets(ring)
+        return offsets[np.abs(offsets).max(axis=1) == ring]
+
+    def nearest(self, queries) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        distance to and index of the nearest point for every query point
+        (inf and -1 when the index is empty)
+        grid cells are searched in growing square shells around each query,
+        starting at the query's own shell distance to the grid; a query is
+        done once its best distance is within the searched square, anything
+        outside it is farther away; queries not done after shell MAX_SHELLS
+        are compared with every point
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 2)
+        best_dist = np.full(len(queries), np.inf)
+        best_idx = np.full(len(queries), -1, dtype=np.int64)
+        if len(self.points) == 0:
+            return best_dist, best_idx
+        if len(self.points) <= BRUTE_FORCE_POINTS:
+            best_dist[:], best_idx[:] = self._nearest_brute_force(queries)
+            return best_dist, best_idx
+
+        for chunk_start in range(0, len(queries), QUERY_CHUNK):
+            chunk = slice(chunk_start, chunk_start + QUERY_CHUNK)
+            q_xy = queries[chunk]
+            q_cells = self._cell_of(q_xy)
+            dist = best_dist[chunk]  # views, filled in place
+            idx = best_idx[chunk]
+
+            # no point can be closer than the query's shell distance to the grid
+            outside = np.maximum(np.maximum(-q_cells, q_cells - (self.n_cells - 1)), 0).max(axis=1)
+            ring = int(outside.min())
+            max_ring = int((outside + self.n_cells.max()).max())
+            pending = np.arange(len(q_xy))
+            while len(pending) and ring <= min(max_ring, MAX_SHELLS):
+                # shells closer than the grid are empty, queries join at their own distance
+                active = pending[outside[pending] <= ring]
+                q_idx, p_idx = self._candidates(q_cells[active], self._shell_offsets(ring))
+                if len(q_idx):
+                    d = np.hypot(*(self.points[p_idx] - q_xy[active[q_idx]]).T)
+                    # candidates come grouped by query: minimum of each group
+                    group_starts = np.flatnonzero(np.r_[True, q_idx[1:] != q_idx[:-1]])
+                    group_min = np.minimum.reduceat(d, group_starts)
+                    group_sizes = np.diff(np.r_[group_starts, len(d)])
+                    # first candidate of each group that reaches the minimum
+                    is_min = np.flatnonzero(d == np.repeat(group_min, group_sizes))
+                    hit = is_min[np.r_[True, q_idx[is_min][1:] != q_idx[is_min][:-1]]]
+                    hit_q = active[q_idx[hit]]
+                    closer = d[hit] < dist[hit_q]
+                    dist[hit_q[closer]] = d[hit][closer]
+                    idx[hit_q[closer]] = p_idx[hit][closer]
+                # points in later shells are at least ring * cell_size away
+                pending = pending[dist[pending] > ring * self.cell_size]
+                ring += 1
+            if len(pending) and ring <= max_ring:
+                # shell cap reached
+                dist[pending], idx[pending] = self._nearest_brute_force(q_xy[pending])
+
+        return best_dist, best_idx
+
+    def _distance_blocks(self, queries: np.ndarray):
+        # (first query, query x point distance matrix) for blocks of queries of BRUTE_FORCE_BLOCK distances
+        chunk = max(BRUTE_FORCE_BLOCK // len(self.points), 1)
+        for chunk_start in range(0, len(queries), chunk):
+            q_xy = queries[chunk_start:chunk_start + chunk]
+            yield chunk_start, np.hypot(self.points[None, :, 0] - q_xy[:, None, 0],
+                                        self.points[None, :, 1] - q_xy[:, None, 1])
+
+    def _nearest_brute_force(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # distance to and index of the nearest point, by comparing with every point
+        best_dist = np.empty(len(queries))
+        best_idx = np.empty(len(queries), dtype=np.int64)
+        for chunk_start, d in self._distance_blocks(queries):
+            idx = np.argmin(d, axis=1)
+            best_idx[chunk_start:chunk_start + len(d)] = idx
+            best_dist[chunk_start:chunk_start + len(d)] = d[np.arange(len(d)), idx]
+        return best_dist, best_idx
+
+    def count_within(self, queries, radius: float) -> np.ndarray:
+        """
+        number of points within radius (inclusive) of every query point
+        a radius spanning more than MAX_OFFSETS grid cells compares every query
+        with every point instead
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 2)
+        counts = np.zeros(len(queries), dtype=np.int64)
+        if len(self.points) == 0 or len(queries) == 0:
+            return counts
+
+        n_rings = int(np.ceil(radius / self.cell_size))
+        if (2 * n_rings + 1) ** 2 > MAX_OFFSETS:
+            for chunk_start, d in self._distance_blocks(queries):
+                counts[chunk_start:chunk_start + len(d)] = np.count_nonzero(d <= radius, axis=1)
+            return counts
+
+        offsets = self._square_offsets(n_rings)
+        for chunk_start in range(0, len(queries), QUERY_CHUNK):
+            q_xy = queries[chunk_start:chunk_start + QUERY_CHUNK]
+            q_idx, p_idx = self._candidates(self._cell_of(q_xy), offsets)
+            d = np.hypot(*(self.points[p_idx] - q_xy[q_idx]).T)
+            counts[chunk_start:chunk_start + len(q_xy)] = np.bincount(q_idx[d <= radius], minlength=len(q_xy))
+        return counts
+
+def plaque_proximity(cell_xy, plaque_xy, radius_um: float = DEFAULT_PROXIMITY_RADIUS_UM):
+    """
+    plaque-proximity metrics of one slice, from cell and plaque centroids in um
+
+    return data structure
+    {
+        "nearest_plaque_um": ...,   # per cell, distance to the nearest plaque centroid (inf without plaques)
+        "cells_within_r": ...       # per plaque, number of cell centroids within radius_um
+    }
+    """
+    cell_xy = np.asarray(cell_xy, dtype=np.float64).reshape(-1, 2)
+    plaque_xy = np.asarray(plaque_xy, dtype=np.float64).reshape(-1, 2)
+    # grid over cells and plaques: every cell is a query inside the grid
+    nearest_plaque_um, _ = GridIndex(plaque_xy, cover=cell_xy).nearest(cell_xy)
+    # cell size = radius: each count looks at 3 x 3 grid cells
+    cell_index = GridIndex(cell_xy, cell_size=radius_um if radius_um > 0 else None)
+    cells_within_r = cell_index.count_within(plaque_xy, radius_um)
+    return {
+        "nearest_plaque_um": nearest_plaque_um,
+        "cells_within_r": cells_within_r
+    }
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, IO, List, Optional, Tuple
+from batch import analyze_slice, finish_slice, parse_row, PATH_COLUMNS, RESUME_OPTION_KEYS, DEFAULT_OPTIONS, \
+    SliceCommits
+from result_store import STORE_FORMATS, open_store
+from image_io import MASKS_CACHE_SUFFIX
+from cohort import load_cohort, DEFAULT_STATE_NAME
+from checkpoint import slice_fingerprint, load_checkpoint
+from result_cache import DEFAULT_CACHE_DIR
+from density_map import DEFAULT_DENSITY_DIR
+from run_log import open_log, write_event, DEFAULT_LOG_NAME
+
+# naming convention of the files of one slice in the watched folder:
+# <slice>_cell_seg.npy, <slice>_ab_seg.npy (Cellpose outputs of <slice>_cell / <slice>_ab images),
+# <slice>_sub.tif and the sidecar <slice>.json with the manifest columns of the slice
+FILE_SUFFIXES = {
+    'cell_npy_path': ('_cell_seg.npy',),
+    'ab_npy_path': ('_ab_seg.npy',),
+    'sub_path': ('_sub.tif', '_sub.tiff')
+}
+SIDECAR_SUFFIX = '.json'
+# manifest columns shared by every slice of the folder (e.g. pixel size), the sidecar overrides them
+DEFAULTS_NAME = 'watch_defaults.json'
+DEFAULT_INTERVAL = 2.0     # seconds between scans of the folder
+# a file counts as complete when its size and mtime did not change for this many scans
+SETTLE_SCANS = 2
+# slices committed by the service, kept in the output folder; not batch.py's checkpoint,
+# which a batch run into the same folder rewrites with its own slices only
+WATCH_CHECKPOINT_NAME = 'watch_checkpoint.json'
+
+def _slice_file(name: str) -> Optional[Tuple[str, str]]:
+    # (slice name, manifest column) of a file in the folder, None if it is not part of a slice
+    if name.startswith('.') or name.endswith(MASKS_CACHE_SUFFIX) or name == DEFAULTS_NAME:
+        # hidden / temporary files, and label caches that older versions wrote next to the _seg.npy files
+        return None
+    for col, suffixes in FILE_SUFFIXES.items():
+        for suffix in suffixes:
+            if name.endswith(suffix) and len(name) > len(suffix):
+                return name[:-len(suffix)], col
+    if name.endswith(SIDECAR_SUFFIX) and len(name) > len(SIDECAR_SUFFIX):
+        return name[:-len(SIDECAR_SUFFIX)], 'sidecar'
+    return None
+
+def scan_folder(watch_dir: str) -> Dict[str, Dict[str, str]]:
+    """slice name -> {'cell_npy_path', 'ab_npy_path', 'sub_path', 'sidecar'} of the files present"""
+    slices: Dict[str, Dict[str, str]] = {}
+    with os.scandir(watch_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            found = _slice_file(entry.name)
+            if found is not None:
+                slices.setdefault(found[0], {})[found[1]] = entry.path
+    return slices
+
+class SettleTracker:
+    """
+    files that stopped changing: segmentation writes its outputs one by one and a copy
+    to a share can take a while, so a slice is only analyzed once all its files kept
+    the same size and mtime for SETTLE_SCANS scans
+    """
+
+    def __init__(self, scans: int = SETTLE_SCANS):
+        self.scans = scans
+        self._seen: Dict[str, Tuple[Tuple[int, int], int]] = {}   # path -> (size, mtime_ns), unchanged scans
+
+    def settled(self, paths: List[str]) -> bool:
+        ready = True
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            identity = (stat.st_size, stat.st_mtime_ns)
+            previous, unchanged = self._seen.get(path, (None, 0))
+            unchanged = unchanged + 1 if identity == previous else 0
+            self._seen[path] = (identity, unchanged)
+            ready &= unchanged >= self.scans - 1
+        return ready
+
+def _read_json(path: str) -> Dict:
+    with open(path, encoding='utf-8') as f:
+        content = json.load(f)
+    if not isinstance(content, dict):
+        raise ValueError(f"{path} must hold one JSON object of manifest columns")
+    return content
+
+def slice_row(name: str, files: Dict[str, str], defaults: Dict) -> Dict:
+    """manifest row of one slice: folder defaults < sidecar, plus the paths found by name"""
+    row = {**defaults, **_read_json(files['sidecar'])}
+    row.update({col: files[col] for col in PATH_COLUMNS})
+    row['slice_id'] = str(row.get('slice_id') or name)
+    return row
+
+class WatchService:
+    """
+    analyze every complete slice that lands in a folder, until stopped
+    the worker processes are started once and stay warm (imports, decoders),
+    the main process writes each slice through save_results as soon as it is
+    analyzed and commits it (tables, cohort stats, checkpoint) right away;
+    slices in the checkpoint with unchanged files and sidecar are not analyzed
+    again, also after a restart, and a slice whose files change is redone
+    """
+
+    def __init__(self, watch_dir: str, store, options: Dict, workers: int = 1,
+                 cohort_path: Optional[str] = None, checkpoint_path: Optional[str] = None,
+                 log: Optional[IO] = None, settle_scans: int = SETTLE_SCANS):
+        self.watch_dir = watch_dir
+        self.store = store
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.log = log
+        self.cohort = load_cohort(cohort_path) if cohort_path else None
+        done = load_checkpoint(checkpoint_path) if checkpoint_path else {}
+        self.commits = SliceCommits(store, 1, self.cohort, cohort_path, checkpoint_path, done, watch_dir)
+        self.tracker = SettleTracker(settle_scans)
+        self.pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.running: Dict[str, Tuple[str, Dict, Future]] = {}   # fingerprint -> (name, params, future)
+        # fingerprint (slice name for a bad sidecar) -> error, not retried until the files change
+        self.failed: Dict[str, str] = {}
+        self.n_done = 0
+
+    def poll(self) -> int:
+        """one scan: finish analyzed slices, start the newly complete ones; returns the slices in flight"""
+        self._collect()
+        slices = scan_folder(self.watch_dir)
+        defaults_path = os.path.join(self.watch_dir, DEFAULTS_NAME)
+        defaults = _read_json(defaults_path) if os.path.isfile(defaults_path) else {}
+        for name in sorted(slices):
+            files = slices[name]
+            if any(col not in files for col in PATH_COLUMNS + ['sidecar']):
+                continue   # still waiting for a file
+            if not self.tracker.settled([files[col] for col in PATH_COLUMNS + ['sidecar']]):
+                continue
+            try:
+                params = parse_row(slice_row(name, files, defaults))
+                # params hold the sidecar values, so fixing the sidecar redoes the slice
+                fingerprint = slice_fingerprint(params, [params[col] for col in PATH_COLUMNS],
+                                                {k: self.options[k] for k in RESUME_OPTION_KEYS})
+            except Exception as e:
+                self._failed(name, files['sidecar'], e)
+                continue
+            self.failed.pop(name, None)
+            if fingerprint in self.commits.done or fingerprint in self.running or fingerprint in self.failed:
+                continue
+            print(f"Slice {name} (mouse {params['mouse_id']}) queued")
+            if self.pool is not None:
+                self.running[fingerprint] = (name, params, self.pool.submit(analyze_slice, params, self.options))
+            else:
+                self._finish(fingerprint, name, params, lambda: analyze_slice(params, self.options))
+        return len(self.running)
+
+    def _collect(self) -> None:
+        # results of the worker processes, written in the order they finish
+        for fingerprint, (name, params, future) in list(self.running.items()):
+            if future.done():
+                del self.running[fingerprint]
+                self._finish(fingerprint, name, params, future.result)
+
+    def _finish(self, fingerprint: str, name: str, params: Dict, result) -> None:
+        try:
+            outcome = result()
+            finish_slice(params, outcome, self.store, self.options, self.cohort)
+        except Exception as e:
+            traceback.print_exc()
+            self._failed(name, params['mouse_id'], e, fingerprint)
+            return
+        status = {'slice': name, 'mouse_id': params['mouse_id'], 'slice_id': params['slice_id'],
+                  'status': 'ok', 'cached': outcome['cached'], 'seconds': outcome['seconds'],
+                  'stages': outcome['stages']}
+        self.commits.slice_done(fingerprint, {'row': name, **status})
+        self.n_done += 1
+        write_event(self.log, {'event': 'slice', **status})
+        print(f"Slice {name} (mouse {params['mouse_id']}) done in {outcome['seconds']:.1f} s"
+              + (" (cached)" if outcome['cached'] else ""))
+
+    def _failed(self, name: str, what: str, error: Exception, fingerprint: Optional[str] = None) -> None:
+        message = f"{type(error).__name__}: {error}"
+        if fingerprint is not None:
+            self.failed[fingerprint] = message
+        elif self.failed.get(name) == message:
+            return   # same bad sidecar as in the last scan, reported once
+        else:
+            self.failed[name] = message
+        print(f"Slice {name} ({what}) failed: {message}")
+        write_event(self.log, {'event': 'slice', 'slice': name, 'status': 'failed', 'error': message})
+
+    def run(self, interval: float = DEFAULT_INTERVAL, once: bool = False) -> None:
+        """
+        scan every interval seconds until interrupted (Ctrl+C); once: process the
+        slices already complete in the folder, then stop
+        """
+        write_event(self.log, {'event': 'start', 'watch_dir': self.watch_dir,
+                               'options': {k: v for k, v in self.options.items() if k != 'verbose'}})
+        print(f"Watching {self.watch_dir} (Ctrl+C to stop)" if not once else f"Processing {self.watch_dir}")
+        try:
+            idle_scans = 0
+            while True:
+                in_flight = self.poll()
+                if in_flight:
+                    # wake up for the first finished slice instead of a whole interval
+                    wait([future for _, _, future in self.running.values()], timeout=interval,
+                         return_when=FIRST_COMPLETED)
+                    idle_scans = 0
+                    continue
+                idle_scans += 1
+                # once: stop when nothing new settled during the settling scans
+                if once and idle_scans > self.tracker.scans:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopping, finishing the slices in flight...")
+            for fingerprint, (name, params, future) in list(self.running.items()):
+                del self.running[fingerprint]
+                self._finish(fingerprint, name, params, future.result)
+        finally:
+            self.commits.commit()
+            if self.pool is not None:
+                self.pool.shutdown()
+            write_event(self.log, {'event': 'stop', 'n_done': self.n_done, 'n_failed': len(self.failed)})
+            print(f"{self.n_done} slices processed, {len(self.failed)} failed")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Watch a folder for Cellpose outputs and analyze every slice as soon as its files are complete.")
+    parser.add_argument('watch_dir', help="folder the segmentation writes to, see FILE_SUFFIXES for the file names")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of warm worker processes (default: 1, analyze in this process)")
+    parser.add_argument('--format', choices=sorted(STORE_FORMATS), default='csv', help="result backend")
+    parser.add_argument('--output-dir', default='.', help="folder for the result tables (default: current)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help=f"seconds between scans of the folder (default: {DEFAULT_INTERVAL:g})")
+    parser.add_argument('--once', action='store_true', help="process the complete slices, then exit")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f"per-slice result cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--no-cache', action='store_true', help="don't use the result cache")
+    parser.add_argument('--roi', choices=['none', 'pixels', 'centroid'], default='none',
+                        help="restrict statistics to the subiculum, see batch.py")
+    parser.add_argument('--no-cohort', action='store_true', help="don't update the cohort statistics")
+    parser.add_argument('--no-density-maps', action='store_true', help="don't write density maps")
+    parser.add_argument('--no-log', action='store_true', help=f"no JSON log ({DEFAULT_LOG_NAME} in the output folder)")
+    parser.add_argument('--checkpoint', default=None,
+                        help=f"checkpoint file (default: {WATCH_CHECKPOINT_NAME} in the output folder)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.watch_dir):
+        print(f"Error: {args.watch_dir} is not a folder")
+        return 1
+    options = {
+        'cache_dir': None if args.no_cache else args.cache_dir,
+        'roi_mode': None if args.roi == 'none' else args.roi,
+        'density_dir': None if args.no_density_maps else os.path.join(args.output_dir, DEFAULT_DENSITY_DIR)
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    log = open_log(None if args.no_log else os.path.join(args.output_dir, DEFAULT_LOG_NAME))
+    try:
+        service = WatchService(
+            args.watch_dir, open_store(args.format, args.output_dir), options, workers=args.workers,
+            cohort_path=None if args.no_cohort else os.path.join(args.output_dir, DEFAULT_STATE_NAME),
+            checkpoint_path=args.checkpoint or os.path.join(args.output_dir, WATCH_CHECKPOINT_NAME),
+            log=log)
+        service.run(args.interval, once=args.once)
+    finally:
+        if log is not None:
+            log.close()
+    return 0 if not service.failed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+# the pipeline modules are flat files run from their folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Morphometric Computation'))
+
+def label_disks(shape, n_objects, max_radius, rng, first_label=1):
+    """Cellpose-style label image: n_objects disks at random positions, later ones on top"""
+    labels = np.zeros(shape, dtype=np.uint16)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    for label in range(first_label, first_label + n_objects):
+        cy, cx = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        radius = rng.integers(2, max_radius)
+        labels[(rows - cy) ** 2 + (cols - cx) ** 2 < radius * radius] = label
+    return labels
+
+def save_seg(path, masks):
+    # the parts of a Cellpose _seg.npy the pipeline reads
+    np.save(path, {'masks': masks, 'flows': [np.zeros((3,) + masks.shape, dtype=np.uint8)]}, allow_pickle=True)
+    return str(path)
+
+def save_sub(path, shape):
+    # elliptic subiculum mask, 255 inside
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    sub = np.zeros(shape, dtype=np.uint8)
+    sub[((rows - shape[0] / 2) / (shape[0] / 3)) ** 2 + ((cols - shape[1] / 2) / (shape[1] / 2.4)) ** 2 < 1] = 255
+    Image.fromarray(sub).save(path)
+    return str(path)
+
+@pytest.fixture
+def synthetic_slice(tmp_path):
+    """small slice: cell and ab _seg.npy (overlapping objects) and a subiculum .tif"""
+    rng = np.random.default_rng(7)
+    shape = (120, 180)
+    return {
+        'cell_npy_path': save_seg(tmp_path / 'cell_seg.npy', label_disks(shape, 40, 8, rng)),
+        'ab_npy_path': save_seg(tmp_path / 'ab_seg.npy', label_disks(shape, 12, 15, rng)),
+        'sub_path': save_sub(tmp_path / 'sub.tif', shape),
+        'shape': shape,
+        'pixel_to_micrometer': 0.17
+    }
+
+@pytest.fixture
+def slice_params(synthetic_slice):
+    """batch.parse_row output for the synthetic slice"""
+    rows, cols = synthetic_slice['shape']
+    px = synthetic_slice['pixel_to_micrometer']
+    return {
+        'cell_npy_path': synthetic_slice['cell_npy_path'],
+        'ab_npy_path': synthetic_slice['ab_npy_path'],
+        'sub_path': synthetic_slice['sub_path'],
+        'physical_width': cols * px,
+        'physical_height': rows * px,
+        'pixel_to_micrometer': px,
+        'left_sub_end': (20.0, rows / 2),
+        'right_sub_end': (cols - 20.0, rows / 2),
+        'age': '6 months',
+        'mouse_id': 'M1',
+        'slice_id': 's1',
+        'sex': 'Female',
+        'genotype': 'WT'
+    }
@@ -0,0 +1,47 @@
+import tracemalloc
+import pandas as pd
+from batch import analyze_slice, run_manifest
+from result_store import open_store
+
+def test_analyze_slice_traces_memory_only_when_asked(slice_params, monkeypatch):
+    started = []
+    start = tracemalloc.start
+    monkeypatch.setattr(tracemalloc, 'start', lambda *args: started.append(True) or start(*args))
+
+    outcome = analyze_slice(slice_params, {'cache_dir': None})
+    assert not started
+    assert outcome['peak_bytes'] is None
+    assert all(record['peak_mb'] is None for record in outcome['stages'])
+    assert outcome['peak_rss_bytes'] is None or outcome['peak_rss_bytes'] > 0
+
+    outcome = analyze_slice(slice_params, {'cache_dir': None, 'trace_memory': True})
+    assert started
+    assert not tracemalloc.is_tracing()
+    assert outcome['peak_bytes'] > 0
+    assert all(record['peak_mb'] is not None for record in outcome['stages'])
+
+def _manifest(tmp_path, synthetic_slice):
+    rows, cols = synthetic_slice['shape']
+    px = synthetic_slice['pixel_to_micrometer']
+    path = tmp_path / 'manifest.csv'
+    pd.DataFrame([{
+        'mouse_id': 'M1', 'sex': 1, 'genotype': 2, 'age': '6 months',
+        'cell_npy_path': synthetic_slice['cell_npy_path'], 'ab_npy_path': synthetic_slice['ab_npy_path'],
+        'sub_path': synthetic_slice['sub_path'], 'physical_width': cols * px, 'physical_height': rows * px,
+        'pixel_width': cols, 'left_sub_end': f"20, {rows / 2}", 'right_sub_end': f"{cols - 20}, {rows / 2}"
+    }]).to_csv(path, index=False)
+    return str(path)
+
+def test_resume_redoes_slices_when_an_output_option_changes(tmp_path, synthetic_slice):
+    manifest = _manifest(tmp_path, synthetic_slice)
+    out = tmp_path / 'out'
+    checkpoint = str(out / 'batch_checkpoint.json')
+
+    def run(**options):
+        return run_manifest(manifest, store=open_store('csv', str(out)), checkpoint_path=checkpoint, resume=True,
+                            options={'cache_dir': None, 'profile_bins': None, **options})
+
+    assert [s['resumed'] for s in run()] == [False]
+    assert [s['resumed'] for s in run()] == [True]
+    assert [s['resumed'] for s in run(proximity_radius_um=10.0)] == [False]
+    assert [s['resumed'] for s in run(proximity_radius_um=10.0, density_dir=str(tmp_path / 'maps'))] == [False]
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from centreline import thin, longest_path, nearest_seed_map, skeleton_centreline, new_coverage, \
+    accumulate_coverage
+
+def _disk(shape, centre, radius):
+    rows, cols = np.indices(shape)
+    return (rows - centre[0]) ** 2 + (cols - centre[1]) ** 2 <= radius ** 2
+
+def _band(shape=(40, 120)):
+    # thick curved band, a subiculum-like shape
+    rows, cols = np.indices(shape)
+    return np.abs(rows - (12 + 0.002 * (cols - 60) ** 2)) <= 4 + (cols % 7 == 0)
+
+@pytest.mark.parametrize('mask', [_band(), _disk((50, 50), (25, 25), 18), np.pad(np.ones((6, 30), bool), 3)])
+def test_thin_gives_one_pixel_wide_connected_skeleton(mask):
+    skeleton = thin(mask)
+    assert skeleton.any()
+    assert not (skeleton & ~mask).any()
+    # one pixel wide: no 2 x 2 block is all skeleton, and thinning again changes nothing
+    assert not (skeleton[:-1, :-1] & skeleton[1:, :-1] & skeleton[:-1, 1:] & skeleton[1:, 1:]).any()
+    np.testing.assert_array_equal(thin(skeleton), skeleton)
+    # thinning keeps the mask in one piece
+    longest_path(skeleton)
+
+def test_longest_path_skips_side_branches():
+    skeleton = np.zeros((12, 25), dtype=bool)
+    skeleton[5, 0:21] = True     # main axis
+    skeleton[6:10, 10] = True    # side branch
+    path = longest_path(skeleton)
+    assert len(path) == 21
+    assert {path[0], path[-1]} == {(5, 0), (5, 20)}
+    # consecutive points are 8-neighbours
+    assert all(max(abs(a[0] - b[0]), abs(a[1] - b[1])) == 1 for a, b in zip(path, path[1:]))
+
+def test_longest_path_warns_about_more_pieces():
+    skeleton = np.zeros((12, 25), dtype=bool)
+    skeleton[2, 0:20] = True
+    skeleton[9, 3:7] = True
+    with pytest.warns(UserWarning, match='2 pieces'):
+        path = longest_path(skeleton)
+    assert len(path) == 20
+
+def test_nearest_seed_map_matches_brute_force():
+    rng = np.random.default_rng(5)
+    for shape, n_seeds in [((37, 91), 40), ((64, 64), 5), ((120, 30), 200)]:
+        seeds = np.stack([rng.integers(0, shape[0], n_seeds), rng.integers(0, shape[1], n_seeds)], axis=1)
+        nearest = nearest_seed_map(shape, seeds)
+        rows, cols = np.indices(shape)
+        d2 = (seeds[:, 0, None, None] - rows) ** 2 + (seeds[:, 1, None, None] - cols) ** 2
+        best = d2.min(axis=0)
+        got = d2[nearest, rows, cols]
+        # "exact for nearly all cells, the rest get a seed marginally farther"
+        assert np.mean(got == best) >= 0.99
+        assert (np.sqrt(got) - np.sqrt(best)).max() <= 1.0
+
+def _coverage(mask):
+    coverage = new_coverage(mask.shape, 1)
+    accumulate_coverage(coverage, mask, 1)
+    return coverage
+
+def test_centreline_of_a_round_mask_is_an_error():
+    # a disk thins to a single block: no main axis, so no proximal / distal direction
+    mask = _disk((30, 30), (15, 15), 10)
+    with pytest.raises(ValueError, match='left_sub_end'):
+        skeleton_centreline(_coverage(mask), mask.shape, 1, 0.5)
+
+def test_centreline_of_a_band_runs_left_to_right():
+    mask = _band()
+    centreline = skeleton_centreline(_coverage(mask), mask.shape, 1, 0.5)
+    assert centreline['length_um'] > 0
+    assert centreline['left_end_pixel'][0] < centreline['right_end_pixel'][0]
+    assert centreline['t_map'].min() == 0 and centreline['t_map'].max() == 1
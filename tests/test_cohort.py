@@ -0,0 +1,81 @@
+import math
+import numpy as np
+import pytest
+from cohort import RunningStats, QuantileSketch, DEFAULT_QUANTILES, SKETCH_RELATIVE_ACCURACY
+
+def cohort_values(rng):
+    # object-area-like values: skewed, a few NaNs (empty sides), zeros and negative values
+    values = np.concatenate([rng.lognormal(3, 1.5, 4000), np.zeros(50), -rng.lognormal(1, 1, 300)])
+    values[rng.choice(len(values), 20, replace=False)] = np.nan
+    return rng.permutation(values)
+
+def chunks(values, rng, n_chunks=40):
+    # uneven slices, some of them empty, as the per-slice accumulators are
+    return np.split(values, np.sort(rng.integers(0, len(values), n_chunks)))
+
+@pytest.mark.parametrize('offset', [0.0, 1e6])
+def test_running_stats_merge_matches_numpy(offset):
+    rng = np.random.default_rng(11)
+    values = cohort_values(rng) + offset
+    expected = values[~np.isnan(values)]
+
+    # per slice accumulators merged pairwise in a random order, as batch / rebuild do
+    parts = []
+    for chunk in chunks(values, rng):
+        part = RunningStats()
+        part.add(chunk)
+        parts.append(part)
+    while len(parts) > 1:
+        a, b = parts.pop(rng.integers(len(parts))), parts.pop(rng.integers(len(parts)))
+        a.merge(b)
+        parts.append(a)
+    merged = parts[0]
+
+    assert merged.n == len(expected)
+    assert merged.mean == pytest.approx(expected.mean(), rel=1e-12, abs=1e-12)
+    assert merged.variance == pytest.approx(expected.var(ddof=1), rel=1e-9)
+    assert (merged.min, merged.max) == (expected.min(), expected.max())
+
+def test_running_stats_small_counts():
+    stats = RunningStats()
+    stats.add([np.nan])
+    assert stats.n == 0 and math.isnan(stats.variance)
+    stats.add([4.0])
+    assert stats.mean == 4.0 and math.isnan(stats.variance)
+    other = RunningStats()
+    other.add([6.0])
+    stats.merge(other)
+    stats.merge(RunningStats())
+    assert (stats.n, stats.mean, stats.variance) == (2, 5.0, 2.0)
+
+def test_quantile_sketch_is_within_its_relative_accuracy():
+    rng = np.random.default_rng(12)
+    values = cohort_values(rng)
+    expected_values = values[~np.isnan(values)]
+    qs = (0.0,) + DEFAULT_QUANTILES + (0.01, 0.99, 1.0)
+
+    whole = QuantileSketch()
+    whole.add(values)
+    merged = QuantileSketch()
+    for chunk in chunks(values, rng):
+        part = QuantileSketch()
+        part.add(chunk)
+        merged.merge(part)
+
+    # the sketch returns the value at rank floor(q * (n - 1)), up to its relative accuracy
+    expected = np.quantile(expected_values, qs, method='lower')
+    approx = whole.quantiles(qs)
+    assert whole.n == len(expected_values)
+    np.testing.assert_array_less(np.abs(np.array(approx) - expected), SKETCH_RELATIVE_ACCURACY * np.abs(expected) + 1e-12)
+    # merging is exact: the same buckets as one sketch of all values
+    assert merged.quantiles(qs) == approx
+
+def test_quantile_sketch_edge_cases():
+    empty = QuantileSketch()
+    assert all(math.isnan(q) for q in empty.quantiles(DEFAULT_QUANTILES))
+    with pytest.raises(ValueError):
+        empty.merge(QuantileSketch(relative_accuracy=0.05))
+    single = QuantileSketch()
+    single.add([0.0, 0.0, 7.5])
+    assert single.quantiles([0.0, 0.5]) == [0.0, 0.0]
+    assert single.quantiles([1.0])[0] == pytest.approx(7.5, rel=SKETCH_RELATIVE_ACCURACY)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from density_map import fft_smooth, gaussian_kernel, density_maps, MAP_NAMES
+from object_table import new_object_table, OBJECT_TYPES
+
+def direct_smooth(grid, sigma_bins):
+    # plain zero-padded convolution, one shifted copy of the grid per kernel entry
+    kernel = gaussian_kernel(sigma_bins)
+    radius = kernel.shape[0] // 2
+    padded = np.pad(grid, radius)
+    n_rows, n_cols = grid.shape
+    out = np.zeros(grid.shape)
+    for dy in range(kernel.shape[0]):
+        for dx in range(kernel.shape[1]):
+            out += kernel[dy, dx] * padded[2 * radius - dy:2 * radius - dy + n_rows, 2 * radius - dx:2 * radius - dx + n_cols]
+    return out
+
+@pytest.mark.parametrize('sigma_bins', [0.4, 1.5, 3.6])
+def test_fft_smooth_matches_direct_convolution(sigma_bins):
+    rng = np.random.default_rng(13)
+    # a stack of sparse count / area grids, objects also right at the border
+    grids = np.zeros((3, 40, 55))
+    grids[0][rng.integers(0, 40, 60), rng.integers(0, 55, 60)] += 1
+    grids[1][rng.integers(0, 40, 60), rng.integers(0, 55, 60)] += rng.lognormal(3, 1, 60)
+    grids[2][[0, 0, 39, 39, 20], [0, 54, 0, 54, 27]] = 1
+    smoothed = fft_smooth(grids, sigma_bins)
+    assert smoothed.shape == grids.shape
+    for grid, result in zip(grids, smoothed):
+        np.testing.assert_allclose(result, direct_smooth(grid, sigma_bins), rtol=0, atol=1e-12 * grid.max())
+
+def test_fft_smooth_does_not_wrap_around():
+    grid = np.zeros((30, 30))
+    grid[15, 0] = 1
+    smoothed = fft_smooth(grid, 2.0)
+    # a circular convolution would put mass of the left edge on the right edge
+    assert smoothed[:, -8:].max() < 1e-12
+    assert (smoothed >= 0).all()
+    # mass near the border partly leaves the grid, mass in the middle stays
+    assert 0.4 < smoothed.sum() < 0.6
+    grid[15, 0], grid[15, 15] = 0, 1
+    assert fft_smooth(grid, 2.0).sum() == pytest.approx(1, abs=1e-12)
+    assert fft_smooth(grid, 0) is grid
+
+def test_density_maps_keep_the_object_count():
+    rng = np.random.default_rng(14)
+    n_objects = 50
+    objects = new_object_table(2 * n_objects)
+    objects['type'] = np.repeat([OBJECT_TYPES.index('cell'), OBJECT_TYPES.index('plaque')], n_objects)
+    # centroids between the ends of a 1000 um horizontal midline, well inside the grid
+    objects['x_um'] = rng.uniform(200, 800, 2 * n_objects)
+    objects['y_um'] = rng.uniform(-200, 200, 2 * n_objects)
+    objects['area_um2'] = rng.uniform(20, 80, 2 * n_objects)
+    midline = {'left_end_um': (0.0, 0.0), 'right_end_um': (1000.0, 0.0)}
+    maps = density_maps({'objects': objects}, midline)
+
+    assert sorted(key for key in maps if key in MAP_NAMES) == sorted(MAP_NAMES)
+    bin_area_mm2 = (1.2 / 120 * 1000) ** 2 / 1e6
+    for obj_type in OBJECT_TYPES:
+        rows = objects[objects['type'] == OBJECT_TYPES.index(obj_type)]
+        assert maps['n_outside'][obj_type] == 0
+        assert maps[f'{obj_type}_density'].sum() * bin_area_mm2 == pytest.approx(n_objects, rel=1e-5)
+        assert maps[f'{obj_type}_area_fraction'].sum() * bin_area_mm2 * 1e6 == \
+            pytest.approx(rows['area_um2'].sum(), rel=1e-5)
@@ -0,0 +1,167 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from image_io import load_label_masks, masks_cache_path, LazyTiff, open_tiff, clear_decode_cache, \
+    decode_cache_stats, _unpack_bits
+
+# (row_start, row_end, col_start, col_end) windows of a 50 x 70 image: whole image, across
+# strip / tile borders, one pixel in the last partial tile, the bottom right corner, empty
+WINDOWS = [(0, 50, 0, 70), (3, 18, 5, 40), (13, 14, 31, 33), (49, 50, 69, 70), (40, 50, 60, 70), (7, 7, 0, 10)]
+# tifffile keyword arguments of every layout LazyTiff decodes block by block
+LAYOUTS = {
+    'strips': {'rowsperstrip': 7},
+    'deflate': {'rowsperstrip': 7, 'compression': 'zlib'},
+    'deflate_predictor': {'rowsperstrip': 7, 'compression': 'zlib', 'predictor': True},
+    'big_endian': {'rowsperstrip': 7, 'compression': 'zlib', 'predictor': True, 'byteorder': '>'},
+    'tiles': {'tile': (16, 32)},
+    'tiles_deflate_predictor': {'tile': (16, 32), 'compression': 'zlib', 'predictor': True},
+}
+
+def random_image(dtype, rng, shape=(50, 70)):
+    if np.dtype(dtype).kind == 'f':
+        return rng.normal(0, 1000, shape).astype(dtype)
+    info = np.iinfo(dtype)
+    return rng.integers(info.min, info.max, shape, endpoint=True).astype(dtype)
+
+def write_tiff(path, array, **kwargs):
+    # PIL can't write tiles or predictor 2, the test files are written with tifffile
+    tifffile = pytest.importorskip('tifffile')
+    tifffile.imwrite(path, array, **kwargs)
+    return str(path)
+
+def test_masks_cache_stays_out_of_the_input_folder(synthetic_slice, tmp_path):
+    seg_path = synthetic_slice['cell_npy_path']
+    input_files = sorted(os.listdir(os.path.dirname(seg_path)))
+    expected = np.load(seg_path, allow_pickle=True).item()['masks']
+
+    # no cache folder: nothing is written anywhere
+    np.testing.assert_array_equal(load_label_masks(seg_path), expected)
+    assert sorted(os.listdir(os.path.dirname(seg_path))) == input_files
+
+    cache_dir = str(tmp_path / 'cache' / 'masks')
+    first = load_label_masks(seg_path, cache_dir)
+    assert os.path.isfile(masks_cache_path(seg_path, cache_dir))
+    second = load_label_masks(seg_path, cache_dir)
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, expected)
+    np.testing.assert_array_equal(second, expected)
+    assert sorted(os.listdir(os.path.dirname(seg_path))) == sorted(input_files + ['cache'])
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int32, np.float32])
+def test_lazy_tiff_windows_match_pil(tmp_path, layout, dtype):
+    if LAYOUTS[layout].get('predictor') and np.dtype(dtype).kind == 'f':
+        pytest.skip("predictor 2 is for integer samples")
+    array = random_image(dtype, np.random.default_rng(3))
+    path = write_tiff(tmp_path / 'image.tif', array, **LAYOUTS[layout])
+    expected = array
+    if not (layout == 'big_endian' and dtype == np.int32):
+        # PIL itself misreads compressed big-endian 32-bit integers
+        with Image.open(path) as img:
+            expected = np.array(img)
+        np.testing.assert_array_equal(expected, array)
+
+    tiff = LazyTiff(path)
+    assert tiff.shape == array.shape
+    for r0, r1, c0, c1 in WINDOWS:
+        window = tiff[r0:r1, c0:c1]
+        assert window.dtype == array.dtype
+        np.testing.assert_array_equal(window, expected[r0:r1, c0:c1])
+    np.testing.assert_array_equal(tiff[10:20], expected[10:20])
+    np.testing.assert_array_equal(np.asarray(tiff), expected)
+    with pytest.raises(IndexError):
+        tiff[::2, :]
+
+def test_lazy_tiff_decodes_only_the_blocks_of_a_window(tmp_path, monkeypatch):
+    array = random_image(np.uint16, np.random.default_rng(4))
+    tiff = LazyTiff(write_tiff(tmp_path / 'image.tif', array, **LAYOUTS['tiles_deflate_predictor']))
+    decoded = []
+    decode_block = LazyTiff._decode_block
+    monkeypatch.setattr(LazyTiff, '_decode_block', lambda self, index: decoded.append(index) or decode_block(self, index))
+    np.testing.assert_array_equal(tiff[20:40, 30:40], array[20:40, 30:40])
+    # 16 x 32 tiles, 3 across: rows 20-39 are tile rows 1 and 2, cols 30-39 tile cols 0 and 1
+    assert sorted(decoded) == [3, 4, 6, 7]
+
+def test_unsupported_tiff_falls_back_to_pil(tmp_path):
+    array = random_image(np.uint16, np.random.default_rng(5))
+    path = str(tmp_path / 'lzw.tif')
+    Image.fromarray(array).save(path, compression='tiff_lzw')
+    with pytest.raises(NotImplementedError):
+        LazyTiff(path)
+    image = open_tiff(path)
+    assert isinstance(image, np.ndarray)
+    np.testing.assert_array_equal(image, array)
+
+def test_floating_point_predictor_is_not_read_lazily(tmp_path):
+    array = random_image(np.uint16, np.random.default_rng(6))
+    path = write_tiff(tmp_path / 'image.tif', array, **LAYOUTS['deflate_predictor'])
+    # tifffile can't write predictor 3 without imagecodecs, patch the tag value in place
+    import tifffile
+    with tifffile.TiffFile(path) as tif:
+        value_offset = tif.pages[0].tags[317].valueoffset
+    with open(path, 'r+b') as f:
+        f.seek(value_offset)
+        f.write((3).to_bytes(2, 'little'))
+    with pytest.raises(NotImplementedError, match='predictor 3'):
+        LazyTiff(path)
+
+def test_unpack_bits():
+    # literal run of 3, repeat 'z' 4 times, no-op header 128, literal run of 1
+    assert _unpack_bits(bytes([2]) + b'abc' + bytes([253]) + b'z' + bytes([128, 0]) + b'q') == b'abczzzzq'
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_packbits_strips_match_pil(tmp_path, dtype):
+    # label-like data (long runs) so both PackBits run types occur
+    array = (np.random.default_rng(7).integers(0, 4, (50, 70)) * 300).astype(dtype)
+    array[10:30, 5:60] = np.arange(55, dtype=dtype)
+    path = str(tmp_path / 'packbits.tif')
+    Image.fromarray(array).save(path, compression='packbits', strip_size=70 * array.itemsize * 7)
+    with Image.open(path) as img:
+        expected = np.array(img)
+
+    tiff = LazyTiff(path)
+    assert tiff.block_shape == (7, 70)
+    for r0, r1, c0, c1 in WINDOWS:
+        np.testing.assert_array_equal(tiff[r0:r1, c0:c1], expected[r0:r1, c0:c1])
+
+def test_uncompressed_strips_are_memory_mapped(tmp_path):
+    array = random_image(np.uint16, np.random.default_rng(8))
+    path = str(tmp_path / 'plain.tif')
+    Image.fromarray(array).save(path)
+    tiff = LazyTiff(path)
+    assert tiff._memmap is not None
+    for r0, r1, c0, c1 in WINDOWS:
+        np.testing.assert_array_equal(tiff[r0:r1, c0:c1], array[r0:r1, c0:c1])
+
+def test_open_tiff_shares_decoded_blocks(tmp_path, monkeypatch):
+    clear_decode_cache()
+    array = (np.random.default_rng(9).integers(0, 4, (50, 70)) * 85).astype(np.uint8)
+    path = str(tmp_path / 'sub.tif')
+    Image.fromarray(array).save(path, compression='tiff_adobe_deflate', strip_size=70 * 7)
+    decoded = []
+    decode_block = LazyTiff._decode_block
+    monkeypatch.setattr(LazyTiff, '_decode_block', lambda self, index: decoded.append(index) or decode_block(self, index))
+
+    tiff = open_tiff(path)
+    assert open_tiff(path) is tiff
+    np.testing.assert_array_equal(tiff[:, :], array)
+    assert sorted(decoded) == list(range(8))
+    # another pass, e.g. analyze_mask after analyze_mask_sub: every strip from the cache
+    hits = decode_cache_stats()['hits']
+    np.testing.assert_array_equal(open_tiff(path)[3:40, 10:20], array[3:40, 10:20])
+    assert len(decoded) == 8
+    assert decode_cache_stats()['hits'] == hits + 6
+
+    # an edited file is a new identity, never served from the cache
+    edited = np.ascontiguousarray(array[::-1])
+    Image.fromarray(edited).save(path, compression='tiff_adobe_deflate', strip_size=70 * 5)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    assert open_tiff(path) is not tiff
+    np.testing.assert_array_equal(open_tiff(path)[:, :], edited)
+
+    clear_decode_cache()
+    assert decode_cache_stats()['bytes'] == 0
+    decoded.clear()
+    np.testing.assert_array_equal(open_tiff(path)[:, :], edited)
+    assert len(decoded) == 10
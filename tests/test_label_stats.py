@@ -0,0 +1,249 @@
+import numpy as np
+import pytest
+from PIL import Image
+import label_stats
+from label_stats import compute_label_stats, new_pair_accumulator, finish_label_pairs
+from cal_area import analyze_mask, overlap_by_side
+from side_split import is_left
+from object_table import legacy_view, OBJECT_TYPES
+from conftest import save_seg
+
+MIDPOINT = (15.3, 10.2)
+PERPENDICULAR = (0.2, 1.0)
+TILE_SHAPES = [(None, None), (17, 23), (512, None)]
+SHAPE_KEYS = ['perimeter_pixels', 'major_axis_pixels', 'minor_axis_pixels', 'eccentricity', 'orientation_deg',
+              'bbox_rows', 'bbox_cols', 'extent']
+
+def loop_label_stats(label_image, exclude=None):
+    # the per-label loop analyze_mask used before label_stats: one boolean mask per label
+    label_image = np.array(label_image)
+    if exclude is not None:
+        label_image[exclude != 0] = 0
+    labels, area, cx, cy = [], [], [], []
+    for label in np.unique(label_image):
+        if label == 0:
+            continue
+        y_coords, x_coords = np.where(label_image == label)
+        labels.append(label)
+        area.append(len(x_coords))
+        cx.append(np.mean(x_coords))
+        cy.append(np.mean(y_coords))
+    return labels, area, cx, cy
+
+def loop_analyze_mask(cell_masks, ab_masks, px, age, midpoint, perpendicular):
+    # baseline analyze_mask: per-label loop, per-object side split, sequential side sums
+    ab_masks = np.array(ab_masks)
+    intra = np.count_nonzero((ab_masks != 0) & (cell_masks != 0)) * px ** 2
+    if age == '6 weeks':
+        ab_masks[cell_masks != 0] = 0
+    result = {'cell_global_dist': [], 'ab_global_dist': [], 'left': {}, 'right': {}}
+    for side in ('left', 'right'):
+        result[side] = {'cell_dist': [], 'ab_dist': [], 'cell_centroids': [], 'ab_centroids': [],
+                        'cell_count': 0, 'cell_area': 0.0, 'plaques': 0, 'plaque_area': 0.0}
+    for masks, prefix, count, area in ((cell_masks, 'cell', 'cell_count', 'cell_area'),
+                                       (ab_masks, 'ab', 'plaques', 'plaque_area')):
+        for label in np.unique(masks):
+            if label == 0:
+                continue
+            mask = masks == label
+            area_um = np.sum(mask) * px ** 2
+            result[f'{prefix}_global_dist'].append(area_um)
+            y_coords, x_coords = np.where(mask)
+            centroid_um = (np.mean(x_coords) * px, np.mean(y_coords) * px)
+            side = result['left'] if is_left(*centroid_um, midpoint, perpendicular) else result['right']
+            side[count] += 1
+            side[area] += area_um
+            side[f'{prefix}_dist'].append(area_um)
+            side[f'{prefix}_centroids'].append(centroid_um)
+    left, right = result['left'], result['right']
+    result['total'] = {'cell_count': left['cell_count'] + right['cell_count'],
+                       'cell_area': left['cell_area'] + right['cell_area'],
+                       'plaques': left['plaques'] + right['plaques'],
+                       'plaque_area': left['plaque_area'] + right['plaque_area'],
+                       'intra_plaque': intra}
+    return result
+
+def _seg_masks(path):
+    return np.load(path, allow_pickle=True).item()['masks']
+
+@pytest.mark.parametrize('tile_shape', TILE_SHAPES)
+@pytest.mark.parametrize('use_exclude', [False, True])
+def test_compute_label_stats_matches_loop(synthetic_slice, tile_shape, use_exclude):
+    cells = _seg_masks(synthetic_slice['cell_npy_path'])
+    ab = _seg_masks(synthetic_slice['ab_npy_path'])
+    exclude = cells if use_exclude else None
+    stats = compute_label_stats(ab, exclude=exclude, tile_shape=tile_shape)
+    labels, area, cx, cy = loop_label_stats(ab, exclude)
+    np.testing.assert_array_equal(stats['labels'], labels)
+    np.testing.assert_array_equal(stats['area_pixels'], area)
+    np.testing.assert_allclose(stats['centroid_x'], cx, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(stats['centroid_y'], cy, rtol=0, atol=1e-9)
+
+@pytest.mark.parametrize('tile_shape', TILE_SHAPES)
+@pytest.mark.parametrize('age', ['6 weeks', '6 months'])
+def test_analyze_mask_matches_loop(synthetic_slice, tile_shape, age):
+    px = synthetic_slice['pixel_to_micrometer']
+    result = legacy_view(analyze_mask(synthetic_slice['cell_npy_path'], synthetic_slice['ab_npy_path'], px, age,
+                                      MIDPOINT, PERPENDICULAR, tile_shape=tile_shape, verbose=False))
+    expected = loop_analyze_mask(_seg_masks(synthetic_slice['cell_npy_path']),
+                                 _seg_masks(synthetic_slice['ab_npy_path']), px, age, MIDPOINT, PERPENDICULAR)
+
+    assert result['cell_global_dist'] == expected['cell_global_dist']
+    assert result['ab_global_dist'] == expected['ab_global_dist']
+    for side in ('left', 'right'):
+        for key in ('cell_dist', 'ab_dist', 'cell_count', 'plaques'):
+            assert result[side][key] == expected[side][key], (side, key)
+        for key in ('cell_area', 'plaque_area'):
+            assert result[side][key] == pytest.approx(expected[side][key], rel=1e-12), (side, key)
+        for key in ('cell_centroids', 'ab_centroids'):
+            np.testing.assert_allclose(result[side][key], expected[side][key], rtol=0, atol=1e-9)
+    for key, value in expected['total'].items():
+        assert result['total'][key] == pytest.approx(value, rel=1e-12), key
+
+def test_centroid_roi_ignores_high_labels_outside_the_box(tmp_path):
+    # label 1 crosses the right edge of the box, so the window grows over label 500
+    # which is outside the box and has a higher id than any label inside it
+    shape = (100, 120)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    cells = np.zeros(shape, dtype=np.uint16)
+    cells[(rows - 50) ** 2 + (cols - 50) ** 2 < 100] = 1
+    cells[(rows - 50) ** 2 + (cols - 90) ** 2 < 64] = 500
+    box = {'min_row': 30, 'max_row': 70, 'min_col': 30, 'max_col': 55}
+    sub = np.zeros(shape, dtype=np.uint8)
+    sub[box['min_row']:box['max_row'] + 1, box['min_col']:box['max_col'] + 1] = 255
+    Image.fromarray(sub).save(tmp_path / 'sub.tif')
+
+    result = analyze_mask(save_seg(tmp_path / 'cell_seg.npy', cells),
+                          save_seg(tmp_path / 'ab_seg.npy', np.zeros(shape, dtype=np.uint16)), 1.0, '6 months',
+                          MIDPOINT, PERPENDICULAR, sub_path=str(tmp_path / 'sub.tif'), bounding_box=box,
+                          roi_mode='centroid', verbose=False)
+    assert result['objects']['label'].tolist() == [1]
+    assert result['objects']['area_um2'].tolist() == [np.count_nonzero(cells == 1)]
+
+def brute_force_pairs(cells, ab):
+    # one boolean mask per (cell, ab) label pair
+    pairs = {}
+    for cell_label in np.unique(cells[cells != 0]):
+        cell_mask = cells == cell_label
+        for ab_label in np.unique(ab[cell_mask & (ab != 0)]):
+            pairs[(cell_label, ab_label)] = np.count_nonzero(cell_mask & (ab == ab_label))
+    return pairs
+
+def _wide_ab_labels(ab):
+    # ab labels above 2**16, so the 32-bit halves of the packed pair keys are both used
+    ab = ab.astype(np.uint32)
+    ab[ab != 0] += 70000
+    return ab
+
+@pytest.mark.parametrize('tile_shape', TILE_SHAPES)
+def test_label_pairs_match_brute_force(synthetic_slice, tile_shape, monkeypatch):
+    # tiny merge size: the per-tile tables are merged many times
+    monkeypatch.setattr(label_stats, 'PAIR_MERGE_SIZE', 8)
+    cells = _seg_masks(synthetic_slice['cell_npy_path'])
+    ab = _wide_ab_labels(_seg_masks(synthetic_slice['ab_npy_path']))
+    acc = new_pair_accumulator()
+    overlap = overlap_by_side(cells, ab, 1.0, MIDPOINT, PERPENDICULAR, tile_shape, pairs=acc)
+    pairs = finish_label_pairs(acc)
+
+    expected = brute_force_pairs(cells, ab)
+    assert len(expected) > 5
+    assert list(zip(pairs['label_a'], pairs['label_b'])) == sorted(expected)
+    assert pairs['pixels'].tolist() == [expected[key] for key in sorted(expected)]
+    assert overlap.sum() == np.count_nonzero((cells != 0) & (ab != 0))
+
+@pytest.mark.parametrize('tile_shape', TILE_SHAPES)
+@pytest.mark.parametrize('age', ['6 weeks', '6 months'])
+def test_overlap_objects_match_brute_force(synthetic_slice, tmp_path, tile_shape, age):
+    px = synthetic_slice['pixel_to_micrometer']
+    cells = _seg_masks(synthetic_slice['cell_npy_path'])
+    ab = _wide_ab_labels(_seg_masks(synthetic_slice['ab_npy_path']))
+    # one plaque entirely inside a cell: gone for 6 weeks, fully overlapped for 6 months
+    ab[cells == np.bincount(cells.ravel())[1:].argmax() + 1] = 99999
+    objects = analyze_mask(synthetic_slice['cell_npy_path'], save_seg(tmp_path / 'ab_wide_seg.npy', ab), px, age,
+                           MIDPOINT, PERPENDICULAR, tile_shape=tile_shape, verbose=False)['objects']
+    pairs = brute_force_pairs(cells, ab)
+
+    cell_rows = objects[objects['type'] == OBJECT_TYPES.index('cell')]
+    assert cell_rows['label'].tolist() == np.unique(cells[cells != 0]).tolist()
+    for row in cell_rows:
+        mask = cells == row['label']
+        overlap = np.count_nonzero(mask & (ab != 0))
+        assert row['overlap_area_um2'] == pytest.approx(overlap * px ** 2, rel=1e-12)
+        assert row['object_area_um2'] == pytest.approx(np.count_nonzero(mask) * px ** 2, rel=1e-12)
+        assert row['overlap_fraction'] == pytest.approx(overlap / np.count_nonzero(mask), rel=1e-12)
+        assert row['n_partners'] == sum(1 for cell_label, _ in pairs if cell_label == row['label'])
+
+    # 6 weeks: plaques are counted without their cell pixels, a plaque
+    # entirely inside cells is dropped; overlap_data still gets whole plaques
+    outside_cells = ab[cells == 0] if age == '6 weeks' else ab
+    plaque_rows = objects[objects['type'] == OBJECT_TYPES.index('plaque')]
+    assert plaque_rows['label'].tolist() == np.unique(outside_cells[outside_cells != 0]).tolist()
+    assert (99999 in plaque_rows['label']) == (age == '6 months')
+    for row in plaque_rows:
+        mask = ab == row['label']
+        overlap = np.count_nonzero(mask & (cells != 0))
+        counted = mask & (cells == 0) if age == '6 weeks' else mask
+        assert row['area_um2'] == pytest.approx(np.count_nonzero(counted) * px ** 2, rel=1e-12)
+        assert row['object_area_um2'] == pytest.approx(np.count_nonzero(mask) * px ** 2, rel=1e-12)
+        assert row['overlap_area_um2'] == pytest.approx(overlap * px ** 2, rel=1e-12)
+        assert row['overlap_fraction'] == pytest.approx(overlap / np.count_nonzero(mask), rel=1e-12)
+        assert row['n_partners'] == sum(1 for _, ab_label in pairs if ab_label == row['label'])
+
+def brute_force_shape(label_image):
+    # shape descriptors from one boolean mask per label (image edge = background)
+    result = {key: [] for key in SHAPE_KEYS}
+    for label in np.unique(label_image[label_image != 0]):
+        mask = np.pad(label_image == label, 1)
+        centre = mask[1:-1, 1:-1]
+        boundary = centre & ~(mask[:-2, 1:-1] & mask[2:, 1:-1] & mask[1:-1, :-2] & mask[1:-1, 2:])
+        rows, cols = np.nonzero(centre)
+        cov = np.cov(np.vstack([cols, rows]), bias=True)
+        minor, major = np.maximum(np.linalg.eigvalsh(cov), 0)
+        bbox_rows, bbox_cols = rows.max() - rows.min() + 1, cols.max() - cols.min() + 1
+        result['perimeter_pixels'].append(np.count_nonzero(boundary))
+        result['major_axis_pixels'].append(4 * np.sqrt(major))
+        result['minor_axis_pixels'].append(4 * np.sqrt(minor))
+        result['eccentricity'].append(np.sqrt(1 - minor / major) if major > 0 else 0.0)
+        result['orientation_deg'].append(np.degrees(0.5 * np.arctan2(2 * cov[0, 1], cov[0, 0] - cov[1, 1])))
+        result['bbox_rows'].append(bbox_rows)
+        result['bbox_cols'].append(bbox_cols)
+        result['extent'].append(len(rows) / (bbox_rows * bbox_cols))
+    return result
+
+@pytest.mark.parametrize('tile_shape', TILE_SHAPES + [(5, 7)])
+@pytest.mark.parametrize('mask', [None, 'exclude', 'inside'])
+def test_shape_descriptors_match_brute_force(synthetic_slice, tile_shape, mask):
+    cells = _seg_masks(synthetic_slice['cell_npy_path'])
+    ab = _seg_masks(synthetic_slice['ab_npy_path'])
+    sub = np.array(Image.open(synthetic_slice['sub_path']))
+    exclude = cells if mask == 'exclude' else None
+    inside = sub if mask == 'inside' else None
+    stats = compute_label_stats(ab, exclude=exclude, inside=inside, tile_shape=tile_shape, shape=True)
+
+    # what the label pass sees: cell pixels / pixels outside the subiculum are background
+    visible = np.where(cells != 0, 0, ab) if mask == 'exclude' else ab
+    visible = np.where(sub == 255, visible, 0) if mask == 'inside' else visible
+    expected = brute_force_shape(visible)
+    np.testing.assert_array_equal(stats['labels'], np.unique(visible[visible != 0]))
+    for key in ('perimeter_pixels', 'bbox_rows', 'bbox_cols'):
+        np.testing.assert_array_equal(stats[key], expected[key], err_msg=key)
+    for key in ('major_axis_pixels', 'minor_axis_pixels', 'extent'):
+        np.testing.assert_allclose(stats[key], expected[key], rtol=1e-9, atol=1e-9, err_msg=key)
+    # squared: the sqrt turns rounding of the moments of a circle into ~1e-6
+    np.testing.assert_allclose(stats['eccentricity'] ** 2, np.square(expected['eccentricity']), rtol=0, atol=1e-9)
+    # orientation of a (near) circle is arbitrary, compare it where the axes differ;
+    # an axis angle is only defined up to 180 degrees (-90 == 90)
+    elongated = np.asarray(expected['eccentricity']) > 0.1
+    angle_diff = np.asarray(stats['orientation_deg']) - np.asarray(expected['orientation_deg'])
+    np.testing.assert_allclose((angle_diff[elongated] + 90) % 180 - 90, 0, rtol=0, atol=1e-6)
+
+def test_object_shape_columns_do_not_depend_on_tiles(synthetic_slice):
+    px = synthetic_slice['pixel_to_micrometer']
+    whole, tiled = (analyze_mask(synthetic_slice['cell_npy_path'], synthetic_slice['ab_npy_path'], px, '6 months',
+                                 MIDPOINT, PERPENDICULAR, tile_shape=tile_shape, verbose=False)['objects']
+                    for tile_shape in [(None, None), (17, 23)])
+    for key in ('perimeter_um', 'major_axis_um', 'minor_axis_um', 'extent', 'compactness'):
+        np.testing.assert_allclose(tiled[key], whole[key], rtol=1e-9, atol=1e-9, err_msg=key)
+    area_pixels = whole['area_um2'] / px ** 2
+    perimeter_pixels = whole['perimeter_um'] / px
+    np.testing.assert_allclose(whole['compactness'], 4 * np.pi * area_pixels / perimeter_pixels ** 2, rtol=1e-9)
@@ -0,0 +1,46 @@
+import math
+import numpy as np
+import pytest
+from batch import analyze_slice, finish_slice
+from result_store import open_store
+from permutation import permutation_test, load_slices, slice_data, LABEL_FIXED_METRICS
+
+OPTIONS = {'cache_dir': None, 'profile_bins': None}
+
+def _saved_slice(slice_params, fmt, output_dir):
+    store = open_store(fmt, str(output_dir))
+    finish_slice(slice_params, analyze_slice(slice_params, OPTIONS), store, OPTIONS)
+    store.flush()
+    return store
+
+@pytest.mark.parametrize('fmt', ['csv', 'sqlite'])
+def test_load_slices_joins_objects_on_id(slice_params, tmp_path, fmt):
+    store = _saved_slice(slice_params, fmt, tmp_path / fmt)
+    objects = analyze_slice(slice_params, OPTIONS)['mask_result']['objects']
+    # SQLite returns rows in any order: spatial_data reversed, distribution_data as stored
+    read = store.read
+    store.read = lambda name, columns=None, mouse_ids=None: \
+        read(name, columns, mouse_ids).iloc[::-1 if name == 'spatial_data' else 1]
+    [data] = load_slices(store)
+    for i, obj_type in enumerate(['cell', 'plaque']):
+        rows = objects[objects['type'] == i]
+        rows = rows[np.lexsort((rows['id'], rows['side']))]
+        np.testing.assert_array_equal(data['types'][obj_type]['area'], rows['area_um2'])
+        np.testing.assert_array_equal(data['types'][obj_type]['left'], rows['side'] == 0)
+
+def test_label_null_does_not_test_counts():
+    rng = np.random.default_rng(3)
+    slices = []
+    for s in range(4):
+        n = 30
+        objects = np.zeros(n, dtype=[('type', np.uint8), ('side', np.uint8), ('area_um2', np.float64),
+                                     ('x_um', np.float64), ('y_um', np.float64)])
+        objects['type'] = np.arange(n) % 2
+        objects['side'] = rng.integers(0, 2, n)
+        objects['area_um2'] = rng.uniform(1, 50, n)
+        slices.append(slice_data(objects, (0.0, 0.0), {'genotype': 'WT', 'age': '6 months', 'mouse_id': f'M{s}'}))
+    tests = permutation_test(slices, null='labels', n_permutations=200, seed=1).set_index('metric')
+    for metric in LABEL_FIXED_METRICS:
+        assert math.isnan(tests.loc[metric, 'p_value'])
+        assert math.isnan(tests.loc[metric, 'effect_z'])
+    assert tests.drop(LABEL_FIXED_METRICS)['p_value'].notna().all()
@@ -0,0 +1,75 @@
+import os
+import json
+import sqlite3
+import pandas as pd
+import pytest
+from result_store import CsvStore, SqliteStore, ParquetStore, JOURNAL_NAME
+
+def test_sqlite_read_closes_its_connection(tmp_path):
+    store = SqliteStore(str(tmp_path))
+    store.add({'summary_stats': pd.DataFrame({'mouse_id': ['M1'], 'slice_id': ['s1'], 'plaques': [3]})})
+    store.flush()
+
+    opened = []
+    connect = store._connect
+    store._connect = lambda: opened.append(connect()) or opened[-1]
+    df = store.read('summary_stats', ['mouse_id', 'plaques'], mouse_ids=['M1'])
+    assert df.to_dict('records') == [{'mouse_id': 'M1', 'plaques': 3}]
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute('SELECT 1')
+
+def _slice_rows(mouse_id, slice_id, values):
+    return {'summary_stats': pd.DataFrame({'mouse_id': mouse_id, 'slice_id': slice_id, 'plaques': values})}
+
+def test_csv_appends_new_slices_and_rewrites_replaced_ones(tmp_path):
+    store = CsvStore(str(tmp_path))
+    path = tmp_path / 'summary_stats.csv'
+    store.add(_slice_rows('M1', 's1', [1, 2]))
+    store.flush()
+    first = path.read_bytes()
+
+    store.add(_slice_rows('M1', 's2', [3]))
+    store.flush()
+    # appended: the bytes already written stay as they are
+    assert path.read_bytes().startswith(first)
+    assert store.read('summary_stats')['plaques'].tolist() == [1, 2, 3]
+
+    store.add(_slice_rows('M1', 's1', [4]))
+    store.flush()
+    df = store.read('summary_stats')
+    assert list(zip(df['slice_id'], df['plaques'])) == [('s2', 3), ('s1', 4)]
+    # a new store sees the same keys in the file
+    store = CsvStore(str(tmp_path))
+    store.add(_slice_rows('M1', 's2', [5]))
+    store.flush()
+    df = store.read('summary_stats')
+    assert list(zip(df['slice_id'], df['plaques'])) == [('s1', 4), ('s2', 5)]
+
+def test_csv_append_interrupted_after_journal_is_finished_once(tmp_path):
+    store = CsvStore(str(tmp_path))
+    store.add(_slice_rows('M1', 's1', [1]))
+    store.flush()
+    store.add(_slice_rows('M1', 's2', [2]))
+    store._staged = []
+    store._write({'summary_stats': pd.concat(store._pending['summary_stats'], ignore_index=True)},
+                 {('M1', 's2')})
+    staged = list(store._staged)
+    # journal on disk, the append half done: part of the staged rows already in the file
+    with open(tmp_path / JOURNAL_NAME, 'w', encoding='utf-8') as f:
+        json.dump(staged, f)
+    with open(tmp_path / 'summary_stats.csv', 'ab') as f:
+        f.write(b'M1,s2')
+
+    store = CsvStore(str(tmp_path))
+    assert not (tmp_path / JOURNAL_NAME).exists()
+    df = store.read('summary_stats')
+    assert list(zip(df['slice_id'], df['plaques'])) == [('s1', 1), ('s2', 2)]
+
+def test_parquet_slice_files_with_separators_in_the_ids(tmp_path):
+    pytest.importorskip('pyarrow')
+    store = ParquetStore(str(tmp_path))
+    store.add(_slice_rows('A/1', 's/1', [7]))
+    store.flush()
+    assert os.listdir(tmp_path / 'summary_stats') == ['A_1__s_1.parquet']
+    df = store.read('summary_stats')
+    assert list(zip(df['mouse_id'], df['slice_id'], df['plaques'])) == [('A/1', 's/1', 7)]
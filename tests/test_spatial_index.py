@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from spatial_index import GridIndex, BRUTE_FORCE_POINTS, MAX_SHELLS, plaque_proximity
+
+def brute_force_nearest(points, queries):
+    d = np.hypot(points[None, :, 0] - queries[:, None, 0], points[None, :, 1] - queries[:, None, 1])
+    return d.min(axis=1)
+
+@pytest.mark.parametrize('n_points', [1, 5, BRUTE_FORCE_POINTS + 1, 2000])
+@pytest.mark.parametrize('cover', [False, True])
+def test_nearest_matches_brute_force(n_points, cover):
+    rng = np.random.default_rng(n_points)
+    # points in one corner, queries around and beyond them
+    points = rng.uniform(0, 200, size=(n_points, 2))
+    queries = rng.uniform(-100, 400, size=(3000, 2))
+    dist, idx = GridIndex(points, cover=queries if cover else None).nearest(queries)
+    np.testing.assert_array_equal(dist, brute_force_nearest(points, queries))
+    np.testing.assert_array_equal(dist, np.hypot(*(points[idx] - queries).T))
+
+@pytest.fixture
+def work(monkeypatch):
+    """grid shells / cells looked at and brute-force distances computed by GridIndex"""
+    counted = {'candidate_calls': 0, 'cells': 0, 'brute_force': 0}
+    candidates, blocks = GridIndex._candidates, GridIndex._distance_blocks
+
+    def count_candidates(self, query_cells, offsets):
+        counted['candidate_calls'] += 1
+        counted['cells'] += len(query_cells) * len(offsets)
+        return candidates(self, query_cells, offsets)
+
+    def count_blocks(self, queries):
+        for chunk_start, d in blocks(self, queries):
+            counted['brute_force'] += d.size
+            yield chunk_start, d
+
+    monkeypatch.setattr(GridIndex, '_candidates', count_candidates)
+    monkeypatch.setattr(GridIndex, '_distance_blocks', count_blocks)
+    return counted
+
+def test_single_plaque_proximity_compares_directly(work):
+    # one plaque, 3000 cells over a whole slice: took over a minute walking grid shells
+    rng = np.random.default_rng(0)
+    cell_xy = rng.uniform(0, 3000, size=(3000, 2))
+    result = plaque_proximity(cell_xy, [[1500.0, 1500.0]])
+    np.testing.assert_array_equal(result['nearest_plaque_um'], np.hypot(*(cell_xy - 1500.0).T))
+    assert work['brute_force'] == 3000
+
+def test_dense_plaque_cluster_proximity_walks_few_shells(work):
+    # more plaques than BRUTE_FORCE_POINTS in a small cluster, cells far away
+    rng = np.random.default_rng(1)
+    plaque_xy = rng.uniform(0, 5, size=(BRUTE_FORCE_POINTS + 1, 2))
+    cell_xy = rng.uniform(2000, 3000, size=(3000, 2))
+    result = plaque_proximity(cell_xy, plaque_xy, radius_um=50.0)
+    np.testing.assert_array_equal(result['nearest_plaque_um'], brute_force_nearest(plaque_xy, cell_xy))
+    # the grid spans cells and plaques, so every cell is a few shells from the cluster
+    assert work['candidate_calls'] <= 2 * 20
+    assert work['brute_force'] == 0
+
+@pytest.mark.parametrize('points', [
+    np.column_stack([np.linspace(0, 5000, 500), np.zeros(500)]),   # collinear
+    np.full((300, 2), 10.0)                                          # duplicates
+], ids=['collinear', 'duplicates'])
+def test_nearest_without_cover_is_capped(work, points):
+    rng = np.random.default_rng(2)
+    queries = rng.uniform(-20000, 20000, size=(2000, 2))
+    dist, _ = GridIndex(points).nearest(queries)
+    np.testing.assert_array_equal(dist, brute_force_nearest(points, queries))
+    # at most MAX_SHELLS + 1 shells per chunk of queries, the rest by brute force
+    assert work['candidate_calls'] <= MAX_SHELLS + 1
+    assert work['brute_force'] <= len(queries) * len(points)
+
+def test_count_within_large_radius_falls_back(work):
+    points = np.column_stack([np.linspace(0, 5000, 500), np.zeros(500)])
+    queries = np.random.default_rng(3).uniform(-3000, 8000, size=(700, 2))
+    counts = GridIndex(points).count_within(queries, 5000.0)
+    d = np.hypot(points[None, :, 0] - queries[:, None, 0], points[None, :, 1] - queries[:, None, 1])
+    np.testing.assert_array_equal(counts, (d <= 5000.0).sum(axis=1))
+    # no (2 * r / cell_size + 1) ** 2 cells per query: that tried to allocate 745 GiB
+    assert work['cells'] == 0
+    assert work['brute_force'] == len(queries) * len(points)
+
+def test_count_within_small_radius_uses_the_grid(work):
+    rng = np.random.default_rng(4)
+    points = rng.uniform(0, 1000, size=(2000, 2))
+    queries = rng.uniform(0, 1000, size=(300, 2))
+    counts = GridIndex(points, cell_size=50.0).count_within(queries, 50.0)
+    d = np.hypot(points[None, :, 0] - queries[:, None, 0], points[None, :, 1] - queries[:, None, 1])
+    np.testing.assert_array_equal(counts, (d <= 50.0).sum(axis=1))
+    assert work['cells'] == len(queries) * 9
+    assert work['brute_force'] == 0
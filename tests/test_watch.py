@@ -0,0 +1,37 @@
+import os
+import json
+import shutil
+import pandas as pd
+from watch import main, WATCH_CHECKPOINT_NAME
+from checkpoint import DEFAULT_CHECKPOINT_NAME, load_checkpoint
+
+def _watch_folder(tmp_path, synthetic_slice):
+    watch_dir = tmp_path / 'incoming'
+    watch_dir.mkdir()
+    shutil.copy(synthetic_slice['cell_npy_path'], watch_dir / 's1_cell_seg.npy')
+    shutil.copy(synthetic_slice['ab_npy_path'], watch_dir / 's1_ab_seg.npy')
+    shutil.copy(synthetic_slice['sub_path'], watch_dir / 's1_sub.tif')
+    rows, cols = synthetic_slice['shape']
+    px = synthetic_slice['pixel_to_micrometer']
+    with open(watch_dir / 's1.json', 'w', encoding='utf-8') as f:
+        json.dump({'mouse_id': 'M1', 'sex': 1, 'genotype': 2, 'age': '6 months',
+                   'physical_width': cols * px, 'physical_height': rows * px, 'pixel_width': cols,
+                   'left_sub_end': f"20, {rows / 2}", 'right_sub_end': f"{cols - 20}, {rows / 2}"}, f)
+    return str(watch_dir)
+
+def test_watch_keeps_its_own_checkpoint_and_cache(tmp_path, synthetic_slice, monkeypatch):
+    watch_dir = _watch_folder(tmp_path, synthetic_slice)
+    out, cache = tmp_path / 'out', tmp_path / 'cache'
+    monkeypatch.chdir(tmp_path)
+    args = [watch_dir, '--once', '--interval', '0', '--output-dir', str(out), '--cache-dir', str(cache),
+            '--no-log', '--no-density-maps', '--no-cohort']
+    assert main(args) == 0
+
+    assert len(load_checkpoint(str(out / WATCH_CHECKPOINT_NAME))) == 1
+    assert not (out / DEFAULT_CHECKPOINT_NAME).exists()
+    assert os.listdir(cache) and not (tmp_path / '.result_cache').exists()
+    assert pd.read_csv(out / 'summary_stats.csv')['slice_id'].unique().tolist() == ['s1']
+
+    checkpoint = tmp_path / 'elsewhere.json'
+    assert main(args + ['--checkpoint', str(checkpoint)]) == 0
+    assert len(load_checkpoint(str(checkpoint))) == 1